@@ -0,0 +1,99 @@
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread
+from time import time
+
+from metrics import RollingPercentiles, Histogram, SIZE_BUCKETS
+from models import Activity
+
+logger = logging.getLogger("auth")
+
+
+class ActivityWriter():
+    """
+    Writes Activity rows from a background thread, committing them in groups.
+
+    A group is committed once it has batch_size rows or interval seconds after its first row came
+    in, so a crash loses at most interval seconds of activity. Rows are copied out of the Activity
+    object when they are queued, callers can keep using the object afterwards. When the database
+    falls queue_size rows behind, new rows are logged and dropped rather than holding up the
+    decision worker that recorded them.
+    """
+
+    def __init__(self, engine, interval=0.02, batch_size=50, queue_size=1000):
+        self._engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = Queue(maxsize=queue_size)
+        self._columns = [c.name for c in Activity.__table__.columns if not c.primary_key]
+        self.writeLatency = RollingPercentiles()
+        self.commitTime = RollingPercentiles()
+        self.batchSize = Histogram(SIZE_BUCKETS)
+        self.failed = 0
+        self.dropped = 0
+        self._thread = Thread(target=self._run, name="activity-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, activity: Activity) -> bool:
+        """:return: False if the writer is backed up and the record was dropped"""
+        row = {c: getattr(activity, c) for c in self._columns}
+        try:
+            self._queue.put_nowait((time(), row))
+            return True
+        except Full:
+            self.dropped += 1
+            logger.error(f"Activity writer is backed up, dropped activity record {row}")
+            return False
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            batch = []
+            deadline = time() + self.interval
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time()))
+                except Empty:
+                    break
+            if item is None:
+                running = False
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        start = time()
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(Activity.__table__.insert(), [row for (queued, row) in batch])
+        except Exception as e:
+            # don't let one bad record take the rest of the group with it
+            logger.warning(f"Group commit of {len(batch)} activity records failed, writing them one by one: {e}")
+            for (queued, row) in batch:
+                try:
+                    with self._engine.begin() as conn:
+                        conn.execute(Activity.__table__.insert(), row)
+                except Exception as row_error:
+                    self.failed += 1
+                    logger.error(f"Failed to write activity record {row}: {row_error}")
+        done = time()
+        self.commitTime.add(done - start)
+        self.batchSize.add(len(batch))
+        for (queued, row) in batch:
+            self.writeLatency.add(done - queued)
+
+    def shutdown(self):
+        """Commits everything queued so far and stops the writer"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return {"queued": self._queue.qsize(),
+                "write_latency": self.writeLatency.snapshot(),
+                "commit_time": self.commitTime.snapshot(),
+                "batch_size": self.batchSize.snapshot(),
+                "failed": self.failed,
+                "dropped": self.dropped}
@@ -12,6 +12,7 @@ from webpanel import webpanel
 import multiprocessing as mp
 
 from authorization_service import AuthorizationService
+from rpc import RpcClient
 
 
 if __name__ == '__main__':
@@ -25,7 +26,6 @@ if __name__ == '__main__':
         from queue import Queue
         sq = Queue()
         wq = Queue()
-    webpanel.config['squeue'] = sq
-    webpanel.config['wqueue'] = wq
+    webpanel.config['rpc'] = RpcClient(sq, wq)
     logger.info("Application starting up")
     webpanel.run( host="0.0.0.0",port=8443, debug=Debug)
\ No newline at end of file
@@ -1,4 +1,7 @@
 class AuthPlugin(object):
+    # Bumped whenever refresh_database brings in new data, cached denials are dropped when it changes
+    data_version = 0
+
     def get_configuration_schema(self) -> (str, dict, bool):
         """
         :return: (plugin name, config schema, config required)
@@ -14,9 +17,25 @@ class AuthPlugin(object):
     def on_close(self):
         pass
 
+    def refresh_interval(self):
+        """
+        :return: seconds between calls to refresh_database, None if the plugin never refreshes
+        """
+        return 60
+
     def refresh_database(self):
+        """
+        Brings the plugin's data up to date. Called from a refresh thread, never twice at once, and
+        should raise when the refresh fails.
+        """
         pass
 
+    def stats(self):
+        """
+        :return: plugin specific figures for the diagnostics page, None if there are none
+        """
+        return None
+
 
     def on_scan(self, credential_type, credential_value, scanner, facility, now_time) -> (bool, str, str):
         """
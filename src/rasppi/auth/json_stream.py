@@ -0,0 +1,92 @@
+import codecs
+import json
+from typing import Iterable, Iterator
+
+WHITESPACE = " \t\n\r"
+
+
+class _Stream():
+    """Text decoded from byte chunks, read forward through a buffer that's trimmed as it's consumed"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self) -> bool:
+        """Reads another chunk into the buffer, False once the input is exhausted"""
+        if self.eof:
+            return False
+        if self.pos > len(self.buffer) // 2:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self.buffer += text
+                return True
+        self.buffer += self._decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def peek(self) -> str:
+        """:return: the next character that isn't whitespace, without consuming it, "" at the end of input"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.more():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, found {self.peek()!r}")
+        self.pos += 1
+
+    def value(self, decoder: json.JSONDecoder):
+        """Decodes the next JSON value, reading more input until the value is complete"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.more()
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str, decoder: json.JSONDecoder = None) -> Iterator:
+    """
+    Yields the elements of the array stored under key in a top-level JSON object, each one as soon
+    as it has been read. Only one element is held at a time, other values in the object are decoded
+    and thrown away, and nothing after the array is read.
+
+    :param chunks: the UTF-8 document in pieces of any size, e.g. response.iter_content()
+    """
+    decoder = decoder or json.JSONDecoder()
+    stream = _Stream(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        name = stream.value(decoder)
+        stream.expect(":")
+        if name == key:
+            break
+        stream.value(decoder)
+        if stream.peek() == "}":
+            return
+        stream.expect(",")
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        yield stream.value(decoder)
+        if stream.peek() == "]":
+            return
+        stream.expect(",")
@@ -1,24 +1,78 @@
 import base64
+import hashlib
 import time
 import traceback
 
 from auth.auth_plugin import AuthPlugin
-from datetime import date, datetime
-from threading import Lock, Thread, Event
+from auth.json_stream import iter_json_array
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import Dict, FrozenSet, NamedTuple, Optional
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
-from sqlalchemy import Table, Column, Integer, String, Date, DateTime, Boolean, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, Date, DateTime, Boolean, Float, ForeignKey, Index, MetaData, text
 from sqlalchemy.ext.declarative import declarative_base
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import RollingPercentiles
 
 WildApricotBase = declarative_base()
 
 logger = logging.getLogger("wildapricot")
 
+# (connect, read) timeouts for Wild Apricot calls. On-demand lookups happen while someone waits
+# at the door and give up well inside the service's auth deadline.
+SYNC_TIMEOUT = (5.0, 60.0)
+ON_DEMAND_TIMEOUT = (2.0, 2.0)
+# Total time a scan waits for an on-demand lookup before going with the database's answer
+ON_DEMAND_WAIT = 2.0
+# Access tokens are replaced this long before they expire, or halfway through shorter lifetimes
+TOKEN_EARLY_REFRESH = 120.0
+TOKEN_DEFAULT_LIFETIME = 1800.0
+
 EXPIRED_LEVEL = 1491510
 CANCELED_LEVEL = 1497893
 
+class MemberRecord(NamedTuple):
+    """One member as scans see it, a plain tuple with no per-instance dict"""
+    person: str
+    code: str
+    member_enabled: bool
+    member_status: str
+    is_banned: bool
+    expiration: datetime
+    membership_level: int
+    last_login: Optional[datetime]
+    last_updated: datetime
+
+    def should_grant(self, now_time):
+        if not self.member_enabled:
+            return (False, self.person, "wildapricot:not_enabled", self.expiration, self.last_updated)
+        if self.is_banned:
+            return (False, self.person, "wildapricot:banned", self.expiration, self.last_updated)
+        if self.membership_level == EXPIRED_LEVEL or self.membership_level == CANCELED_LEVEL: # Magic number, Expired level from WA
+            return (False, self.person, "wildapricot:expired", self.expiration, self.last_updated)
+        if self.member_status != "Active":
+            return (False, self.person, "wildapricot:not_active", self.expiration, self.last_updated)
+        if self.expiration < now_time:
+            return (False, self.person, "wildapricot:expired",self.expiration, self.last_updated)
+        if self.last_login is None:
+            return (True, self.person, "wildapricot:needs_wa", self.expiration, self.last_updated)
+        return (True, self.person, "wildapricot:granted", self.expiration, self.last_updated)
+
+
+class MemberIndex(NamedTuple):
+    """Every member by fob code, replaced as a whole after each refresh"""
+    members: Dict[str, MemberRecord]
+    duplicates: FrozenSet[str]  # codes held by more than one member, the first one by row id is indexed
+    built: float  # time.time() when it was read from the database
+    build_seconds: float
+
+
 class WildApricotDb(WildApricotBase):
     __tablename__ = 'members'
 
@@ -33,36 +87,133 @@ class WildApricotDb(WildApricotBase):
     membership_level = Column(Integer)
     last_login = Column(DateTime, nullable=True)
     last_updated = Column(DateTime)
+    content_hash = Column(String)  # contact_hash() of what was last written, finds changed members in SQL
 
+    __table_args__ = (Index('ix_members_person_code', 'person', 'code'),)
+
+    def record(self) -> MemberRecord:
+        return MemberRecord._make(getattr(self, f) for f in MemberRecord._fields)
 
     def should_grant(self, now_time):
-        if not self.member_enabled:
-            return (False, self.person, "wildapricot:not_enabled", self.expiration, self.last_updated)
-        if self.is_banned:
-            return (False, self.person, "wildapricot:banned", self.expiration, self.last_updated)
-        if self.membership_level == EXPIRED_LEVEL or self.membership_level == CANCELED_LEVEL: # Magic number, Expired level from WA
-            return (False, self.person, "wildapricot:expired", self.expiration, self.last_updated)
-        if self.member_status != "Active":
-            return (False, self.person, "wildapricot:not_active", self.expiration, self.last_updated)
-        if self.expiration < now_time:
-            return (False, self.person, "wildapricot:expired",self.expiration, self.last_updated)
-        if self.last_login is None:
-            return (True, self.person, "wildapricot:needs_wa", self.expiration, self.last_updated)
-        return (True, self.person, "wildapricot:granted", self.expiration, self.last_updated)
+        return self.record().should_grant(now_time)
 
     @staticmethod
     def from_json(json):
         return WildApricotDb(person=str(json['person']), code=json['fob'], member_enabled=json['enabled'], expiration=json['renewal_due'],
                             member_status=json['status'], is_banned=json['banned'],last_login=json['last_login'],
-                                last_updated=datetime.now(), membership_level=json['membership_level'])
+                                last_updated=datetime.now(), membership_level=json['membership_level'],
+                             content_hash=contact_hash(json))
+
+
+# the member columns a contact fills in, in the order they're hashed
+CONTACT_COLUMNS = (('member_enabled', 'enabled'), ('member_status', 'status'), ('is_banned', 'banned'),
+                   ('expiration', 'renewal_due'), ('membership_level', 'membership_level'),
+                   ('last_login', 'last_login'))
+
+
+def contact_hash(contact):
+    return hashlib.sha1("\x1f".join(str(contact[k]) for c, k in CONTACT_COLUMNS).encode("UTF-8")).hexdigest()
+
+
+# Contacts from a full sync land here first and are applied to members in a few set-based statements
+STAGING_BATCH = 1000
+staging_metadata = MetaData()
+members_staging = Table('members_staging', staging_metadata,
+                        Column('person', String),
+                        Column('code', String),
+                        *(Column(c, WildApricotDb.__table__.c[c].type) for c, k in CONTACT_COLUMNS),
+                        Column('content_hash', String),
+                        Index('ix_members_staging_person_code', 'person', 'code', unique=True),
+                        prefixes=['TEMPORARY'])
+
+
+def migrate_members_db(engine):
+    """Creates the plugin's tables, and adds the columns and indexes that older databases don't have"""
+    WildApricotBase.metadata.create_all(engine)
+    with engine.connect() as connection:
+        existing = {row[1] for row in connection.execute(text("PRAGMA table_info(members)"))}
+        for column in WildApricotDb.__table__.columns:
+            if column.name not in existing:
+                connection.execute(text(f"ALTER TABLE members ADD COLUMN {column.name} "
+                                        f"{column.type.compile(engine.dialect)}"))
+        indexes = {row[1] for row in connection.execute(text("PRAGMA index_list(members)"))}
+        for index in WildApricotDb.__table__.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+
+def load_member_index(db) -> MemberIndex:
+    """
+    Reads every member into a new MemberIndex. Statuses and dates repeat across the membership,
+    so equal values share one object and a member costs its tuple plus its person and code strings.
+    """
+    started = perf_counter()
+    members = {}
+    duplicates = set()
+    shared = {}
+    shared_fields = [MemberRecord._fields.index(f) for f in ('member_status', 'expiration', 'last_login',
+                                                             'last_updated')]
+    table = WildApricotDb.__table__
+    for row in db.execute(table.select().with_only_columns([table.c[f] for f in MemberRecord._fields])
+                          .order_by(table.c.id)):
+        values = list(row)
+        for i in shared_fields:
+            values[i] = shared.setdefault(values[i], values[i])
+        record = MemberRecord._make(values)
+        if record.code in members:
+            duplicates.add(record.code)
+        else:
+            members[record.code] = record
+    return MemberIndex(members, frozenset(duplicates), time.time(), perf_counter() - started)
+
+
+SYNC_STATE_KEY = "contacts"
+# Delta syncs ask for contacts changed this long before the last sync started, covering clock skew
+# between the Pi and Wild Apricot. Both sides compare UTC times, so this only has to cover NTP drift
+# and requests in flight.
+DELTA_OVERLAP = timedelta(minutes=2)
+
+
+class WildApricotSyncState(WildApricotBase):
+    """Where the last sync left off, so delta syncs survive restarts"""
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    watermark = Column(DateTime)  # start of the last successful sync, UTC stored without a zone
+    last_full_sync = Column(DateTime)
+    last_sync_mode = Column(String)
+    last_contacts = Column(Integer)
+    last_added = Column(Integer)
+    last_modified = Column(Integer)
+    last_deleted = Column(Integer)
+    last_duration = Column(Float)
+    full_syncs = Column(Integer, default=0)
+    delta_syncs = Column(Integer, default=0)
+
 
 class WildApricotAuth(AuthPlugin):
+    TokenUrl = 'https://oauth.wildapricot.org/auth/token/'
+    ContactsUrl = 'https://api.wildapricot.org/v2.2/accounts/409807/contacts'
+    # bytes read from the contacts response at a time, contacts are decoded as they come in
+    StreamChunk = 64 * 1024
+
     def __init__(self):
-        self._mysqlFailure = False
-        self.refresh_done_event = Event()
-        self.on_demand_auth_event = Event()
-        self.on_demand_result = None
-    
+        self._token = None
+        self._tokenRefreshAt = 0.0
+        self._tokenLock = Lock()
+        self.tokenFetches = 0
+        self.tokenHits = 0
+        self.onDemandLatency = {stage: RollingPercentiles() for stage in ("token", "request", "decode", "total")}
+        self.onDemandTimeouts = 0
+        # one keep-alive session for every call, so lookups at the door reuse warm connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/json', 'User-Agent': 'WildApricotAuth'})
+        self.onDemand = ThreadPoolExecutor(max_workers=2, thread_name_prefix="wa-on-demand")
+        # scans look members up here, the database is only read to build it
+        self.memberIndex = MemberIndex({}, frozenset(), 0.0, 0.0)
 
     def priority(self):
         return 2
@@ -79,6 +230,7 @@ class WildApricotAuth(AuthPlugin):
                 "dbfile": {"type": "string"},
                 "api_key": {"type": "string"},
                 "refresh": {"type" : "integer"},
+                "full_refresh": {"type" : "integer"},
                 "__line__": {},
             },
             "required" : ["dbfile","api_key"]
@@ -87,6 +239,8 @@ class WildApricotAuth(AuthPlugin):
     def read_configuration(self, config):
         self.DatabaseFile = config['dbfile']
         self.Refresh = config['refresh'] * 60 if 'refresh' in config else 20 * 60
+        # refreshes in between full ones only fetch contacts changed since the last sync, 0 makes every refresh full
+        self.FullRefresh = config['full_refresh'] * 60 if 'full_refresh' in config else 24 * 60 * 60
         self.ApiKey = base64.b64encode(f"APIKEY:{config['api_key']}".encode("UTF-8")).decode("ascii")
 
         self.RequestHeaders = {
@@ -104,33 +258,29 @@ class WildApricotAuth(AuthPlugin):
         Session = sessionmaker(bind=engine)
         # session = Session()
         self.ScopedSession = scoped_session(Session)
-        WildApricotBase.metadata.create_all(engine)
-        logger.info("Loaded Wild Apricot Membership Plugin")
-        self.LastSQLRefresh = datetime.min
+        migrate_members_db(engine)
+        self.reload_member_index()
+        logger.info(f"Loaded Wild Apricot Membership Plugin, {len(self.memberIndex.members)} fobs")
         self.refresh_lock = Lock()
 
-    def refresh_database(self):
-        now = datetime.now()
-        if (now - self.LastSQLRefresh).total_seconds() >= self.Refresh:
-            if not self.refresh_lock.locked():
-                self.LastSQLRefresh = now
-                #launch the database resync on its own thread because internet timeouts make this take awhile
-                self.refresh_done_event.clear()
-                t = Thread(target=self.do_database_refresh)
-                t.start()
-
-    def do_database_refresh(self):
+    def reload_member_index(self):
+        """Rebuilds the fob index from the database and swaps it in, scans in flight keep the old one"""
+        db = self.ScopedSession()
         try:
-            self.refresh_lock.acquire(True,timeout=30) #todo: this could be a problem, needs better sync
-            self.refresh_membership()
-            self._mysqlFailure = False
-        except Exception as e:
-            if not self._mysqlFailure:
-                logger.error(f"Unable to refresh membership database: {e}")
-                self._mysqlFailure = True
+            self.memberIndex = load_member_index(db)
         finally:
-            self.refresh_lock.release()
-            self.refresh_done_event.set()
+            db.close()
+
+    def on_close(self):
+        self.onDemand.shutdown(wait=False)
+        self.session.close()
+
+    def refresh_interval(self):
+        return self.Refresh
+
+    def refresh_database(self):
+        with self.refresh_lock:
+            self.refresh_membership()
 
     # def getFieldValue(self, js, fv, default=None):
         # match = [a['Value'] for a in js['FieldValues'] if a['FieldName'] == fv]
@@ -159,51 +309,89 @@ class WildApricotAuth(AuthPlugin):
         # If no matching 'FieldName' is found after checking all items, return default.
         return default
 
-    def get_access_token(self):
-        refresh_url = 'https://oauth.wildapricot.org/auth/token/'
-        response = requests.post(refresh_url, data={'grant_type': 'client_credentials', 'scope': 'auto'},
-                                 headers=self.RequestHeaders)
-        response.raise_for_status()
-        oauth = response.json()
-        access_token = oauth['access_token']
-        return access_token
+    def get_access_token(self, timeout=SYNC_TIMEOUT):
+        """The cached access token, fetched again when it is about to expire"""
+        with self._tokenLock:
+            if self._token is not None and monotonic() < self._tokenRefreshAt:
+                self.tokenHits += 1
+                return self._token
+            response = self.session.post(self.TokenUrl, data={'grant_type': 'client_credentials', 'scope': 'auto'},
+                                         headers=self.RequestHeaders, timeout=timeout)
+            response.raise_for_status()
+            oauth = response.json()
+            lifetime = float(oauth.get('expires_in', TOKEN_DEFAULT_LIFETIME))
+            self._token = oauth['access_token']
+            self._tokenRefreshAt = monotonic() + lifetime - min(TOKEN_EARLY_REFRESH, lifetime / 2)
+            self.tokenFetches += 1
+            return self._token
+
+    def forget_token(self, token):
+        with self._tokenLock:
+            if self._token == token:
+                self._token = None
+
+    def get_contacts(self, params, timeout, stream=False, timings=None):
+        """GET on the contacts endpoint, fetching a new token once if the cached one was turned down"""
+        for attempt in range(2):
+            started = perf_counter()
+            access_token = self.get_access_token(timeout)
+            if timings is not None:
+                timings['token'] = timings.get('token', 0.0) + perf_counter() - started
+            started = perf_counter()
+            response = self.session.get(self.ContactsUrl, headers={'Authorization': f'Bearer {access_token}'},
+                                        params=params, timeout=timeout, stream=stream)
+            if timings is not None:
+                timings['request'] = timings.get('request', 0.0) + perf_counter() - started
+            if response.status_code != 401 or attempt > 0:
+                return response
+            response.close()
+            self.forget_token(access_token)
+
+    def query_contacts(self, contact_filter, select):
+        responseContacts = self.get_contacts({'$async': 'false',
+                                              '$filter': contact_filter,
+                                              '$select': select
+                                              }, SYNC_TIMEOUT, stream=True)
+        with responseContacts:
+            # Raise an exception on HTTP error
+            responseContacts.raise_for_status()
+            # the whole membership is one response, never hold all of it at once
+            yield from iter_json_array(responseContacts.iter_content(self.StreamChunk), 'Contacts')
 
     def list_wa_accounts(self):
-        access_token = self.get_access_token()
-
-        responseContacts = requests.get('https://api.wildapricot.org/v2.2/accounts/409807/contacts',
-                                        headers={'Accept': 'application/json',
-                                                 'Authorization': f'Bearer {access_token}',
-                                                 },
-                                        params={'$async': 'false',
-                                                '$filter': "'Key Fob' ne 'NULL' AND 'Key Fob' ne 0 AND 'IsArchived' eq False",
-                                                '$select': "'Key Fob','Key Fob is','MembershipEnabled','Renewal due','Status','is_banned', 'LastLoginDate'"
-                                                }
-                                        )
-        # Raise an exception on HTTP error
-        responseContacts.raise_for_status()
-        cc = responseContacts.json()
-
-        for c in cc['Contacts']:
+        for c in self.query_contacts("'Key Fob' ne 'NULL' AND 'Key Fob' ne 0 AND 'IsArchived' eq False",
+                                     "'Key Fob','Key Fob is','MembershipEnabled','Renewal due','Status','is_banned', 'LastLoginDate'"):
             contact = self.wa_to_contact(c)
             if contact:
                 yield contact
 
-    def get_single_contact(self, account_id, account_fob):
-        access_token = self.get_access_token()
-
-        responseContacts = requests.get('https://api.wildapricot.org/v2.2/accounts/409807/contacts',
-                                        headers={'Accept': 'application/json',
-                                                 'Authorization': f'Bearer {access_token}',
-                                                 },
-                                        params={'$async': 'false',
-                                                f'$filter': f"'Key Fob' eq '{account_fob}' and 'User Id' eq '{account_id}'", # Filtering on this to reduce surprised
-                                                '$select': "'Key Fob','Key Fob is','MembershipEnabled','Renewal due','Status','is_banned', 'LastLoginDate'"
-                                                }
-                                        )
+    def list_changed_accounts(self, since: datetime):
+        """
+        Contacts changed since the given time, whether or not they have a fob.
+        :param since: a time zone aware datetime, sent to Wild Apricot with its UTC offset
+        :return: (person id, contact) pairs, contact is None when the person no longer has a usable fob
+        """
+        since = since.astimezone(timezone.utc).isoformat(timespec='seconds')
+        for c in self.query_contacts(f"'Profile last updated' ge {since}",
+                                     "'Key Fob','Key Fob is','MembershipEnabled','Renewal due','Status','is_banned', 'LastLoginDate', 'Archived'"):
+            if 'Id' not in c:
+                continue
+            contact = None if self.getFieldValue(c, "Archived", False) else self.wa_to_contact(c)
+            if contact is not None and contact['fob'] == "f:0":
+                contact = None
+            yield str(c['Id']), contact
+
+    def get_single_contact(self, account_id, account_fob, timings=None):
+        responseContacts = self.get_contacts({'$async': 'false',
+                                              f'$filter': f"'Key Fob' eq '{account_fob}' and 'User Id' eq '{account_id}'", # Filtering on this to reduce surprised
+                                              '$select': "'Key Fob','Key Fob is','MembershipEnabled','Renewal due','Status','is_banned', 'LastLoginDate'"
+                                              }, ON_DEMAND_TIMEOUT, timings=timings)
         # Raise an exception on HTTP error
         responseContacts.raise_for_status()
+        started = perf_counter()
         cc = responseContacts.json()
+        if timings is not None:
+            timings['decode'] = perf_counter() - started
         if cc and 'Contacts' in cc and cc['Contacts']:
             return self.wa_to_contact(cc['Contacts'][0])
         else:
@@ -260,74 +448,169 @@ class WildApricotAuth(AuthPlugin):
         return contact
 
     def attempt_on_demand_auth(self, account, fob, now):
-        try:
-            contact = self.get_single_contact(account, fob)
-            if contact:
-                self.on_demand_result = WildApricotDb.from_json(contact).should_grant(now)
-            else:
-                self.on_demand_result = None
-        finally:
-            self.on_demand_auth_event.set()
+        """Asks Wild Apricot about one member directly, for when the database would turn them away"""
+        started = perf_counter()
+        timings = {}
+        contact = self.get_single_contact(account, fob, timings)
+        timings['total'] = perf_counter() - started
+        for stage, seconds in timings.items():
+            self.onDemandLatency[stage].add(seconds)
+        if contact:
+            return WildApricotDb.from_json(contact).should_grant(now)
+        return None
+
+    def stats(self):
+        return {"on_demand": {stage: p.snapshot() for stage, p in self.onDemandLatency.items()},
+                "on_demand_timeouts": self.onDemandTimeouts,
+                "token_fetches": self.tokenFetches,
+                "token_hits": self.tokenHits,
+                "index": {"members": len(self.memberIndex.members), "duplicates": len(self.memberIndex.duplicates),
+                          "built": self.memberIndex.built, "build_seconds": self.memberIndex.build_seconds}}
 
-    def refresh_membership(self):
-        logger.debug("Refreshing Wild Apricot Membership db")
-
-        #fobs = list(self.list_keyfobs(self.Url))
-        #print(f"fobs: {len(fobs)}")
+    @staticmethod
+    def update_member(mem: WildApricotDb, contact) -> bool:
+        """:return: whether anything about the member changed"""
+        if mem.member_enabled == contact['enabled'] and mem.code == contact['fob'] and \
+                mem.expiration == contact['renewal_due'] and mem.member_status == contact['status'] and \
+                mem.is_banned == contact['banned'] and mem.last_login == contact['last_login'] and \
+                mem.membership_level == contact['membership_level']:
+            return False
+        mem.member_enabled = contact['enabled']
+        mem.is_banned = contact['banned']
+        mem.code = contact['fob']
+        mem.expiration = contact['renewal_due']
+        mem.member_status = contact['status']
+        mem.last_updated = datetime.now()
+        mem.last_login = contact['last_login']
+        mem.membership_level = contact['membership_level']
+        mem.content_hash = contact_hash(contact)
+        return True
+
+    def full_sync(self, db):
+        """
+        Compares every contact with a fob against the database, removing members that are gone.
 
-        db = self.ScopedSession()
+        Contacts are written to a temporary staging table and applied with one statement each for
+        deleting, updating and inserting, all in the session's transaction. Members are only
+        updated when their content hash differs from the contact's.
+        """
+        connection = db.connection()
+        members_staging.create(connection, checkfirst=True)
+        connection.execute(members_staging.delete())
+        # Rows go straight to the DBAPI cursor, converted by the column types so they're stored
+        # exactly as the ORM would store them. A contact listed twice keeps its last entry.
+        staged_columns = ['person', 'code'] + [c for c, k in CONTACT_COLUMNS] + ['content_hash']
+        dialect = connection.dialect
+        convert = [members_staging.c[c].type.dialect_impl(dialect).bind_processor(dialect) or (lambda v: v)
+                   for c in staged_columns]
+        stage = f"INSERT OR REPLACE INTO members_staging ({', '.join(staged_columns)}) " \
+                f"VALUES ({', '.join('?' for c in staged_columns)})"
+        cursor = connection.connection.cursor()
+        batch = []
+        for contact in self.list_wa_accounts():
+            values = [contact['person'], contact['fob']] + [contact[k] for c, k in CONTACT_COLUMNS] + \
+                     [contact_hash(contact)]
+            batch.append([f(v) for f, v in zip(convert, values)])
+            if len(batch) >= STAGING_BATCH:
+                cursor.executemany(stage, batch)
+                batch = []
+        if batch:
+            cursor.executemany(stage, batch)
+        cursor.close()
+        num_contacts = connection.execute(text("SELECT COUNT(*) FROM members_staging")).scalar()
+        staged_row = "SELECT 1 FROM members_staging s WHERE s.person = members.person AND s.code = members.code"
+        columns = [c for c, k in CONTACT_COLUMNS]
+
+        num_deleted = connection.execute(text(f"DELETE FROM members WHERE NOT EXISTS ({staged_row})")).rowcount
+        # members written before content hashes existed get one when nothing about them changed
+        connection.execute(text(
+            f"UPDATE members SET content_hash = (SELECT s.content_hash FROM members_staging s "
+            f"WHERE s.person = members.person AND s.code = members.code) "
+            f"WHERE content_hash IS NULL AND EXISTS ({staged_row} AND "
+            + " AND ".join(f"s.{c} IS members.{c}" for c in columns) + ")"))
+        num_modified = connection.execute(text(
+            f"UPDATE members SET ({', '.join(columns)}, content_hash, last_updated) = "
+            f"(SELECT {', '.join('s.' + c for c in columns)}, s.content_hash, :now FROM members_staging s "
+            f"WHERE s.person = members.person AND s.code = members.code) "
+            f"WHERE EXISTS ({staged_row} AND s.content_hash IS NOT members.content_hash)"),
+            now=datetime.now()).rowcount
+        num_added = connection.execute(text(
+            f"INSERT INTO members (person, code, {', '.join(columns)}, content_hash, last_updated) "
+            f"SELECT s.person, s.code, {', '.join('s.' + c for c in columns)}, s.content_hash, :now "
+            f"FROM members_staging s WHERE NOT EXISTS (SELECT 1 FROM members m "
+            f"WHERE m.person = s.person AND m.code = s.code)"), now=datetime.now()).rowcount
+        connection.execute(members_staging.delete())
+        return num_contacts, num_added, num_modified, num_deleted
+
+    def delta_sync(self, db, since: datetime):
+        """
+        Applies the contacts changed since the given time. Contacts deleted outright in Wild Apricot
+        don't show up here, the next full sync removes them.
+        """
         num_deleted = 0
         num_modified = 0
         num_added = 0
-        # this could all be done a lot more efficiently, but future me can deal with that
-        m: WildApricotDb
-        members: dict = {(m.person, m.code): m for m in db.query(WildApricotDb).order_by(WildApricotDb.person).all() }
-        #members: list[TcmakerMembershipDb] =
-        current_fob = "None"
-        try:
-            for contact in self.list_wa_accounts():
-                person_id = contact['person']
-                code = contact['fob']
-                #person_url = contact['url']
-                enabled = contact['enabled']
-                status = contact['status']
-                banned = contact['banned']
-                expiration = contact['renewal_due']
-                last_login = contact['last_login']
-                level = contact['membership_level']
-
-                idpair = (person_id, code)
-                if idpair in members:
-                    mem: WildApricotDb = members[idpair]
-                    members.pop(idpair)
-                    #see if we should update this one
-                    if mem.member_enabled != enabled or mem.code != code or mem.expiration != expiration or\
-                            mem.member_status != status or mem.is_banned != banned or mem.last_login != last_login or \
-                            mem.membership_level != level:
-                        mem.member_enabled = enabled
-                        mem.is_banned = banned
-                        mem.code = code
-                        mem.expiration = expiration
-                        mem.member_status = status
+        changed = dict(self.list_changed_accounts(since))
+        people = list(changed)
+        rows = {}
+        # sqlite caps the number of parameters in a query
+        for n in range(0, len(people), 500):
+            for m in db.query(WildApricotDb).filter(WildApricotDb.person.in_(people[n:n + 500])):
+                rows.setdefault(m.person, []).append(m)
+        for person, contact in changed.items():
+            kept = False
+            for m in rows.get(person, []):
+                if contact is not None and not kept and m.code == contact['fob']:
+                    kept = True
+                    if self.update_member(m, contact):
                         num_modified += 1
-                        mem.last_updated = datetime.now()
-                        mem.last_login = last_login
-                        mem.membership_level = level
-                else: #they're new!
-                    newMember = WildApricotDb.from_json(contact)
-                    db.add(newMember)
-                    num_added += 1
-            for m in members.values():
-                current_fob = m
-                db.delete(m)
-                num_deleted += 1
-                pass
+                else:  # fob changed or removed, or the contact was archived
+                    db.delete(m)
+                    num_deleted += 1
+            if contact is not None and not kept:
+                db.add(WildApricotDb.from_json(contact))
+                num_added += 1
+        return len(changed), num_added, num_modified, num_deleted
+
+    def refresh_membership(self):
+        logger.debug("Refreshing Wild Apricot Membership db")
+        started = datetime.now()
+        started_utc = datetime.now(timezone.utc)
+        db = self.ScopedSession()
+        try:
+            state = db.query(WildApricotSyncState).get(SYNC_STATE_KEY)
+            if state is None:
+                state = WildApricotSyncState(name=SYNC_STATE_KEY, full_syncs=0, delta_syncs=0)
+                db.add(state)
+            full = self.FullRefresh <= 0 or state.watermark is None or state.last_full_sync is None or \
+                (started - state.last_full_sync).total_seconds() >= self.FullRefresh
+            if full:
+                (num_contacts, num_added, num_modified, num_deleted) = self.full_sync(db)
+                state.last_full_sync = started
+                state.full_syncs += 1
+            else:
+                since = state.watermark.replace(tzinfo=timezone.utc) - DELTA_OVERLAP
+                (num_contacts, num_added, num_modified, num_deleted) = self.delta_sync(db, since)
+                state.delta_syncs += 1
+            state.watermark = started_utc.replace(tzinfo=None)
+            state.last_sync_mode = "full" if full else "delta"
+            state.last_contacts = num_contacts
+            state.last_added = num_added
+            state.last_modified = num_modified
+            state.last_deleted = num_deleted
+            state.last_duration = (datetime.now() - started).total_seconds()
             db.commit()
+            if num_added or num_modified or num_deleted:
+                self.memberIndex = load_member_index(db)
+                self.data_version += 1
+            logger.debug(f"{state.last_sync_mode} sync of {num_contacts} contacts: added {num_added}, "
+                         f"modified {num_modified}, deleted {num_deleted}")
         except Exception as e:
-            logger.error(f"Unable to refresh wildapricot database: {e}, failed on {current_fob}. {traceback.format_exc()}")
+            db.rollback()
+            logger.error(f"Unable to refresh wildapricot database: {e}. {traceback.format_exc()}")
+            raise
         finally:
             db.close()
-            logger.debug(f"Added {num_added}, modified {num_modified}, deleted {num_deleted}")
 
     # denial types
     # Fob Not Recognized
@@ -341,30 +624,34 @@ class WildApricotAuth(AuthPlugin):
             return (False, None, "wildapricot:unknown_fob", None, None)
 
         credential_string = f"f:{int(credential_value)}"
-        db = self.ScopedSession()
+        index = self.memberIndex
         try:
-            user : list[WildApricotDb] = db.query(WildApricotDb).filter(WildApricotDb.code == credential_string).all()
-            if len(user) == 0:
+            user = index.members.get(credential_string)
+            if user is None:
                 return (False, None, "wildapricot:unknown_fob", None, None)
-            if len(user) > 1:
+            if credential_string in index.duplicates:
                 logger.warning(f"Unexpected duplicate users with same fob number: {credential_string}")
-            user : WildApricotDb = user[0]
             first_pass = user.should_grant(now_time)
             if first_pass[0]:
                 return first_pass
             # Attempt on-demand
-            Thread(target=self.attempt_on_demand_auth,args=(user.person,int(credential_value),now_time)).start()
-            if self.on_demand_auth_event.wait(2000):
-                second_pass = self.on_demand_result
-                if second_pass and second_pass[1] == user.person:
-                    #  If the on-demand was successful, we're not going to actually store it in the DB, we'll
-                    #  let the refresh deal with that
-                    return second_pass
+            lookup = self.onDemand.submit(self.attempt_on_demand_auth, user.person, int(credential_value), now_time)
+            try:
+                second_pass = lookup.result(timeout=ON_DEMAND_WAIT)
+            except TimeoutError:
+                self.onDemandTimeouts += 1
+                logger.warning(f"On-demand lookup of {credential_string} took longer than {ON_DEMAND_WAIT}s")
+                second_pass = None
+            except Exception as e:
+                logger.warning(f"On-demand lookup of {credential_string} failed: {e}")
+                second_pass = None
+            if second_pass and second_pass[1] == user.person:
+                #  If the on-demand was successful, we're not going to actually store it in the DB, we'll
+                #  let the refresh deal with that
+                return second_pass
             return first_pass
         except Exception as e:
             logger.error(f"Unable to test fob: {credential_value}, e: {e}")
-        finally:
-            db.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -380,6 +667,5 @@ if __name__ == "__main__":
     auth.on_load()
     now = datetime.now()
     auth.refresh_database()
-    auth.refresh_done_event.wait(60000)
     print(auth.on_scan("fob", "11123412", "frontdoor", "building", now))
 
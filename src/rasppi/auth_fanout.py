@@ -0,0 +1,154 @@
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from threading import Lock
+from time import time
+from typing import Dict
+
+from metrics import RollingPercentiles
+
+logger = logging.getLogger("auth")
+
+# on_scan answers (grant, member, authorization, expiration, last update). AuthPlugin's contract only
+# requires the first three, the rest are filled in with None.
+RESULT_FIELDS = 5
+
+
+class AuthFanout():
+    """
+    Asks every auth module about a scan at once instead of one after another.
+
+    Results are still read in priority order: a module's grant only wins once every module above it
+    has answered without granting or missed the deadline, so a slow or hung backend costs at most
+    `deadline` seconds per scan. Answers that arrive after the scan was decided are kept as late
+    results for auditing.
+
+    A module that still has a call running past its deadline isn't asked about new scans until that
+    call returns, so one hung backend can't tie up every worker.
+    """
+
+    def __init__(self, workers=8, deadline=3.0, late_history=50):
+        self.workers = workers
+        self.deadline = deadline
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+        self._lock = Lock()
+        self.latency: Dict[str, RollingPercentiles] = {}
+        self.timeouts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.lateResults = deque(maxlen=late_history)
+        # module -> {call: its deadline} for calls that hadn't answered when their scan was decided
+        self._outstanding: Dict[str, Dict[Future, float]] = {}
+
+    def _module_latency(self, name):
+        with self._lock:
+            if name not in self.latency:
+                self.latency[name] = RollingPercentiles()
+            return self.latency[name]
+
+    def _count(self, counts, name):
+        with self._lock:
+            counts[name] = counts.get(name, 0) + 1
+
+    def _call(self, am, args, timings):
+        latency = self._module_latency(am.__module__)
+        start = time()
+        try:
+            result = am.on_scan(*args)
+            if not isinstance(result, tuple) or not 3 <= len(result) <= RESULT_FIELDS:
+                raise TypeError(f"on_scan returned {result!r}, not a (grant, member, authorization, ...) tuple")
+            return result + (None,) * (RESULT_FIELDS - len(result))
+        except Exception:
+            self._count(self.errors, am.__module__)
+            raise
+        finally:
+            elapsed = time() - start
+            latency.add(elapsed)
+            if timings is not None:
+                timings[am.__module__] = elapsed
+
+    def _overdue(self, name, now):
+        """:return: how many of the module's calls are still running past their deadline"""
+        with self._lock:
+            return sum(1 for deadline in self._outstanding.get(name, {}).values() if deadline < now)
+
+    def _record_late(self, name, credential_ref, started, future):
+        with self._lock:
+            self._outstanding.get(name, {}).pop(future, None)
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Auth module {name} failed after the scan for {credential_ref} was decided: {e}")
+            return
+        elapsed = time() - started
+        with self._lock:
+            self.lateResults.append({"module": name, "credential": credential_ref, "grant": bool(result[0]),
+                                     "member": result[1], "authorization": result[2], "elapsed": elapsed})
+        if result[0]:
+            logger.warning(f"Auth module {name} granted {credential_ref} {elapsed:.2f}s after the scan, too late to unlock")
+
+    def decide(self, auth_modules, credential_type, credential_value, scanner, facility, now, timings=None):
+        """
+        :param auth_modules: modules in priority order, highest first
+        :param timings: optional dict, filled in with the seconds each module took as they answer
+        :return: (granting module or None, {module name: on_scan result} for every module that answered in time)
+        """
+        started = time()
+        deadline = started + self.deadline
+        args = (credential_type, credential_value, scanner, facility, now)
+        credential_ref = f'{credential_type}:{credential_value}'
+        futures = []
+        for am in auth_modules:
+            if self._overdue(am.__module__, started):
+                self._count(self.skipped, am.__module__)
+                logger.warning(f"Auth module {am.__module__} is still stuck on an earlier scan, skipped for {credential_ref}")
+                continue
+            futures.append((am, self._pool.submit(self._call, am, args, timings)))
+        results = {}
+        winner = None
+        unresolved = []
+        for am, future in futures:
+            if winner is not None:
+                if future.done():
+                    # answered in time, it just didn't matter
+                    if future.exception() is None:
+                        results[am.__module__] = future.result()
+                else:
+                    unresolved.append((am, future))
+                continue
+            try:
+                result = future.result(timeout=max(0.0, deadline - time()))
+                results[am.__module__] = result
+                if result[0]:
+                    winner = am
+            except TimeoutError:
+                self._count(self.timeouts, am.__module__)
+                logger.warning(f"Auth module {am.__module__} missed the {self.deadline:.1f}s deadline for {credential_ref}")
+                unresolved.append((am, future))
+            except Exception as ame:
+                logger.error(f"Failed to call auth module {am.__module__}:  {ame}")
+        for am, future in unresolved:
+            with self._lock:
+                self._outstanding.setdefault(am.__module__, {})[future] = deadline
+            future.add_done_callback(
+                lambda f, name=am.__module__: self._record_late(name, credential_ref, started, f))
+        return winner, results
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            names = list(self.latency)
+            late = list(self.lateResults)
+            timeouts = dict(self.timeouts)
+            errors = dict(self.errors)
+            skipped = dict(self.skipped)
+        now = time()
+        return {"deadline": self.deadline,
+                "modules": {n: {"latency": self.latency[n].snapshot(),
+                                "timeouts": timeouts.get(n, 0),
+                                "errors": errors.get(n, 0),
+                                "stuck": self._overdue(n, now),
+                                "skipped": skipped.get(n, 0)} for n in names},
+                "late": late}
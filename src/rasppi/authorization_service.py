@@ -1,16 +1,27 @@
 from configuration import Config, Facility, Scanner
-from models import DoorControllerBase, Activity#, Credential, Activity, AccessRequirement
-from hardware import ReaderBoard, query_devices
+from models import Activity, create_activity_engine, migrate_activity_db#, Credential, Activity, AccessRequirement
+from activity_writer import ActivityWriter
+from hardware import ReaderBoard, iter_query_devices
+from decision_pool import DecisionPool
+from auth_fanout import AuthFanout
+from negative_cache import NegativeCache
+from scan_debouncer import ScanDebouncer
+from tracing import ScanTrace, TraceRecorder
+import tracing
+from relay_scheduler import Scheduler
+from mqtt_publisher import MqttPublisher
+from log_pipeline import Pipeline
+from rpc import RPC
+from refresh_scheduler import RefreshScheduler
 import plugins
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy import create_engine
-import paho.mqtt.client as mqtt
 from json import dumps
 
 from typing import Dict, Iterable
 import logging
 
-from threading import Thread, Lock
+from threading import Lock, Thread, Timer
 from multiprocessing import Queue
 from queue import Empty
 
@@ -19,30 +30,56 @@ from datetime import datetime
 logger = logging.getLogger("auth")
 try:
     from datadog_logger import get_datadog_logger
-    dd_logger = get_datadog_logger("frontdoor", "front_door_access")
-    auth_service_logger = get_datadog_logger("authorization_service", "authorization_service")
+    dd_logger = Pipeline.install(get_datadog_logger("frontdoor", "front_door_access"))
+    auth_service_logger = Pipeline.install(get_datadog_logger("authorization_service", "authorization_service"))
     dd_logger.setLevel(logging.INFO)
     auth_service_logger.setLevel(logging.INFO)
 except:
     pass
 
+# Backoff between attempts to bring a failed board back, doubling up to the max
+RECONNECT_DELAY_MIN = 1.0
+RECONNECT_DELAY_MAX = 60.0
+# How long a hardware query waits on device probes, inside the webpanel's 10s wait for the reply
+DISCOVERY_REPLY_TIMEOUT = 6.0
+# How long replaced auth modules wait for the decisions still using them before they are closed anyway
+AUTH_RETIRE_TIMEOUT = 30.0
+
+
 class AuthorizationService:
     boards: Dict[str, ReaderBoard]
 
 
     def __init__(self, input_queue: Queue, output_queue: Queue):
-        engine = create_engine(f"sqlite:///{Config.ActivityDb}")
+        engine = create_activity_engine(Config.ActivityDb)
         Session = sessionmaker(bind=engine)
         # session = Session()
         self.ScopedSession = scoped_session(Session)
-        DoorControllerBase.metadata.create_all(engine)
+        migrate_activity_db(engine)
+        self.activityWriter = ActivityWriter(engine, Config.ActivityCommitInterval, Config.ActivityBatchSize)
 
         self._run = True
         self.boards = {}
         self.boardLock = Lock()
+        self._reconnectDelay: Dict[str, float] = {}
+        self._reconnectTimers: Dict[str, Timer] = {}
+        # boards are opened on their own threads, the loop installs them once they're up
+        self._openLock = Lock()
+        self._opening: Dict[str, Thread] = {}
+        self._opened: Dict[str, tuple] = {}  # device id -> (board or None, error or None)
         self._inqueue = input_queue
         self._outqueue = output_queue
         self.authModules = self.load_authorizations()
+        self.refresher = RefreshScheduler(self.authModules)
+        self.decisions = DecisionPool(Config.DecisionWorkers, Config.DecisionQueueDepth)
+        self.authFanout = AuthFanout(Config.AuthWorkers, Config.AuthDeadline)
+        self.negativeCache = NegativeCache(Config.NegativeCacheSize, Config.NegativeCacheTtl)
+        self.debouncer = ScanDebouncer()
+        self.traces = TraceRecorder()
+        self.capture = None
+        self.reload_capture()
+        self.mqtt = None
+        self.reload_mqtt()
         self.curfew_start = datetime(2020,4,13,22,0,0)
         self.curfew_end = datetime(2020,4,13,6,0,0)
 
@@ -63,90 +100,309 @@ class AuthorizationService:
             pass
         return sorted(auth_plugins, key=lambda ap: ap.priority(), reverse=True)
 
-    def reload_boards(self):
-        self.boardLock.acquire()
-        for bn, bv in self.boards.items():
-            logger.debug(f"Shutting down board: {bn}")
-            bv.shutdown()
-        self.boards.clear()
+    def retire_auth_modules(self, modules, pools):
+        """Closes replaced auth modules once the decisions that were queued while they were current are done"""
+        for pool in pools:
+            if not pool.drain(AUTH_RETIRE_TIMEOUT):
+                logger.warning(f"Decisions still running {AUTH_RETIRE_TIMEOUT}s after a reload, "
+                               f"closing the old auth modules anyway")
+                break
+        for api in modules:
+            try:
+                api.on_close()
+            except Exception as e:
+                logger.error(f"Failed to close {api}: {e}")
+
+    def reload_capture(self):
+        if self.capture is not None:
+            if self.capture.name == Config.ScanCapture:
+                return
+            self.capture.close()
+            self.capture = None
+        if Config.ScanCapture is not None:
+            try:
+                self.capture = open(Config.ScanCapture, 'a', buffering=1)
+            except OSError as e:
+                logger.error(f"Unable to open scan capture {Config.ScanCapture}: {e}")
+
+    def reload_mqtt(self):
+        """Starts, replaces or stops the MQTT publisher when the broker settings change"""
+        settings = (Config.mqtt_broker, Config.mqtt_port, Config.mqtt_topic, Config.mqtt_qos,
+                    Config.mqtt_queue_size, Config.mqtt_spool)
+        if self.mqtt is not None:
+            if settings == (self.mqtt.broker, self.mqtt.port, self.mqtt.topic, self.mqtt.qos,
+                            self.mqtt.queue_size, self.mqtt.spool_file):
+                return
+            self.mqtt.shutdown()
+            self.mqtt = None
+        if Config.mqtt_broker is None or Config.mqtt_topic is None or Config.mqtt_port is None:
+            return
+        try:
+            self.mqtt = MqttPublisher(Config.mqtt_broker, Config.mqtt_port, Config.mqtt_topic, qos=Config.mqtt_qos,
+                                      queue_size=Config.mqtt_queue_size, spool_file=Config.mqtt_spool)
+        except Exception as e:
+            logger.error(f"Failed to start MQTT publisher: {e}")
 
-        all_boards = []
+    def reload_boards(self):
+        """
+        Brings the running boards in line with the configuration. Only boards that were added or
+        removed are opened or shut down, boards that stay keep running along with their pending
+        relock timers. Facility mappings are looked up on every scan so they need nothing here.
+        """
+        with self.boardLock:
+            wanted = list(dict.fromkeys(Config.getDevices()))
+            for bn in [bn for bn in self.boards if bn not in wanted]:
+                self.close_board(bn)
+            for bn in [bn for bn in self._reconnectTimers if bn not in wanted]:
+                self._reconnectTimers.pop(bn).cancel()
+                self._reconnectDelay.pop(bn, None)
+
+            for f in wanted:
+                if f in self.boards or f in self._reconnectTimers:
+                    continue
+                self.open_board(f)
+
+    def open_board(self, device_id):
+        """
+        Starts opening a board on its own thread. Opening waits for the board to reset and answer,
+        which a hung board can drag out, so it never runs on the loop that carries unlocks.
+        """
+        with self._openLock:
+            if device_id in self._opening:
+                return
+            opener = Thread(target=self._open_in_background, args=(device_id,), name=f"open {device_id}",
+                            daemon=True)
+            self._opening[device_id] = opener
+        opener.start()
+
+    def _open_in_background(self, device_id):
+        logger.debug(f"Staring up board: {device_id}")
         try:
-            for f in Config.getDevices():
-                try:
-                    if f not in all_boards:
-                        logger.debug(f"Staring up board: {f}")
-                        new_reader = ReaderBoard(f)
-                        new_reader.packetCallback = self.on_scan
-                        self.boards[f] = new_reader
-                        new_reader.loop_crashed_callback = self.restart
-                        all_boards.append(f)
-                except Exception as e:
-                    logger.fatal(f"Unable to startup hardware {f}: {e}")
-        finally:
-            self.boardLock.release()
+            new_reader = ReaderBoard(device_id)
+            new_reader.packetCallback = self.dispatch_scan
+            new_reader.loop_crashed_callback = lambda: self.board_failed(device_id)
+            result = (new_reader, None)
+        except Exception as e:
+            result = (None, e)
+        with self._openLock:
+            self._opened[device_id] = result
+        self._inqueue.put(('opened', device_id))
+
+    def board_opened(self, device_id):
+        """Installs a board opened in the background, or schedules another attempt if it didn't come up"""
+        with self._openLock:
+            result = self._opened.pop(device_id, None)
+            if result is not None:
+                self._opening.pop(device_id, None)
+        if result is None:
+            return  # installed already
+        (new_reader, error) = result
+        with self.boardLock:
+            if not self._run or device_id not in Config.getDevices():
+                if new_reader is not None:
+                    try:
+                        new_reader.shutdown()
+                    except Exception as e:
+                        logger.error(f"Failed to shut down board {device_id} cleanly: {e}")
+                return
+            if error is not None:
+                logger.error(f"Unable to start up board {device_id}: {error}")
+                self.schedule_reconnect(device_id)
+                return
+            self.boards[device_id] = new_reader
+            self._reconnectDelay.pop(device_id, None)
+            logger.info(f"Board {device_id} is up")
+
+    def wait_for_opens(self, timeout=None):
+        """Waits for the boards being opened and installs them, for startup and shutdown"""
+        with self._openLock:
+            opening = list(self._opening.items())
+        for device_id, opener in opening:
+            opener.join(timeout)
+            self.board_opened(device_id)
+
+    def close_board(self, device_id):
+        board = self.boards.pop(device_id)
+        logger.debug(f"Shutting down board: {device_id}")
+        try:
+            board.shutdown()
+        except Exception as e:
+            logger.error(f"Failed to shut down board {device_id} cleanly: {e}")
+
+    def board_failed(self, device_id):
+        """Called from a board's read thread when it loses the device"""
+        self._inqueue.put(('reconnect', device_id))
+
+    def schedule_reconnect(self, device_id):
+        delay = min(RECONNECT_DELAY_MAX, self._reconnectDelay.get(device_id, RECONNECT_DELAY_MIN / 2) * 2)
+        self._reconnectDelay[device_id] = delay
+        logger.info(f"Retrying board {device_id} in {delay}s")
+        timer = Timer(delay, self._inqueue.put, args=(('reconnect', device_id),))
+        timer.daemon = True
+        self._reconnectTimers[device_id] = timer
+        timer.start()
+
+    def reconnect_board(self, device_id):
+        with self.boardLock:
+            self._reconnectTimers.pop(device_id, None)
+            if device_id not in Config.getDevices():
+                return
+            if device_id in self.boards:
+                self.close_board(device_id)
+            self.open_board(device_id)
 
     def run(self):
         self.reload_boards()
-        for api in self.authModules:
-            try:
-                api.refresh_database()
-            except Exception as e:
-                logger.error(f"Failed to refresh database, module: {api.__module__}, e: {e}")
+        self.wait_for_opens()
         while self._run:
+            self.refresher.run_due()
             try:
-                r = self._inqueue.get(block=True, timeout=60)
+                r = self._inqueue.get(block=True, timeout=self.refresher.next_wait())
             except Empty:
-                #  Do our AWS checks
-                for api in self.authModules:
-                    try:
-                        api.refresh_database()
-                    except Exception as e:
-                        logger.error(f"Failed to refresh database, module: {api.__module__}, e: {e}")
                 continue
 
+            # webpanel calls carry a request id that goes back with the reply
+            request_id = None
+            if type(r) == tuple and r[0] == RPC:
+                (_, request_id, r) = r
+
             if type(r) == tuple:
                 if r[0] == 'unlock':
-                    (c, board, relay, duration, credential) = r
-                    self.boards[board].Unlock(relay, duration, credential)
+                    (c, board, relay, duration, credential) = r[:5]
+                    trace = self.traces.claim(r[5]) if len(r) > 5 else None
+                    if board in self.boards:
+                        if trace is not None:
+                            trace.mark(tracing.RELAY_SENT)
+                        sent = self.boards[board].Unlock(relay, duration, credential)
+                    else:
+                        sent = None
+                        logger.error(f"Can't unlock relay {relay}, board {board} is offline")
+                    if trace is not None:
+                        if sent is not None:
+                            sent.add_done_callback(lambda f, t=trace: self.relay_answered(t, f))
+                        else:
+                            self.traces.finish(trace)
+                    if request_id is not None:
+                        if sent is not None:
+                            sent.add_done_callback(lambda f, rid=request_id: self.reply(rid, f.exception() is None))
+                        else:
+                            self.reply(request_id, False)
                 elif r[0] == "lock":
                     (a, board, relay, credential) = r
-                    self.boards[board].Lock(relay, credential)
+                    if board in self.boards:
+                        self.boards[board].Lock(relay, credential)
+                    if request_id is not None:
+                        self.reply(request_id, board in self.boards)
+                elif r[0] == 'reconnect':
+                    self.reconnect_board(r[1])
+                elif r[0] == 'opened':
+                    self.board_opened(r[1])
                 elif r[0] == 'aws':
-                    for api in self.authModules:
-                        api.refresh_database()
+                    self.refresher.request()
                 elif r[0] == "status":
                     fv: Facility
                     # def facilityStatus(f : Facility):
                     #    return self.boards[f.board].relaystatus[f.relay]
                     try:
-                        status = dict((f.name,
-                                       self.boards[f.board].relaystatus[f.relay]) for f in Config.Facilities.values())
+                        facilities = dict((f.name,
+                                           self.boards[f.board].relaystatus.get(f.relay, False)
+                                           if f.board in self.boards else False) for f in Config.Facilities.values())
                     # status = list(map(facilityStatus,Config.Facilities.values()))
-                        self._outqueue.put(status)
+                        self.reply(request_id, {"facilities": facilities,
+                                                "boards": {bn: bv.stats() for bn, bv in self.boards.items()},
+                                                "relock_jitter": Scheduler.jitter.snapshot(),
+                                                "decisions": self.decisions.stats(),
+                                                "auth": self.authFanout.stats(),
+                                                "negative_cache": self.negativeCache.stats(),
+                                                "debounce": self.debouncer.stats(),
+                                                "traces": self.traces.stats(),
+                                                "slow_scans": self.traces.slowest(),
+                                                "logging": Pipeline.stats(),
+                                                "refresh": self.refresher.stats(),
+                                                "plugins": {module: stats for (module, stats) in
+                                                            ((am.__module__, am.stats()) for am in self.authModules)
+                                                            if stats is not None},
+                                                "activity": self.activityWriter.stats(),
+                                                "mqtt": self.mqtt.stats() if self.mqtt is not None else None})
                     except:
-                        self._outqueue.put({})
+                        self.reply(request_id, {})
                 elif r[0] == "query":
-                    response = []
                     bv: ReaderBoard
-                    for bn, bv in self.boards.items():
-                        response.append(bv.__repr__())
-                    for bv in query_devices(ignored_devices=self.boards.values()):
-                        response.append(bv)
-                    self._outqueue.put(response)
+                    running = [bv.__repr__() for bv in self.boards.values()]
+                    # boards being opened or waiting to reconnect are ours, probing them would fight the reconnect
+                    with self._openLock:
+                        busy = set(self.boards) | set(self._opening) | set(self._reconnectTimers)
+                    # probing resets every board it finds, keep the loop free for unlocks meanwhile
+                    Thread(target=self.query_hardware, args=(request_id, running, busy), name="discovery",
+                           daemon=True).start()
                 elif r[0] == 'checkfob':
                     (a, fob) = r
                     logger.info(f"Got check fob for {fob}")
-                    self._outqueue.put(self.check_fob_status(fob))
+                    # the auth modules can take a while to answer, keep the loop free for other commands
+                    Thread(target=lambda rid=request_id: self.reply(rid, self.check_fob_status(fob)),
+                           name="checkfob", daemon=True).start()
                 elif r[0] == "reload":
                     # We have to do this here, even though it's also done in the webpanel, because
                     # Config is different here vs webpanel due to multiprocessing
                     Config.Reload()
                     self.reload_boards()
+                    draining = [self.decisions]
+                    if (Config.DecisionWorkers, Config.DecisionQueueDepth) != \
+                            (self.decisions.workers, self.decisions.queue_depth):
+                        old_pool = self.decisions
+                        self.decisions = DecisionPool(Config.DecisionWorkers, Config.DecisionQueueDepth)
+                        old_pool.shutdown(wait=False)
+                        draining.append(self.decisions)
+                    if (Config.AuthWorkers, Config.AuthDeadline) != (self.authFanout.workers, self.authFanout.deadline):
+                        old_fanout = self.authFanout
+                        self.authFanout = AuthFanout(Config.AuthWorkers, Config.AuthDeadline)
+                        old_fanout.shutdown()
+                    self.reload_mqtt()
+                    self.reload_capture()
+                    # new decisions pick up the new modules, the old ones are closed once nothing uses them
+                    retired = self.authModules
+                    self.authModules = self.load_authorizations()
+                    self.refresher.set_plugins(self.authModules)
+                    self.negativeCache = NegativeCache(Config.NegativeCacheSize, Config.NegativeCacheTtl)
+                    Thread(target=self.retire_auth_modules, args=(retired, draining), name="auth-retire",
+                           daemon=True).start()
+                    self.reply(request_id, "OK")
+                elif r[0] == "shutdown":
+                    self._run = False
+                    self.wait_for_opens(10.0)  # boards still coming up are shut down as they arrive
+                    with self.boardLock:
+                        for timer in self._reconnectTimers.values():
+                            timer.cancel()
+                        for bn in list(self.boards):
+                            self.close_board(bn)
+                    self.decisions.shutdown()
+                    self.authFanout.shutdown()
+                    self.activityWriter.shutdown()
+                    if self.mqtt is not None:
+                        self.mqtt.shutdown()
+                    if self.capture is not None:
+                        self.capture.close()
                     for api in self.authModules:
                         api.on_close()
-                    self.authModules = self.load_authorizations()
-                    self._outqueue.put("OK")
+                    Pipeline.stop()
+                    self.reply(request_id, "OK")
+
+    def query_hardware(self, request_id, running, busy):
+        """
+        Answers a hardware query with the running boards and every other board found. Boards probed
+        recently come from the discovery cache, the rest are added as their probes finish, and
+        probes still running at the deadline land in the cache for the next query.
+        """
+        response = list(running)
+        try:
+            response += iter_query_devices(None, DISCOVERY_REPLY_TIMEOUT, ignored_urls=busy)
+        except Exception as e:
+            logger.error(f"Hardware query failed: {e}")
+        self.reply(request_id, response)
+
+    def reply(self, request_id, response):
+        """Answers a command, tagged with its request id when it came in as an RPC call"""
+        self._outqueue.put(response if request_id is None else (request_id, response))
 
     def restart(self):
         self._inqueue.put(('reload',))
@@ -154,31 +410,83 @@ class AuthorizationService:
     def lock(self, board, relay, credential):
         self._inqueue.put(('lock', board, relay, credential))
 
-    def unlock(self, board, relay, duration, credential):
-        self._inqueue.put(('unlock', board, relay, duration, credential))
+    def unlock(self, board, relay, duration, credential, trace: ScanTrace = None):
+        if trace is None:
+            self._inqueue.put(('unlock', board, relay, duration, credential))
+        else:
+            self.traces.park(trace)
+            self._inqueue.put(('unlock', board, relay, duration, credential, trace.trace_id))
+
+    def relay_answered(self, trace: ScanTrace, sent):
+        if sent.exception() is None:
+            trace.mark(tracing.RELAY_ACKED)
+        self.traces.finish(trace)
 
-    def trigger_notify(self, activity):
-        if activity is not None:
-            t = Thread(target=self.notify_mqtt, args=[activity])
-            t.start()
+    def trigger_notify(self, payload):
+        if payload is not None and self.mqtt is not None:
+            self.mqtt.publish(payload)
 
     @staticmethod
     def find_facility(board, scanner_index):
-        target: Scanner or None = None
-        for sb, si in Config.getScanners().items():
-            if si.board == board and si.scannerIndex == scanner_index:
-                target = si
-                break
-        if target is not None:
-            for fn, fv in Config.getFacilities().items():
-                if fv.scanner == target or fv.outscanner == target:
-                    return fv, fv.scanner if fv.scanner == target else fv.outscanner
-        else:
-            return None, None
-
-    def on_scan(self, first_char: str, body: str, device_id: str):
-        db: Session = self.ScopedSession()
+        return Config.findFacility(board, scanner_index)
+
+    def dispatch_scan(self, first_char: str, body: str, device_id: str):
+        """
+        Packet callback for the boards. Runs on a board's serial reader thread, so all it does is
+        hand the scan to the decision pool, keyed by facility so scans at one door stay in order.
+        """
+        if first_char != 'F' and first_char != 'P':
+            return
+        board = self.boards.get(device_id)
+        trace = ScanTrace(board.packetTime if board is not None else None)
+        trace.mark(tracing.FRAMED)
+        if self.capture is not None:
+            try:
+                self.capture.write(f"{trace.marks[tracing.RECEIVED]:.3f} {device_id} {first_char}{body}\n")
+            except (OSError, ValueError):
+                pass  # closed by a reload
+        try:
+            scanner_index = int(body.split(',')[1])
+        except (IndexError, ValueError):
+            logger.warning(f"Malformed scan from {device_id}: {first_char}{body}")
+            return
+        (facility, scanner) = self.find_facility(device_id, scanner_index)
+        debounce_key = (device_id, scanner_index, first_char, body.split(',')[0])
+        if scanner is not None:
+            held = self.debouncer.seen(debounce_key, scanner.debounce, scanner.name)
+            if held is not None:
+                if not self.debouncer.can_extend(held) or self.extend_unlock(held.facility, debounce_key[3]):
+                    return
+                # the door relocked under a fob that is still held, it gets a decision of its own
+                self.debouncer.restart(debounce_key)
+        key = facility.name if facility is not None else device_id
+        trace.mark(tracing.DISPATCHED)
+        if not self.decisions.submit(key, self.on_scan, first_char, body, device_id, trace):
+            self.debouncer.forget(debounce_key)
+            credential_type = 'fob' if first_char == 'F' else 'passcode'
+            message = f"Denied {credential_type} scan at {key}, decision queue is full"
+            logger.warning(message)
+            try:
+                dd_logger.warning(message)
+            except:
+                pass
+
+    def extend_unlock(self, facility: Facility, credential_value) -> bool:
+        """
+        Keeps the door open for a fob that is still being held against the reader.
+        :return: False if the door isn't being held open anymore
+        """
+        board = self.boards.get(facility.board)
+        if board is not None and board.ExtendUnlock(facility.relay, facility.unlockduration, credential_value):
+            self.debouncer.extended += 1
+            return True
+        return False
+
+    def on_scan(self, first_char: str, body: str, device_id: str, trace: ScanTrace = None):
         activity = None
+        if trace is None:
+            trace = ScanTrace()
+        trace.mark(tracing.STARTED)
         try:
             if first_char == 'F' or first_char == 'P':  # keyfob
                 (code, scanner_index) = body.split(',')
@@ -190,33 +498,44 @@ class AuthorizationService:
                 auth_results = {}
                 if facility is not None:
                     now = datetime.now()
-                    #attempt to find an authorization for the user
-                    for am in self.authModules:
-                        try:
-                            (grant, member, auth, expiration, last_update) = am.on_scan(credential_type,credential_value,scanner,facility, now)
-                            auth_results[am.__module__] = (grant, member, auth, expiration, last_update)
-                            if grant:
-                                #CURFEW ENFORCING HACKJOB, REMOVE ME
-                                if (now > self.curfew_start and now < self.curfew_end):
-                                    activity = Activity(memberid=member,authorization="curfew",
-                                                    result="denied",
-                                                    timestamp=now,
-                                                    credentialref=credential_ref,
-                                                    facility=facility.name,
-                                                    notified=False)
-                                else:
-                                    activity = Activity(memberid=member, authorization=auth,
-                                                    result="granted" if grant else "denied",
-                                                    timestamp=datetime.now(),
-                                                    credentialref=credential_ref,
-                                                    facility=facility.name,
-                                                    notified=False)                            
-                                    self.unlock(facility.board, facility.relay, facility.unlockduration, credential_value)
-                                db.add(activity)
-                                db.commit()
-                                return
-                        except Exception as ame:
-                            logger.error(f"Failed to call auth module {am.__module__}:  {ame}")
+                    cache_key = (credential_type, credential_value, facility.name)
+                    modules = self.authModules  # one list for the whole decision, a reload can replace it meanwhile
+                    data_versions = tuple(am.data_version for am in modules)
+                    auth_results = self.negativeCache.get(cache_key, data_versions)
+                    if auth_results is not None:
+                        winner = None
+                    else:
+                        #attempt to find an authorization for the user, every module is asked at once
+                        (winner, auth_results) = self.authFanout.decide(modules, credential_type,
+                                                                        credential_value, scanner, facility, now,
+                                                                        trace.modules)
+                        # only cache credentials every module answered for and none of them knows
+                        if winner is None and len(auth_results) == len(modules) and \
+                                all(r[1] is None for r in auth_results.values()):
+                            self.negativeCache.put(cache_key, auth_results, data_versions)
+                    trace.mark(tracing.AUTHORIZED)
+                    if winner is not None:
+                        (grant, member, auth, expiration, last_update) = auth_results[winner.__module__]
+                        #CURFEW ENFORCING HACKJOB, REMOVE ME
+                        if (now > self.curfew_start and now < self.curfew_end):
+                            activity = Activity(memberid=member,authorization="curfew",
+                                            result="denied",
+                                            timestamp=now,
+                                            credentialref=credential_ref,
+                                            facility=facility.name,
+                                            notified=False)
+                        else:
+                            activity = Activity(memberid=member, authorization=auth,
+                                            result="granted" if grant else "denied",
+                                            timestamp=datetime.now(),
+                                            credentialref=credential_ref,
+                                            facility=facility.name,
+                                            notified=False)
+                            # marked before the unlock so relay_sent measures the relay path alone
+                            trace.mark(tracing.DECIDED)
+                            self.unlock(facility.board, facility.relay, facility.unlockduration, credential_value, trace)
+                            self.debouncer.granted((device_id, scanner_index, first_char, credential_value), facility)
+                        return
                 # no credential matched, or no valid facility, user is denied
                 wauth = auth_results.get('auth.wildapricot',None)
                 if wauth:
@@ -224,16 +543,26 @@ class AuthorizationService:
                                     result="denied", timestamp=datetime.now(),
                                     facility=facility.name if facility is not None else None,
                                     notified=False)
-                    db.add(activity)
-                    db.commit()
         finally:
+            if tracing.DECIDED not in trace.marks:
+                trace.mark(tracing.DECIDED)
             try:
                 if activity is not None:
                     mqtt_payload = self.make_mqtt_payload(activity)
                     self.trigger_notify(mqtt_payload)
             except Exception as mq:
                 logger.error("Failed to dispatch mqtt message: {mq}",exc_info=True)
-            db.close()
+            trace.mark(tracing.NOTIFIED)
+            if activity is not None:
+                trace.credential = activity.credentialref
+                trace.facility = activity.facility
+                trace.result = activity.result
+                trace.timestamp = activity.timestamp
+                activity.traceid = trace.trace_id
+                activity.latency = round(trace.total() * 1000.0, 3)
+                activity.stages = dumps({s: round(v * 1000.0, 3) for s, v in trace.stages().items()})
+                self.activityWriter.add(activity)
+            self.traces.finish(trace)
 
     def check_fob_status(self, fob):
         try:
@@ -301,15 +630,3 @@ class AuthorizationService:
             logger.warning(f"Failed datadog message: {exx}", exc_info=True)
 
         return pl
-
-    def notify_mqtt(self, payload):
-        if Config.mqtt_broker is None or Config.mqtt_topic is None or Config.mqtt_port is None:
-            return
-
-        try:
-            client = mqtt.Client()
-            client.connect(Config.mqtt_broker, Config.mqtt_port)
-            client.publish(Config.mqtt_topic,payload)
-            client.disconnect()
-        except Exception as e:
-            logger.error(f"Failed to signal MQTT message:  {e}")
@@ -0,0 +1,174 @@
+"""Benchmarks for the hardware layer, run against simulated boards"""
+import argparse
+import logging
+import random
+from enum import Enum
+from threading import Event
+from time import perf_counter, sleep, time
+
+from framing import PacketFramer
+from hardware import ReaderBoard
+from metrics import RollingPercentiles, format_ms
+from relay_scheduler import Scheduler
+from simulator import SimulatedFtdi
+
+
+def scan_latency(blocking_read, scans, spacing):
+    """Measures the time from a scan leaving the board to the packet callback firing"""
+    sim = SimulatedFtdi()
+    board = ReaderBoard("sim://latency", blocking_read=blocking_read, ftdi=sim)
+    latency = RollingPercentiles(window=scans)
+    sent = {}
+    done = Event()
+
+    def callback(first_char, body, device_id):
+        code = body.split(',')[0]
+        if code in sent:
+            latency.add(time() - sent.pop(code))
+            if latency.count == scans:
+                done.set()
+
+    board.packetCallback = callback
+    try:
+        for n in range(scans):
+            code = str(10000000 + n)
+            sent[code] = time()
+            sim.inject_scan(code, 1)
+            sleep(random.uniform(0.5, 1.5) * spacing)
+        done.wait(5.0)
+    finally:
+        board.shutdown()
+    return latency.snapshot()
+
+
+def relock_jitter(boards, unlocks, duration):
+    """Unlocks random relays across several boards and measures how late each relock fires"""
+    boards = [ReaderBoard(f"sim://relock{n}", ftdi=SimulatedFtdi()) for n in range(boards)]
+    Scheduler.jitter.clear()
+    try:
+        for n in range(unlocks):
+            board = random.choice(boards)
+            board.Unlock(random.randint(1, board.numRelays), random.uniform(0.5, 1.5) * duration, f"fob:{n}")
+            sleep(duration / 10)
+        sleep(duration * 2)
+    finally:
+        for board in boards:
+            board.shutdown()
+    return Scheduler.jitter.snapshot()
+
+
+class ParserState(Enum):
+    BEGIN = 1
+    FOUND_FIRST = 2
+    FOUND_CARRIAGE = 3
+    FOUND_NEWLINE = 4
+
+
+class LegacyParser():
+    """The per-byte state machine ReaderBoard.parse used before PacketFramer, kept for comparison"""
+
+    def __init__(self):
+        self._parserState = ParserState.BEGIN
+        self._firstChar = ' '
+        self._body = bytearray()
+
+    def feed(self, in_bytes):
+        packets = []
+        for b in in_bytes:
+            c = chr(b)
+            if self._parserState == ParserState.BEGIN or self._parserState == ParserState.FOUND_NEWLINE:
+                self._body.clear()
+                self._firstChar = c
+                self._parserState = ParserState.FOUND_FIRST
+            elif self._parserState == ParserState.FOUND_FIRST:
+                if b != 0x0D:
+                    self._body.append(b)
+                else:
+                    self._parserState = ParserState.FOUND_CARRIAGE
+            elif self._parserState == ParserState.FOUND_CARRIAGE:
+                if b != 0x0A:
+                    self._parserState = ParserState.BEGIN
+                else:
+                    self._parserState = ParserState.FOUND_NEWLINE
+                    packets.append((self._firstChar, self._body.decode("utf-8")))
+        return packets
+
+
+def recorded_stream(packets):
+    """Builds a byte stream resembling a busy board: scans, relay acknowledgements and info replies"""
+    lines = []
+    for n in range(packets):
+        kind = random.random()
+        if kind < 0.6:
+            lines.append(f"F{random.randint(1000000, 16777215)},{random.randint(1, 2)}")
+        elif kind < 0.7:
+            lines.append(f"P{random.randint(1000, 99999999)},{random.randint(1, 2)}")
+        elif kind < 0.95:
+            lines.append(f"{random.choice('CO')}{random.randint(1, 4)}")
+        else:
+            lines.append("Im:TCM-ACCX,v:0.03,s:2,r:4")
+    return "".join(f"{line}\r\n" for line in lines).encode("utf-8")
+
+
+def split_reads(stream, mean_read):
+    """Chops a stream into the uneven chunks a USB read would hand back"""
+    reads = []
+    offset = 0
+    while offset < len(stream):
+        size = max(1, int(random.expovariate(1.0 / mean_read)))
+        reads.append(stream[offset:offset + size])
+        offset += size
+    return reads
+
+
+def framer_throughput(parser_factory, reads, repeat):
+    best = None
+    packets = 0
+    for r in range(repeat):
+        parser = parser_factory()
+        start = perf_counter()
+        packets = 0
+        for chunk in reads:
+            packets += len(parser.feed(chunk))
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, packets
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Hardware layer benchmarks")
+    sub = parser.add_subparsers(dest='bench')
+    latency_parser = sub.add_parser('latency', help='scan-to-callback latency, polling vs blocking reads')
+    latency_parser.add_argument('--scans', type=int, default=200, help='number of scans to simulate')
+    latency_parser.add_argument('--spacing', type=float, default=0.05, help='mean seconds between scans')
+    relock_parser = sub.add_parser('relock', help='relay relock scheduling jitter')
+    relock_parser.add_argument('--boards', type=int, default=3)
+    relock_parser.add_argument('--unlocks', type=int, default=100)
+    relock_parser.add_argument('--duration', type=float, default=0.5, help='mean unlock duration in seconds')
+    framer_parser = sub.add_parser('framer', help='packet framing throughput, state machine vs PacketFramer')
+    framer_parser.add_argument('--capture', help='raw serial capture to replay instead of a generated stream')
+    framer_parser.add_argument('--packets', type=int, default=20000, help='packets in the generated stream')
+    framer_parser.add_argument('--read-size', type=int, default=24, help='mean bytes per USB read')
+    framer_parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.bench == 'latency':
+        for name, blocking in (("polling", False), ("blocking", True)):
+            print(f"{name:>9} scan-to-callback: {format_ms(scan_latency(blocking, args.scans, args.spacing))}")
+    elif args.bench == 'relock':
+        print(f"relock jitter: {format_ms(relock_jitter(args.boards, args.unlocks, args.duration))}")
+    elif args.bench == 'framer':
+        if args.capture:
+            with open(args.capture, 'rb') as capture:
+                stream = capture.read()
+        else:
+            stream = recorded_stream(args.packets)
+        reads = split_reads(stream, args.read_size)
+        print(f"{len(stream)} bytes in {len(reads)} reads")
+        for name, factory in (("state machine", LegacyParser), ("PacketFramer", PacketFramer)):
+            elapsed, packets = framer_throughput(factory, reads, args.repeat)
+            print(f"{name:>14}: {packets} packets in {elapsed * 1000.0:.1f}ms, "
+                  f"{len(stream) / elapsed / 1e6:.2f} MB/s, {elapsed / max(packets, 1) * 1e6:.2f}us/packet")
+    else:
+        parser.print_help()
@@ -0,0 +1,187 @@
+"""
+Benchmarks door event publishing against a local stand-in MQTT broker.
+
+The broker only speaks enough MQTT 3.1.1 for a publisher: CONNECT, PUBLISH (acknowledging QoS 1),
+PINGREQ and DISCONNECT. It counts the messages it receives so the publisher can be timed end to end.
+"""
+import argparse
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paho.mqtt.client as mqtt
+
+from mqtt_publisher import MqttPublisher
+
+
+class StandInBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), _BrokerConnection)
+        self.received = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.clients = set()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stand-in-broker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops listening and drops every client, as a broker going down would"""
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for client in self.clients:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class _BrokerConnection(socketserver.BaseRequestHandler):
+    def _read_exact(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data.extend(chunk)
+        return bytes(data)
+
+    def _read_packet(self):
+        header = self._read_exact(1)[0]
+        length, shift = 0, 0
+        while True:
+            b = self._read_exact(1)[0]
+            length |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return header, self._read_exact(length) if length else b""
+
+    def handle(self):
+        server: StandInBroker = self.server
+        with server.lock:
+            server.connections += 1
+            server.clients.add(self.request)
+        try:
+            while True:
+                header, body = self._read_packet()
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    self.request.sendall(b"\x20\x02\x00\x00")
+                elif kind == 3:  # PUBLISH
+                    with server.lock:
+                        server.received += 1
+                    qos = (header >> 1) & 0x03
+                    if qos:
+                        topic_length = int.from_bytes(body[0:2], "big")
+                        mid = body[2 + topic_length:4 + topic_length]
+                        self.request.sendall((b"\x40\x02" if qos == 1 else b"\x50\x02") + mid)
+                elif kind == 6:  # PUBREL
+                    self.request.sendall(b"\x70\x02" + body[0:2])
+                elif kind == 12:  # PINGREQ
+                    self.request.sendall(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with server.lock:
+                server.clients.discard(self.request)
+
+
+def wait_for(broker, count, timeout=30.0):
+    deadline = perf_counter() + timeout
+    while broker.received < count and perf_counter() < deadline:
+        sleep(0.001)
+    return broker.received >= count
+
+
+def legacy_publish(broker, events, payload):
+    """What notify_mqtt used to do for every event: connect, publish, disconnect"""
+    start = perf_counter()
+    for n in range(events):
+        client = mqtt.Client()
+        client.connect("127.0.0.1", broker.port)
+        client.publish("bench/activity", payload)
+        client.disconnect()
+    wait_for(broker, events)
+    return perf_counter() - start
+
+
+def persistent_publish(broker, events, payload, qos):
+    publisher = MqttPublisher("127.0.0.1", broker.port, "bench/activity", qos=qos, queue_size=events)
+    publisher._connected.wait(5.0)
+    start = perf_counter()
+    for n in range(events):
+        publisher.publish(payload)
+    wait_for(broker, events)
+    elapsed = perf_counter() - start
+    stats = publisher.stats()
+    publisher.shutdown()
+    return elapsed, stats
+
+
+def outage(events, payload, qos):
+    """Publishes while the broker is down, then brings it up and checks everything arrives"""
+    broker = StandInBroker().start()
+    port = broker.port
+    spool = os.path.join(tempfile.mkdtemp(prefix="tcdoor-bench-"), "mqtt-spool.jsonl")
+    publisher = MqttPublisher("127.0.0.1", port, "bench/activity", qos=qos, queue_size=events // 4,
+                              spool_file=spool, reconnect_max=1)
+    publisher._connected.wait(5.0)
+    broker.stop()
+    for n in range(events):
+        publisher.publish(payload)
+    during = publisher.stats()
+    broker = StandInBroker(port).start()
+    delivered = wait_for(broker, events)
+    after = publisher.stats()
+    publisher.shutdown()
+    broker.stop()
+    return during, after, delivered, broker.received
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MQTT publishing benchmarks against a stand-in broker")
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument('--outage', action='store_true', help='also check delivery across a broker restart')
+    args = parser.parse_args()
+    payload = '{"timestamp": "2020-04-13T22:00:00", "result": "granted", "facility": "frontdoor"}'
+
+    broker = StandInBroker().start()
+    legacy_events = min(args.events, 200)
+    legacy = legacy_publish(broker, legacy_events, payload)
+    print(f"connect per event: {legacy_events / legacy:8.0f} events/s ({legacy_events} events, "
+          f"{broker.connections} connections)")
+    broker.stop()
+
+    broker = StandInBroker().start()
+    elapsed, stats = persistent_publish(broker, args.events, payload, args.qos)
+    latency = stats["publish_latency"]
+    print(f"persistent qos {args.qos}: {args.events / elapsed:8.0f} events/s ({args.events} events, "
+          f"{broker.connections} connection, publish p50 {latency['p50'] * 1000:.1f}ms "
+          f"p99 {latency['p99'] * 1000:.1f}ms)")
+    broker.stop()
+
+    if args.outage:
+        during, after, delivered, received = outage(args.events, payload, args.qos)
+        print(f"outage: backlog {during['backlog']} ({during['spooled']} spooled) while down, "
+              f"{received}/{args.events} delivered after restart, {after['dropped']} dropped")
@@ -0,0 +1,103 @@
+"""Benchmarks for the authorization service hot path"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import write_config
+from auth_fanout import AuthFanout
+
+
+def linear_find_facility(config, board, scanner_index):
+    """find_facility as it was before Config.ScannerIndex, kept for comparison"""
+    target = None
+    for sb, si in config.getScanners().items():
+        if si.board == board and si.scannerIndex == scanner_index:
+            target = si
+            break
+    if target is not None:
+        for fn, fv in config.getFacilities().items():
+            if fv.scanner == target or fv.outscanner == target:
+                return fv, fv.scanner if fv.scanner == target else fv.outscanner
+    return None, None
+
+
+def facility_lookup(config, lookups):
+    keys = [(s.board, s.scannerIndex) for s in config.getScanners().values()]
+    probes = [random.choice(keys) for n in range(lookups)]
+    results = {}
+    for name, find in (("linear scan", lambda b, s: linear_find_facility(config, b, s)),
+                       ("ScannerIndex", config.findFacility)):
+        start = perf_counter()
+        for board, scanner in probes:
+            find(board, scanner)
+        results[name] = (perf_counter() - start) / lookups
+    return results
+
+
+class DelayedModule():
+    """Auth module that denies everything after a fixed delay, standing in for a slow backend"""
+
+    def __init__(self, name, delay):
+        self.__module__ = name
+        self.delay = delay
+
+    def on_scan(self, credential_type, credential_value, scanner, facility, now_time):
+        sleep(self.delay)
+        return (False, None, f"{self.__module__}:unknown_fob", None, None)
+
+
+def serial_decide(auth_modules, *args):
+    """on_scan's module loop as it was before AuthFanout, kept for comparison"""
+    for am in auth_modules:
+        result = am.on_scan(*args)
+        if result[0]:
+            return am
+    return None
+
+
+def auth_fanout(delays, deadline, scans):
+    auth_modules = [DelayedModule(f"module{n}", d) for n, d in enumerate(delays)]
+    fanout = AuthFanout(deadline=deadline)
+    results = {}
+    for name, decide in (("serial", lambda: serial_decide(auth_modules, "fob", "1", None, None, None)),
+                         ("fan-out", lambda: fanout.decide(auth_modules, "fob", "1", None, None, None))):
+        start = perf_counter()
+        for n in range(scans):
+            decide()
+        results[name] = (perf_counter() - start) / scans
+    fanout.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Authorization service benchmarks")
+    sub = parser.add_subparsers(dest='bench')
+    facility_parser = sub.add_parser('facility', help='scanner to facility lookup, linear scan vs index')
+    facility_parser.add_argument('--boards', type=int, default=100)
+    facility_parser.add_argument('--scanners', type=int, default=4, help='scanners per board')
+    facility_parser.add_argument('--lookups', type=int, default=20000)
+    fanout_parser = sub.add_parser('fanout', help='time to deny a scan, modules asked in turn vs all at once')
+    fanout_parser.add_argument('--delays', type=float, nargs='+', default=[0.002, 0.05, 0.2],
+                               help='seconds each module takes to answer, highest priority first')
+    fanout_parser.add_argument('--deadline', type=float, default=3.0)
+    fanout_parser.add_argument('--scans', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.bench == 'facility':
+        workdir = tempfile.mkdtemp(prefix="tcdoor-bench-")
+        write_config(workdir, args.boards, args.scanners)
+        os.chdir(workdir)
+        from configuration import Config
+        print(f"{len(Config.getScanners())} scanners, {len(Config.getFacilities())} facilities")
+        for name, per_lookup in facility_lookup(Config, args.lookups).items():
+            print(f"{name:>12}: {per_lookup * 1e6:.2f}us per lookup")
+    elif args.bench == 'fanout':
+        for name, per_scan in auth_fanout(args.delays, args.deadline, args.scans).items():
+            print(f"{name:>7}: {per_scan * 1000:.1f}ms per denied scan")
+    else:
+        parser.print_help()
@@ -0,0 +1,75 @@
+"""
+Compares WildApricot scan lookups through the ORM with lookups in the in-memory fob index, and
+measures what the index costs to build and hold for synthetic memberships.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_wildapricot import make_contacts
+from metrics import RollingPercentiles, format_ms
+
+
+def legacy_on_scan(auth, credential_value, now_time):
+    """on_scan's database lookup as it was before the fob index, kept for comparison"""
+    from auth.wildapricot import WildApricotDb
+
+    db = auth.ScopedSession()
+    try:
+        user = db.query(WildApricotDb).filter(WildApricotDb.code == f"f:{int(credential_value)}").all()
+        if len(user) == 0:
+            return (False, None, "wildapricot:unknown_fob", None, None)
+        return user[0].should_grant(now_time)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark WildApricot fob lookups")
+    parser.add_argument('--members', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--scans', type=int, default=2000)
+    args = parser.parse_args()
+
+    from auth.wildapricot import WildApricotAuth, load_member_index
+
+    workdir = tempfile.mkdtemp(prefix="tcdoor-bench-wa-index-")
+    for members in args.members:
+        auth = WildApricotAuth()
+        auth.read_configuration({"dbfile": os.path.join(workdir, f"{members}.db"), "api_key": "bench"})
+        auth.on_load()
+        contacts = make_contacts(members, seed=members)
+        auth.list_wa_accounts = lambda: iter(contacts)
+        auth.refresh_membership()
+
+        # tracemalloc slows the build down, it's timed in a separate untraced one
+        db = auth.ScopedSession()
+        index = load_member_index(db)
+        tracemalloc.start()
+        traced = load_member_index(db)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        db.close()
+        print(f"{members} members: index of {len(index.members)} fobs built in {index.build_seconds * 1000:.0f}ms, "
+              f"{size / 2 ** 20:.1f}MB ({size / len(index.members):.0f} bytes a member)")
+
+        fobs = [int(c["fob"][2:]) for c in contacts] + [1] * (args.scans // 10)  # some unknown fobs too
+        now = datetime.now()
+        for label, scan in (("ORM query", lambda fob: legacy_on_scan(auth, fob, now)),
+                            ("fob index", lambda fob: auth.on_scan("fob", fob, None, None, now))):
+            latency = RollingPercentiles(window=args.scans)
+            rng = random.Random(members)
+            for n in range(args.scans):
+                fob = rng.choice(fobs)
+                start = perf_counter()
+                scan(fob)
+                latency.add(perf_counter() - start)
+            print(f"  {label:>9}: {format_ms(latency.snapshot())}")
+        auth.on_close()
+        auth.ScopedSession.remove()
@@ -0,0 +1,118 @@
+"""
+Breaks down the latency of an on-demand WildApricot lookup, the call made while someone waits at
+the door, with and without the token cache and keep-alive session.
+
+A local stub serves the token and single-contact endpoints. Every new connection is held back by
+--handshake to stand in for TCP and TLS setup, and every request by --rtt.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_wa_stream import synthetic_contact
+from metrics import RollingPercentiles, format_ms
+
+
+def stub_server(handshake, rtt):
+    counts = {"connections": 0, "tokens": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            # headers and body go out in separate writes, don't let Nagle hold the body back
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            counts["connections"] += 1
+            sleep(handshake)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            counts["tokens"] += 1
+            self.reply({"access_token": "stub", "expires_in": 1800})
+
+        def do_GET(self):
+            self.reply({"Contacts": [synthetic_contact(1)]})
+
+        def reply(self, document):
+            sleep(rtt)
+            data = json.dumps(document).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, counts
+
+
+def legacy_lookup(auth, account, fob, timings):
+    """get_access_token and get_single_contact as they were before the token cache and session"""
+    import requests
+
+    started = perf_counter()
+    response = requests.post(auth.TokenUrl, data={'grant_type': 'client_credentials', 'scope': 'auto'},
+                             headers=auth.RequestHeaders)
+    response.raise_for_status()
+    token = response.json()['access_token']
+    timings['token'] = perf_counter() - started
+    started = perf_counter()
+    response = requests.get(auth.ContactsUrl, headers={'Accept': 'application/json',
+                                                       'Authorization': f'Bearer {token}'},
+                            params={'$async': 'false', '$filter': f"'Key Fob' eq '{fob}' and 'User Id' eq '{account}'"})
+    response.raise_for_status()
+    timings['request'] = perf_counter() - started
+    started = perf_counter()
+    contacts = response.json()['Contacts']
+    timings['decode'] = perf_counter() - started
+    return auth.wa_to_contact(contacts[0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Break down on-demand WildApricot lookup latency")
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--handshake', type=float, default=0.060, help='seconds to set up a connection')
+    parser.add_argument('--rtt', type=float, default=0.040, help='seconds per request')
+    args = parser.parse_args()
+
+    from auth.wildapricot import WildApricotAuth
+
+    server, counts = stub_server(args.handshake, args.rtt)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    auth = WildApricotAuth()
+    auth.TokenUrl = f"{base}/auth/token/"
+    auth.ContactsUrl = f"{base}/contacts"
+    auth.read_configuration({"dbfile": ":memory:", "api_key": "bench"})
+
+    print(f"{args.lookups} lookups, {args.handshake * 1000:.0f}ms per new connection, {args.rtt * 1000:.0f}ms per request")
+    for label in ("per-call connections, no token cache", "token cache and keep-alive session"):
+        connections, tokens = counts["connections"], counts["tokens"]
+        stages = {stage: RollingPercentiles() for stage in ("token", "request", "decode", "total")}
+        for n in range(args.lookups):
+            timings = {}
+            started = perf_counter()
+            if label.startswith("per-call"):
+                legacy_lookup(auth, 100001, 3000001, timings)
+            else:
+                auth.get_single_contact(100001, 3000001, timings)
+            timings['total'] = perf_counter() - started
+            for stage, seconds in timings.items():
+                stages[stage].add(seconds)
+        print(f"{label}: {counts['connections'] - connections} connections, {counts['tokens'] - tokens} tokens")
+        for stage, p in stages.items():
+            print(f"  {stage:>8}: {format_ms(p.snapshot())}")
+    auth.on_close()
+    server.shutdown()
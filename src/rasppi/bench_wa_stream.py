@@ -0,0 +1,121 @@
+"""
+Measures peak memory of reading the WildApricot contacts response, streamed or parsed whole.
+
+A local stub stands in for the WildApricot token and contacts endpoints and serves a synthetic
+membership of each size. The stub runs in its own process and every run in a fresh one, so a
+run's peak RSS is its own: "list" only decodes the contacts, "sync" runs a full refresh into an
+empty plugin database.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_contact(n):
+    """A contact shaped like the API's, with the profile fields a real account carries"""
+    fields = {"Key Fob": str(3000000 + n), "Key Fob is": "Active", "Renewal due": "2030-01-01T00:00:00",
+              "is_banned": False, "Last login date": "2024-05-01T12:00:00", "First name": f"Member{n}",
+              "Last name": "Example", "e-Mail": f"member{n}@example.org", "Phone": "612-555-0100",
+              "Organization": "", "Member since": "2019-03-04T00:00:00", "Notes": "x" * 200}
+    return {"Id": 100000 + n, "Url": f"https://api.wildapricot.org/v2.2/accounts/409807/contacts/{100000 + n}",
+            "FirstName": f"Member{n}", "LastName": "Example", "Email": f"member{n}@example.org",
+            "DisplayName": f"Example, Member{n}", "Status": "Active", "MembershipEnabled": True,
+            "MembershipLevel": {"Id": 1200000 + n % 5, "Name": "Regular"},
+            "FieldValues": [{"FieldName": k, "Value": v, "SystemCode": f"custom-{i}"}
+                            for i, (k, v) in enumerate(fields.items())]}
+
+
+def stub_server(members, ready):
+    body = json.dumps({"ResultType": "Contacts",
+                       "Contacts": [synthetic_contact(n) for n in range(members)]}).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.reply(json.dumps({"access_token": "stub"}).encode("utf-8"))
+
+        def do_GET(self):
+            self.reply(body)
+
+        def reply(self, data):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            for n in range(0, len(data), 256 * 1024):
+                self.wfile.write(data[n:n + 256 * 1024])
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    ready.put((server.server_address[1], len(body)))
+    server.serve_forever()
+
+
+def whole_query_contacts(auth, contact_filter, select):
+    """query_contacts as it was before streaming, kept for comparison"""
+    import requests
+
+    response = requests.get(auth.ContactsUrl, headers={'Authorization': f'Bearer {auth.get_access_token()}'},
+                            params={'$async': 'false', '$filter': contact_filter, '$select': select})
+    response.raise_for_status()
+    return response.json()['Contacts']
+
+
+def run(base, workdir, mode, streamed, results):
+    from auth.wildapricot import WildApricotAuth
+
+    auth = WildApricotAuth()
+    auth.TokenUrl = f"{base}/auth/token/"
+    auth.ContactsUrl = f"{base}/contacts"
+    auth.read_configuration({"dbfile": os.path.join(workdir, f"{mode}-{streamed}-{os.getpid()}.db"),
+                             "api_key": "bench"})
+    auth.on_load()
+    if not streamed:
+        auth.query_contacts = lambda f, s: whole_query_contacts(auth, f, s)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    if mode == "list":
+        count = sum(1 for contact in auth.list_wa_accounts())
+    else:
+        auth.refresh_membership()
+        count = auth.ScopedSession().execute("SELECT COUNT(*) FROM members").scalar()
+    elapsed = perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((count, elapsed, peak, peak - before))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark memory use of reading the WildApricot contacts")
+    parser.add_argument('--members', type=int, nargs='+', default=[5000, 20000, 50000])
+    args = parser.parse_args()
+
+    context = mp.get_context("spawn")
+    workdir = tempfile.mkdtemp(prefix="tcdoor-bench-wa-stream-")
+    print(f"{'members':>8} {'response':>9} {'mode':>5} {'parsing':>8} {'time':>8} {'peak RSS':>9} {'growth':>8}")
+    for members in args.members:
+        ready = context.Queue()
+        server = context.Process(target=stub_server, args=(members, ready), daemon=True)
+        server.start()
+        port, size = ready.get()
+        base = f"http://127.0.0.1:{port}"
+        for mode in ("list", "sync"):
+            for streamed in (False, True):
+                results = context.Queue()
+                process = context.Process(target=run, args=(base, workdir, mode, streamed, results))
+                process.start()
+                count, elapsed, peak, growth = results.get()
+                process.join()
+                print(f"{count:>8} {size / 2 ** 20:>7.1f}MB {mode:>5} {'stream' if streamed else 'whole':>8} "
+                      f"{elapsed:>7.2f}s {peak / 1024:>7.1f}MB {growth / 1024:>6.1f}MB")
+        server.terminate()
+        server.join()
@@ -0,0 +1,115 @@
+"""
+Load tests the webpanel's calls into the authorization service with concurrent HTTP clients.
+
+Starts an AuthorizationService in its own process on simulated boards, the way app.py does, serves
+the webpanel from a threaded server in this process and has --clients threads request
+/testfob and /diagnostics as fast as they can. Every fob test names a seeded member, so a page
+showing anyone else's member id means a reply went to the wrong request.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import seed_members, write_config
+from metrics import RollingPercentiles, format_ms
+
+
+def client(base, deadline, fobs, diagnostics_share, latency, outcomes, outcomesLock):
+    import requests
+    from requests.auth import HTTPDigestAuth
+
+    session = requests.Session()
+    session.auth = HTTPDigestAuth("loadtest", "loadtest")
+    while time() < deadline:
+        start = perf_counter()
+        try:
+            if random.random() < diagnostics_share:
+                kind = "diagnostics"
+                response = session.get(f"{base}/diagnostics", timeout=30)
+                ok = response.status_code == 200 and "Relock scheduling jitter" in response.text
+            else:
+                kind = "testfob"
+                member, fob = random.choice(fobs)
+                response = session.get(f"{base}/testfob", params={"fobnumber": fob}, timeout=30)
+                ok = response.status_code == 200 and f"contactId={member}\"" in response.text
+                if response.status_code == 200 and not ok and "contactId=" in response.text:
+                    kind = "testfob wrong member"
+        except Exception:
+            kind, ok = "error", False
+        latency[kind].add(perf_counter() - start)
+        with outcomesLock:
+            outcomes[(kind, ok)] += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test webpanel to service calls")
+    parser.add_argument('--clients', type=int, default=32, help='concurrent HTTP clients')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--diagnostics', type=float, default=0.3, help='share of requests for /diagnostics')
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--port', type=int, default=8543)
+    parser.add_argument('--workdir', help='directory for the generated config and databases')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tcdoor-bench-webpanel-")
+    os.makedirs(workdir, exist_ok=True)
+    write_config(workdir, 2, 2)
+    os.chdir(workdir)
+    fobs = [(str(50000 + n), fob) for n, fob in enumerate(seed_members("loadtest-wildapricot.db", args.members))]
+    print(f"Working in {workdir}")
+
+    # configuration reads door_config.yaml from the working directory when it is imported
+    from authorization_service import AuthorizationService
+    from rpc import RpcClient
+    from webpanel import webpanel
+    from werkzeug.serving import make_server
+
+    context = mp.get_context("fork")
+    sq = context.Queue()
+    wq = context.Queue()
+    service = context.Process(target=AuthorizationService, args=(sq, wq))
+    service.start()
+    rpc = RpcClient(sq, wq)
+    rpc.call("status", timeout=60)  # boards are up once the service answers
+    webpanel.config['rpc'] = rpc
+
+    server = make_server("127.0.0.1", args.port, webpanel, threaded=True)
+    Thread(target=server.serve_forever, name="webpanel", daemon=True).start()
+    sleep(0.2)
+
+    latency = {k: RollingPercentiles(window=1000000) for k in ("diagnostics", "testfob", "testfob wrong member",
+                                                                 "error")}
+    outcomes = Counter()
+    outcomesLock = Lock()
+    deadline = time() + args.duration
+    clients = [Thread(target=client, args=(f"http://127.0.0.1:{args.port}", deadline, fobs, args.diagnostics,
+                                           latency, outcomes, outcomesLock)) for n in range(args.clients)]
+    started = time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time() - started
+
+    stats = rpc.stats()
+    rpc.call("shutdown", timeout=30)
+    server.shutdown()
+    service.join(10)
+
+    total = sum(outcomes.values())
+    print(f"{args.clients} clients, {total} requests in {elapsed:.1f}s ({total / elapsed:.1f}/s)")
+    for (kind, ok), n in sorted(outcomes.items()):
+        print(f"  {kind:>20} {'ok' if ok else 'FAILED':>6}: {n}")
+    for kind, p in latency.items():
+        if p.snapshot()["count"]:
+            print(f"{kind:>22}: {format_ms(p.snapshot())}")
+    print(f"service calls: {stats['calls']}, {stats['timeouts']} timed out, {stats['late']} late replies, "
+          f"{format_ms(stats['latency'])}")
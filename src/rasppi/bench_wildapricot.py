@@ -0,0 +1,105 @@
+"""
+Benchmarks the WildApricot full sync against synthetic memberships, no API access needed.
+
+Each run happens in a fresh process so peak RSS belongs to that run alone. For every membership
+size the database is first loaded from empty, then resynced with a few percent of contacts
+changed, removed and added, once with the set-based full_sync and once with the per-object
+ORM sync it replaced.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import random
+import resource
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_contacts(members, seed, churn=0.0):
+    """Contacts for members people, with churn of them changed, removed and replaced by newcomers"""
+    rng = random.Random(seed)
+    renewal = datetime(2030, 1, 1)
+    contacts = [{"person": str(100000 + n), "fob": f"f:{3000000 + n}", "enabled": True, "status": "Active",
+                 "renewal_due": renewal, "banned": False, "last_login": renewal - timedelta(days=n % 400),
+                 "membership_level": 1200000 + n % 5} for n in range(members)]
+    if churn:
+        count = int(members * churn)
+        for c in rng.sample(contacts, count):
+            c["status"] = "Lapsed"
+        for c in rng.sample(contacts, count):
+            contacts.remove(c)
+        contacts += [dict(contacts[0], person=str(900000 + n), fob=f"f:{9000000 + n}") for n in range(count)]
+    return contacts
+
+
+def legacy_full_sync(auth, db):
+    """full_sync as it was before the staging table, kept for comparison"""
+    from auth.wildapricot import WildApricotDb
+
+    num_deleted = num_modified = num_added = num_contacts = 0
+    members = {(m.person, m.code): m for m in db.query(WildApricotDb).order_by(WildApricotDb.person).all()}
+    for contact in auth.list_wa_accounts():
+        num_contacts += 1
+        idpair = (contact['person'], contact['fob'])
+        if idpair in members:
+            if auth.update_member(members.pop(idpair), contact):
+                num_modified += 1
+        else:
+            db.add(WildApricotDb.from_json(contact))
+            num_added += 1
+    for m in members.values():
+        db.delete(m)
+        num_deleted += 1
+    return num_contacts, num_added, num_modified, num_deleted
+
+
+def run(dbfile, members, churn, legacy, results):
+    from auth.wildapricot import WildApricotAuth
+
+    auth = WildApricotAuth()
+    auth.read_configuration({"dbfile": dbfile, "api_key": "bench", "full_refresh": 0})
+    auth.on_load()
+    contacts = make_contacts(members, seed=members, churn=churn)
+    auth.list_wa_accounts = lambda: iter(contacts)
+    if legacy:
+        auth.full_sync = lambda db: legacy_full_sync(auth, db)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    auth.refresh_membership()
+    elapsed = perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    db = auth.ScopedSession()
+    state = db.execute("SELECT last_added, last_modified, last_deleted FROM sync_state").fetchone()
+    db.close()
+    results.put((elapsed, peak, peak - before, tuple(state)))
+
+
+def measure(context, dbfile, members, churn, legacy):
+    results = context.Queue()
+    process = context.Process(target=run, args=(dbfile, members, churn, legacy, results))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the WildApricot membership sync")
+    parser.add_argument('--members', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--churn', type=float, default=0.02, help='share of members changed, removed and added')
+    args = parser.parse_args()
+
+    context = mp.get_context("spawn")
+    workdir = tempfile.mkdtemp(prefix="tcdoor-bench-wa-")
+    print(f"{'members':>8} {'sync':>10} {'run':>8} {'time':>9} {'peak RSS':>10} {'growth':>9}  added/modified/deleted")
+    for members in args.members:
+        for legacy in (True, False):
+            dbfile = os.path.join(workdir, f"{'legacy' if legacy else 'staged'}-{members}.db")
+            for label, churn in (("initial", 0.0), ("resync", args.churn)):
+                elapsed, peak, growth, counts = measure(context, dbfile, members, churn, legacy)
+                print(f"{members:>8} {'ORM' if legacy else 'set-based':>10} {label:>8} {elapsed:>8.2f}s "
+                      f"{peak / 1024:>8.1f}MB {growth / 1024:>7.1f}MB  {'/'.join(str(c) for c in counts)}")
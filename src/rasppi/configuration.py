@@ -8,10 +8,12 @@ import logging.handlers
 
 import os
 import plugins
+from types import MappingProxyType
 
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy import create_engine
-from models import DoorControllerBase
+from models import create_activity_engine, migrate_activity_db
+from log_pipeline import Pipeline
 
 from yaml import load, safe_load
 from yaml.loader import  SafeLoader
@@ -35,11 +37,15 @@ class Facility():  # controls a single relay
     def __repr__(self):
         return f"<Facility: {self.name}@:{self.board}.{self.relay}>"
 
+# Identical scans on one scanner closer together than this are treated as one
+DEFAULT_DEBOUNCE_MS = 1500
+
 class Scanner():  # represents a scanner on a board
-    def __init__(self, name, board, scannerIndex):
+    def __init__(self, name, board, scannerIndex, debounce=DEFAULT_DEBOUNCE_MS / 1000.0):
         self.name = name
         self.board = board
         self.scannerIndex = scannerIndex
+        self.debounce = debounce
 
 class ConfigurationException(Exception):
     pass
@@ -99,6 +105,18 @@ class Configuration():
                                            "mqtt_broker": {"type": "string"},
                                            "mqtt_topic": {"type": "string"},
                                            "mqtt_port": {"type": "integer"},
+                                           "mqtt_qos": {"type": "integer", "minimum": 0, "maximum": 2},
+                                           "mqtt_queue_size": {"type": "integer", "minimum": 1},
+                                           "mqtt_spool": {"type": "string"},
+                                           "decision_workers": {"type": "integer", "minimum": 1},
+                                           "decision_queue_depth": {"type": "integer", "minimum": 1},
+                                           "auth_workers": {"type": "integer", "minimum": 1},
+                                           "auth_deadline_ms": {"type": "integer", "minimum": 1},
+                                           "negative_cache_size": {"type": "integer", "minimum": 1},
+                                           "negative_cache_ttl": {"type": "integer", "minimum": 0},
+                                           "scan_capture": {"type": "string"},
+                                           "activity_commit_ms": {"type": "integer", "minimum": 1},
+                                           "activity_batch_size": {"type": "integer", "minimum": 1},
                                            "__line__" : { },
                                        },
                                        "required" : ['activitydb','logfile']},
@@ -121,7 +139,8 @@ class Configuration():
                                                                          "properties" : {
                                                                              "__line__": {},
                                                                              "board" : {"type" : "string"},
-                                                                             "scanner": {"type": "integer"}
+                                                                             "scanner": {"type": "integer"},
+                                                                             "debounce_ms": {"type": "integer", "minimum": 0},
                                                                              },
                                                                             "required" : ['board',"scanner",],
                                                                             "additionalProperties": False,
@@ -156,6 +175,7 @@ class Configuration():
 
 
     FileName = os.path.abspath('door_config.yaml')
+    SmtpHandler = None  # email alerts, swapped out on reload
 
 
     def Reload(self,stringInput = None):
@@ -178,6 +198,20 @@ class Configuration():
 
             self.LogFile = config['system']['logfile']
             self.ActivityDb = config['system']['activitydb']
+            # Scans are decided by a pool of workers, each door is handled by one of them
+            self.DecisionWorkers = config['system'].get('decision_workers', 4)
+            self.DecisionQueueDepth = config['system'].get('decision_queue_depth', 16)
+            # Every auth module is asked about a scan at once, the ones that haven't answered by the deadline are skipped
+            self.AuthWorkers = config['system'].get('auth_workers', 8)
+            self.AuthDeadline = config['system'].get('auth_deadline_ms', 3000) / 1000.0
+            # Credentials no auth module knows are denied from a cache until it expires or a module refreshes
+            self.NegativeCacheSize = config['system'].get('negative_cache_size', 4096)
+            self.NegativeCacheTtl = config['system'].get('negative_cache_ttl', 60)
+            # Every scan packet is appended here when set, replay.py can play the file back
+            self.ScanCapture = config['system'].get('scan_capture')
+            # Activity is committed in groups, at most this often or every batch size rows
+            self.ActivityCommitInterval = config['system'].get('activity_commit_ms', 20) / 1000.0
+            self.ActivityBatchSize = config['system'].get('activity_batch_size', 50)
             #attempt to write to that file
             #try:
             #    with open(self.LogFile, 'r+') as writer:
@@ -207,7 +241,8 @@ class Configuration():
                         continue
                     #TODO: should we disallow numbered scanners
                     dev = sv['board']
-                    s = Scanner(name=sn,board=dev,scannerIndex=sv['scanner'])
+                    s = Scanner(name=sn,board=dev,scannerIndex=sv['scanner'],
+                                debounce=sv.get('debounce_ms', DEFAULT_DEBOUNCE_MS) / 1000.0)
                     self.Scanners[sn] = s
                     if dev not in self.Devices:
                         self.Devices.append(dev)
@@ -256,13 +291,22 @@ class Configuration():
 
 
 
+            # (board, scanner index) -> (facility, scanner), looked up on every scan. Built whole and
+            # swapped in with a single assignment so readers never see a half built table.
+            scannerIndex: Dict[Tuple[str, int], Tuple[Facility, Scanner]] = {}
+            for f in self.Facilities.values():
+                for sc in (f.scanner, f.outscanner):
+                    if sc is not None:
+                        scannerIndex[(sc.board, sc.scannerIndex)] = (f, sc)
+            self.ScannerIndex = MappingProxyType(scannerIndex)
+
             self.RawConfig = config
 
-            engine = create_engine(f"sqlite:///{self.ActivityDb}")
+            engine = create_activity_engine(self.ActivityDb)
             Session = sessionmaker(bind=engine)
             # session = Session()
             self.ScopedSession = scoped_session(Session)
-            DoorControllerBase.metadata.create_all(engine)
+            migrate_activity_db(engine)
 
         except Exception as e:
             raise ConfigurationException(e)
@@ -271,6 +315,8 @@ class Configuration():
 
         #TODO: bring back force=true for a 3.7 version install
         logging.basicConfig(filename=self.LogFile, level=logging.INFO, format=FORMAT)
+        # handlers run on the log pipeline's listener thread, logging never waits on a file, SMTP or Datadog
+        Pipeline.install(logging.root)
         try:
             if "email_alerts" in config["system"]:
                 self.HasEmail = True
@@ -289,7 +335,10 @@ class Configuration():
                                         logging.WARNING
                 smtp_handler.setLevel(email_level)
                 smtp_handler.setFormatter(logging.Formatter(FORMAT))
-                logging.root.addHandler(smtp_handler)
+                if self.SmtpHandler is not None:
+                    Pipeline.detach(logging.root, self.SmtpHandler)
+                Pipeline.attach(logging.root, smtp_handler)
+                self.SmtpHandler = smtp_handler
         except:
             pass
 
@@ -298,6 +347,9 @@ class Configuration():
             self.mqtt_broker = config['system']['mqtt_broker'] if 'mqtt_broker' in config['system'] else None
             self.mqtt_topic = config['system']['mqtt_topic'] if 'mqtt_topic' in config['system'] else None
             self.mqtt_port = config['system']['mqtt_port'] if 'mqtt_port' in config['system'] else None
+            self.mqtt_qos = config['system'].get('mqtt_qos', 0)
+            self.mqtt_queue_size = config['system'].get('mqtt_queue_size', 1000)
+            self.mqtt_spool = config['system'].get('mqtt_spool', 'mqtt-spool.jsonl')
             logging.debug(f"MQTT setup to {self.mqtt_topic} via {self.mqtt_broker}:{self.mqtt_port}")
         except:
             pass
@@ -314,6 +366,10 @@ class Configuration():
     def getDevices(self):
         return self.Devices
 
+    def findFacility(self, board, scanner_index) -> Tuple[Facility, Scanner]:
+        """:return: (facility, scanner) for a scanner on a board, (None, None) if no facility uses it"""
+        return self.ScannerIndex.get((board, scanner_index), (None, None))
+
 Config = Configuration()
 
 #logging.basicConfig(level=logging.DEBUG)
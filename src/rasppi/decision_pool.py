@@ -0,0 +1,99 @@
+import logging
+import zlib
+from queue import Queue, Full
+from threading import Event, Thread
+from time import time
+
+logger = logging.getLogger("auth")
+
+
+class DecisionPool():
+    """
+    Runs scan decisions off the boards' serial reader threads.
+
+    Every key (a facility) is pinned to one worker, so scans at the same door are decided in the
+    order they arrived while other doors are served in parallel. Each worker has a bounded queue,
+    when it is full the scan is refused rather than stalling the reader.
+    """
+
+    def __init__(self, workers=4, queue_depth=16):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.shed = 0
+        self._stopping = False
+        self._queues = [Queue(maxsize=queue_depth) for w in range(workers)]
+        self._threads = [Thread(target=self._work, args=(q,), name=f"decision-{n}", daemon=True)
+                         for n, q in enumerate(self._queues)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: str, fn, *args) -> bool:
+        """:return: False if the worker for key is backed up and the call was dropped"""
+        q = self._queues[zlib.crc32(key.encode("utf-8")) % self.workers]
+        try:
+            q.put_nowait((fn, args))
+            return True
+        except Full:
+            self.shed += 1
+            return False
+
+    def _work(self, q: Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                logger.error("Scan decision failed", exc_info=True)
+            # a full queue had no room for the stop marker
+            if self._stopping and q.empty():
+                break
+
+    def shutdown(self, wait=True):
+        """
+        Lets the queued decisions finish, then stops the workers. Never blocks on a full queue, and
+        only waits for the workers when wait is set.
+        """
+        self._stopping = True
+        for q in self._queues:
+            try:
+                q.put_nowait(None)
+            except Full:
+                pass  # the worker stops once it has drained the queue
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def drain(self, timeout=None) -> bool:
+        """
+        Waits for every decision submitted so far to finish. Queues a marker behind each worker's
+        backlog, so it can block on a full queue and isn't for the service loop.
+
+        :return: False if the workers didn't get through their backlogs within timeout
+        """
+        deadline = None if timeout is None else time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time())
+
+        if self._stopping:  # the workers finish their queues and exit
+            for t in self._threads:
+                t.join(remaining())
+            return not any(t.is_alive() for t in self._threads)
+        reached = []
+        for q in self._queues:
+            marker = Event()
+            try:
+                q.put((marker.set, ()), timeout=remaining())
+            except Full:
+                return False
+            reached.append(marker)
+        return all(marker.wait(remaining()) for marker in reached)
+
+    def stats(self):
+        return {"workers": self.workers,
+                "queue_depth": self.queue_depth,
+                "queued": [q.qsize() for q in self._queues],
+                "shed": self.shed}
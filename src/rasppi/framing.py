@@ -0,0 +1,58 @@
+import logging
+
+logger = logging.getLogger("Hardware")
+
+# The firmware never sends a line anywhere near this long, anything bigger is line noise
+MAX_FRAME_SIZE = 256
+
+
+class PacketFramer():
+    """
+    Splits the board's serial stream into packets.
+
+    Packets are a single command character, an optional body, then "\\r\\n". Partial packets are
+    kept until the rest arrives. A carriage return that isn't followed by a newline is a framing
+    error, the partial packet is dropped and parsing resumes at the next byte.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.framing_errors = 0
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the board
+        :return: list of (first_char, body) for every complete packet
+        """
+        buf = self._buffer
+        buf.extend(data)
+        packets = []
+        start = 0
+        end = len(buf)
+        view = memoryview(buf)
+        try:
+            while True:
+                cr = buf.find(b'\r', start)
+                if cr == -1 or cr + 1 == end:
+                    break
+                if buf[cr + 1] != 0x0A:  # \r without \n
+                    self.framing_errors += 1
+                    logger.debug(f"Framing error, dropped {bytes(view[start:cr + 1])}")
+                    start = cr + 1
+                    continue
+                if cr > start:
+                    packets.append((chr(buf[start]), str(view[start + 1:cr], "utf-8", "replace")))
+                start = cr + 2
+        finally:
+            view.release()
+
+        if start:
+            del buf[:start]
+        if len(buf) > MAX_FRAME_SIZE:
+            self.framing_errors += 1
+            logger.debug(f"Framing error, discarding {len(buf)} bytes without a packet end")
+            buf.clear()
+        return packets
+
+    def reset(self):
+        self._buffer.clear()
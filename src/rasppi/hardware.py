@@ -1,42 +1,87 @@
-from enum import Enum
 import logging
-from typing import Dict, List, Tuple
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from typing import Deque, Dict, Iterable, Set, Tuple
 
 import pyftdi
 from pyftdi.usbtools import UsbDeviceDescriptor
-from threading import Thread, Lock, Event, get_ident
-from time import sleep, time
+from threading import Thread, Lock, RLock, Event, BoundedSemaphore
+from time import monotonic, sleep, time
 from pyftdi.ftdi import Ftdi
+from framing import PacketFramer
+from metrics import Histogram, SIZE_BUCKETS
+from relay_scheduler import Scheduler
+from simulator import SimulatedFtdi, is_simulated
 
 logger = logging.getLogger("Hardware")
 #logger.setLevel(logging.DEBUG)
 from datadog_logger import get_datadog_logger
-dd_logger = get_datadog_logger("hardware", "hardware")
+from log_pipeline import Pipeline
+dd_logger = Pipeline.install(get_datadog_logger("hardware", "hardware"))
+
+
+# Blocking read tuning. The FTDI chip flushes its buffer to the host when the latency timer
+# expires, so a short latency timer lets a blocking read return almost as soon as a packet
+# arrives instead of waiting for the next polling tick.
+READ_LATENCY_MS = 4
+READ_TIMEOUT_MS = 100
+READ_CHUNK_SIZE = 4096
+
+# Each command gets its own deadline, several may be outstanding on a board at once
+COMMAND_TIMEOUT = 3.0
+MAX_COMMANDS_IN_FLIGHT = 8
+# How long a board has after its reset to print the firmware banner
+STARTUP_TIMEOUT = 3.0
+
+# Device discovery, probing a board resets it and waits for its banner so results are cached
+DISCOVERY_TIMEOUT = 8.0
+DISCOVERY_CACHE_TTL = 300
+_discoveryPool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="discovery")
+_discoveryLock = RLock()
+_discoveryCache: Dict[str, Tuple[float, str]] = {}  # serial number -> (probe time, description)
+_probesInFlight: Dict[str, Future] = {}
+
+# Urls a ReaderBoard has open, so a discovery probe and a reconnect never open the same device at once
+_openLock = Lock()
+_openUrls: Set[str] = set()
+
+
+def _claim_url(url) -> bool:
+    with _openLock:
+        if url in _openUrls:
+            return False
+        _openUrls.add(url)
+        return True
+
+
+def _release_url(url):
+    with _openLock:
+        _openUrls.discard(url)
+
+# Legacy polling mode
+POLL_INTERVAL = 0.1
+POLL_READ_SIZE = 50
 
 
 def list_devices():
     Ftdi.show_devices()
 
-class LockTimeout():
-    timeout: float
-    credential: str
+class CommandTimeout(Exception):
+    pass
 
-    def __init__(self, timeout: float, credential: str):
-        self.timeout = timeout
-        self.credential = credential
 
-class ParserState(Enum):
-    BEGIN = 1
-    FOUND_FIRST = 2
-    FOUND_CARRIAGE = 3
-    FOUND_NEWLINE = 4
+class PendingCommand():
+    """A command written to the board that is waiting on its upper case reply"""
+    def __init__(self, command: str, data: str, deadline: float):
+        self.command = command
+        self.data = data
+        self.sent = time()
+        self.deadline = deadline
+        self.future = Future()
 
 
-def query_devices(ignored_devices):
-    if ignored_devices is not None and not hasattr(ignored_devices, '__iter__'):
-        raise ValueError("Invalid ignored devices variable")
-
-    ignored_ids = list(map(lambda d: d.device_id, ignored_devices))
+def list_device_urls():
+    """:return: list of (pyftdi url, serial number) for every attached FTDI device"""
     def map_url(dev):
         usb: UsbDeviceDescriptor = dev[0]
         vid = usb.vid
@@ -46,96 +91,167 @@ def query_devices(ignored_devices):
         if pid == 0x6001:
             pid = "232"
         interface = dev[1]
-        return f"ftdi://{vid}:{pid}:{usb.sn}/{interface}"
+        return f"ftdi://{vid}:{pid}:{usb.sn}/{interface}", usb.sn
 
-    all_devices = list(map(map_url, Ftdi.list_devices()))
+    return list(map(map_url, Ftdi.list_devices()))
 
-    def not_ignored(dev):
-        return dev not in ignored_ids
 
-    if ignored_devices is None:
-        to_query = all_devices
-    else:
-        to_query = list(filter(not_ignored, all_devices))
+def probe_device(url):
+    qb = ReaderBoard(deviceid=url)
+    description = qb.__repr__()
+    qb.shutdown()
+    return description
 
-    discovered_boards = []
-    for t in to_query:
-        try:
-            qb = ReaderBoard(deviceid=t)
-            discovered_boards.append(qb.__repr__())
-            qb.shutdown()
-        except:
-            pass
-    return discovered_boards
 
+def iter_query_devices(ignored_devices, timeout=DISCOVERY_TIMEOUT, ignored_urls: Iterable[str] = ()):
+    """
+    Probes every attached board that isn't in ignored_devices or ignored_urls, all at once, and
+    yields each board's description as soon as its probe finishes. Boards probed within the last
+    DISCOVERY_CACHE_TTL seconds are answered from the cache. Probes still running when the timeout
+    passes are left to finish in the background and will land in the cache for the next query.
+    """
+    if ignored_devices is not None and not hasattr(ignored_devices, '__iter__'):
+        raise ValueError("Invalid ignored devices variable")
 
-class ReaderBoard:
-    _unlockTimeouts: Dict[int, List[LockTimeout]]
+    ignored_ids = [] if ignored_devices is None else list(map(lambda d: d.device_id, ignored_devices))
+    ignored_ids += list(ignored_urls)
+    to_query = [(url, sn) for (url, sn) in list_device_urls() if url not in ignored_ids]
+
+    now = time()
+    cached_results = []
+    probes = {}
+    with _discoveryLock:
+        for url, sn in to_query:
+            cached = _discoveryCache.get(sn)
+            if cached is not None and now - cached[0] < DISCOVERY_CACHE_TTL:
+                cached_results.append(cached[1])
+                continue
+            probe = _probesInFlight.get(sn)
+            if probe is None:
+                probe = _discoveryPool.submit(probe_device, url)
+                _probesInFlight[sn] = probe
+                probe.add_done_callback(lambda f, sn=sn: _probe_finished(sn, f))
+            probes[probe] = url
+
+    yield from cached_results
+    try:
+        for probe in as_completed(probes, timeout=timeout):
+            try:
+                yield probe.result()
+            except Exception as e:
+                logger.debug(f"Failed to probe {probes[probe]}: {e}")
+    except FutureTimeoutError:
+        logger.warning(f"Gave up waiting on {sum(not p.done() for p in probes)} device probes")
+
+
+def _probe_finished(sn, probe: Future):
+    with _discoveryLock:
+        _probesInFlight.pop(sn, None)
+        if probe.exception() is None:
+            _discoveryCache[sn] = (time(), probe.result())
+
+
+def query_devices(ignored_devices, timeout=DISCOVERY_TIMEOUT, ignored_urls: Iterable[str] = ()):
+    return list(iter_query_devices(ignored_devices, timeout, ignored_urls))
 
-    def __init__(self, deviceid):
-        """
 
-        :rtype: object
+class ReaderBoard:
+    def __init__(self, deviceid, blocking_read=True, ftdi=None):
+        """
+        :param deviceid: pyftdi url of the board
+        :param blocking_read: wake on incoming bytes rather than polling every 100ms
+        :param ftdi: transport to use in place of a pyftdi Ftdi. Defaults to a SimulatedFtdi for
+                     sim:// urls
         """
         # self.input = queue.Queue(20)
         self.packetCallback = None
+        self.packetTime = time()  # when the read that is being parsed returned, for scan tracing
         self.errorCallback = None
         self.loop_crashed_callback = None
 
-        self._commandLock = Lock()
-        self._packetReadEvent = Event()
+        self._writeLock = Lock()
+        self._pendingLock = Lock()
+        self._pending: Dict[str, Deque[PendingCommand]] = {}
+        self._expired: Deque[Tuple[str, str]] = deque(maxlen=MAX_COMMANDS_IN_FLIGHT)  # (reply, data)
+        self._inFlight = BoundedSemaphore(MAX_COMMANDS_IN_FLIGHT)
         self._startedEvent = Event()
         self._stoppedEvent = Event()
         self._run = True
         self.device_id = deviceid
-        self._ftdi = Ftdi()
+        self._blockingRead = blocking_read
+        if ftdi is None:
+            ftdi = SimulatedFtdi() if is_simulated(deviceid) else Ftdi()
+        self._ftdi = ftdi
         self.numScanners = 0
         self.numRelays = 0
         self.relaystatus = {}
         self.version = "0.00"
         self.model = "unknown"
-        self._unlockTimeouts = {}
 
-        self._parserState = ParserState.BEGIN
-        self._firstChar = ' '
-        self._body = bytearray()
+        self._framer = PacketFramer()
 
-        # self.ftdi.open(vendor=0x0403,product=0x6001, serial=self.device)
-        self._ftdi.open_from_url(self.device_id)
-        self._ftdi.set_baudrate(57600)
+        # Diagnostics, see stats()
+        self.commandRtt: Dict[str, Histogram] = {}
+        self.commandTimeouts: Dict[str, int] = {}
+        self.wakeBytes = Histogram(SIZE_BUCKETS)
+        self.emptyWakes = 0
+        self.relayOverrun = Histogram()  # how much longer than configured a relay stayed unlocked
+        self.earlyRelocks = 0
+        self._expectedRelock: Dict[int, float] = {}
 
-        self._backgroundThread = Thread(target=self.background)
+        # self.ftdi.open(vendor=0x0403,product=0x6001, serial=self.device)
+        if not _claim_url(self.device_id):
+            raise RuntimeError(f"{self.device_id} is already open")
+        try:
+            self._ftdi.open_from_url(self.device_id)
+            self._ftdi.set_baudrate(57600)
+            if self._blockingRead:
+                self._ftdi.set_latency_timer(READ_LATENCY_MS)
+                self._ftdi.timeouts = (READ_TIMEOUT_MS, self._ftdi.timeouts[1])
+        except Exception:
+            _release_url(self.device_id)
+            raise
+
+        self._backgroundThread = Thread(target=self.background, name=f"board {self.device_id}")
         self._backgroundThread.start()
-        self._otherThread = Thread(target=self.lock_watch_loop)
-        self._otherThread.start()
 
-        if not self._startedEvent.wait(3.0):
+        if not self._startedEvent.wait(STARTUP_TIMEOUT):
+            self._abandon_startup()
             raise RuntimeError("Unable to startup board!")
         else:
             logger.log(logging.DEBUG, "Started up, disabling echo")
             self.send_command('e', '0')
 
-            def get_device_info(fc, b, me):
-                if fc == 'I':
-                    info = {i.split(':')[0]: i.split(':')[1] for i in b.split(',')}
-                    self.model = info['m']
-                    self.version = info['v']
-                    self.numRelays = int(info['r'])
-                    self.numScanners = int(info['s'])
-                    for a in range(self.numRelays):
-                        self._unlockTimeouts[a] = []
-                        self.relaystatus[a] = False
-
-            self.packetCallback = get_device_info
             logger.info("calling getting device info")
-            self.send_command('i', '')
+            b = self.send_command('i', '')
+            if b is None:
+                self.shutdown()
+                raise RuntimeError("Board didn't answer the device info request!")
+            info = {i.split(':')[0]: i.split(':')[1] for i in b.split(',')}
+            self.model = info['m']
+            self.version = info['v']
+            self.numRelays = int(info['r'])
+            self.numScanners = int(info['s'])
+            for a in range(1, self.numRelays + 1):  # relays are numbered from 1 by the firmware
+                self.relaystatus[a] = False
             logger.info("done interrogating")
 
-            self.packetCallback = None
+    def _abandon_startup(self):
+        """
+        Stops the read thread of a board that never came up and releases the device, so a retry
+        doesn't find the thread still holding it or parsing packets nobody is listening for.
+        """
+        self._run = False
+        self._backgroundThread.join(STARTUP_TIMEOUT)
+        if self._backgroundThread.is_alive():
+            logger.error(f"Read thread for {self.device_id} didn't stop, closing the device under it")
+            self._ftdi.close()
+            _release_url(self.device_id)
 
     def shutdown(self):
         self._run = False
-        self._commandLock.acquire()
+        Scheduler.forget(self)
+        self._fail_pending(RuntimeError(f"Board {self.device_id} shut down"))
         if not self._stoppedEvent.wait(3.0):
             raise TimeoutError("Failed to shut down board in a timely manner")
         self._backgroundThread.join()
@@ -144,18 +260,16 @@ class ReaderBoard:
         self._ftdi.set_dtr(False)
         sleep(0.1)
         self._ftdi.set_dtr(True)  # Reset the device
-        totaltime = 0
+        deadline = time() + 5
         ready_bytes = bytearray()
         started_up = False
-        while totaltime < 5:
-            sleep(0.1)
-            totaltime += 0.1
-            in_bytes = self._ftdi.read_data_bytes(50)
+        while self._run and time() < deadline:
+            in_bytes = self.read_wake()
             if len(in_bytes) > 0:
                 ready_bytes.extend(in_bytes)
                 s = ready_bytes.decode(encoding="utf-8")
                 if '? for help' in s:
-                    totaltime = 1000
+                    deadline = 0
                     started_up = True
                     self._startedEvent.set()
                     try:
@@ -164,128 +278,238 @@ class ReaderBoard:
                         logger.fatal(f"USB ERROR! {error}")
                         if self.errorCallback is not None:
                             self.errorCallback(error)
+                        if self._run and self.loop_crashed_callback:
+                            dd_logger.critical(f"Read loop for {self.device_id} crashed!", exc_info=True)
+                            self.loop_crashed_callback()
 
         if not started_up:
             print("Failed to startup device!")
         logger.log(logging.DEBUG, "Shutting down FTDI device...")
+        self._fail_pending(RuntimeError(f"Board {self.device_id} shut down"))
         self._ftdi.close()
-        self._commandLock.release()
+        _release_url(self.device_id)
         logger.log(logging.DEBUG, "Done shutting down hardware interface")
 
-    def lock_watch_loop(self):
-        try:
-            if not self._startedEvent.wait(5000):
-                logger.fatal("Didn't start up!")
-            else:
-                while self._run:
-                    now = time()
-                    tos: List[LockTimeout]
-                    for (r, tos) in self._unlockTimeouts.items():
-                        if any(tos):
-                            for t in tos:
-                                if now >= t.timeout:
-                                    tos.remove(t)
-                                    if len(tos) == 0:
-                                        # close the door
-                                        self.send_command('o', str(r))
-                                        self.relaystatus[r] = False
-                        elif self.relaystatus[r]:
-                            self.send_command('o', str(r))
-                            self.relaystatus[r] = False
-                    sleep(0.25)
-        except:
-            dd_logger.critical("Unlock timeout loop crashed!", exc_info=True)
-            if self.loop_crashed_callback:
-                self.loop_crashed_callback()
+    def read_wake(self):
+        """
+        Waits for data from the board and returns everything that is buffered.
 
-    def parse_loop(self):
-        totaltime = 0
-        while self._run:
-            sleep(0.1)
-            totaltime += 0.1
-            in_bytes = self._ftdi.read_data_bytes(50)
-            self.parse(in_bytes)
+        In blocking mode this returns as soon as the FTDI latency timer flushes bytes to us, or once
+        READ_TIMEOUT_MS passes with nothing to read, and keeps reading while full chunks come back
+        so a burst is drained in a single wake. The chip sends a status-only packet every latency
+        period, which pyftdi returns as an empty read, so empty reads are retried until the timeout.
+        """
+        if not self._blockingRead:
+            sleep(POLL_INTERVAL)
+            return self._ftdi.read_data_bytes(POLL_READ_SIZE)
+
+        deadline = monotonic() + READ_TIMEOUT_MS / 1000.0
+        in_bytes = self._ftdi.read_data_bytes(READ_CHUNK_SIZE)
+        while len(in_bytes) == 0 and self._run and monotonic() < deadline:
+            in_bytes = self._ftdi.read_data_bytes(READ_CHUNK_SIZE)
+        if len(in_bytes) == READ_CHUNK_SIZE:
+            in_bytes = bytearray(in_bytes)
+            while True:
+                more = self._ftdi.read_data_bytes(READ_CHUNK_SIZE)
+                in_bytes.extend(more)
+                if len(more) < READ_CHUNK_SIZE:
+                    break
+        return in_bytes
 
-            # Check out open/close queue
-        self._stoppedEvent.set()
+    def parse_loop(self):
+        try:
+            while self._run:
+                in_bytes = self.read_wake()
+                self.packetTime = time()
+                if len(in_bytes) > 0:
+                    self.wakeBytes.add(len(in_bytes))
+                else:
+                    self.emptyWakes += 1
+                self.parse(in_bytes)
+                self._expire_commands()
+        finally:
+            self._stoppedEvent.set()
 
     def parse(self, in_bytes):
         if len(in_bytes) > 0:
-            for b in in_bytes:
-                c = chr(b)
-
-                if self._parserState == ParserState.BEGIN or self._parserState == ParserState.FOUND_NEWLINE:
-                    self._body.clear()
-                    self._firstChar = c
-                    self._parserState = ParserState.FOUND_FIRST
-                elif self._parserState == ParserState.FOUND_FIRST:
-                    if b != 0x0D:  # '\r'
-                        self._body.append(b)
-                    else:
-                        self._parserState = ParserState.FOUND_CARRIAGE
-                elif self._parserState == ParserState.FOUND_CARRIAGE:
-                    if b != 0x0A:  # \n
-                        # RAISE PARSING ERROR
-                        self._parserState = ParserState.BEGIN
-                    else:
-                        self._parserState = ParserState.FOUND_NEWLINE
-                        logger.log(logging.DEBUG, f"Read a packet: {self._firstChar}, {self._body}")
-                        if self.packetCallback is not None:
-                            try:
-                                self.packetCallback(self._firstChar, self._body.decode("utf-8"), self.device_id)
-                            except Exception as e:
-                                logger.log(logging.FATAL, f"Failed calling packet callback: {e}")
-                        if not (self._firstChar == 'e' and len(self._body) == 1 and self._body[0] == ord('0')):
-                            self._packetReadEvent.set()
-
-    def send_command(self, c: str, data: str):
+            for (first_char, body) in self._framer.feed(in_bytes):
+                logger.log(logging.DEBUG, f"Read a packet: {first_char}, {body}")
+                if first_char == 'G' and len(body) > 0:  # the board didn't understand a command, body is what it got
+                    if self._complete_command(body[0].upper(), body[1:],
+                                              error=ValueError(f"Board rejected command: {body}")):
+                        continue
+                elif first_char.isupper() and self._complete_command(first_char, body):
+                    continue
+                if self.packetCallback is not None:
+                    try:
+                        self.packetCallback(first_char, body, self.device_id)
+                    except Exception as e:
+                        logger.log(logging.FATAL, f"Failed calling packet callback: {e}")
+
+    def _complete_command(self, reply: str, body: str, error=None):
+        """
+        Matches a reply to the oldest outstanding command with the same letter, preferring one whose
+        argument is echoed back in the reply (o1 -> O1) so a late reply can't land on the wrong relay.
+
+        :return: True if the reply belonged to a command
+        """
+        with self._pendingLock:
+            waiting = self._pending.get(reply)
+            if not waiting:
+                return False
+            match = next((pc for pc in waiting if pc.data == body), None)
+            if match is None:
+                if (reply, body) in self._expired:
+                    # the late echo of a command that already timed out
+                    self._expired.remove((reply, body))
+                    return False
+                match = waiting[0]
+            waiting.remove(match)
+        self._inFlight.release()
+        if error is not None:
+            match.future.set_exception(error)
+        else:
+            rtt = self.commandRtt.get(match.command)
+            if rtt is None:
+                rtt = self.commandRtt.setdefault(match.command, Histogram())
+            rtt.add(time() - match.sent)
+            match.future.set_result(body)
+        return True
+
+    def _expire_commands(self):
+        now = time()
+        expired = []
+        with self._pendingLock:
+            for waiting in self._pending.values():
+                for pc in [pc for pc in waiting if pc.deadline <= now]:
+                    waiting.remove(pc)
+                    expired.append(pc)
+                    self._expired.append((pc.command.upper(), pc.data))
+        for pc in expired:
+            self._inFlight.release()
+            self.commandTimeouts[pc.command] = self.commandTimeouts.get(pc.command, 0) + 1
+            logger.log(logging.ERROR, f"Failure to get response from board, it's down? Command: {pc.command}:{pc.data}")
+            pc.future.set_exception(CommandTimeout(f"{self.device_id} didn't answer {pc.command}{pc.data}"))
+
+    def _fail_pending(self, error):
+        with self._pendingLock:
+            failed = [pc for waiting in self._pending.values() for pc in waiting]
+            self._pending.clear()
+        for pc in failed:
+            self._inFlight.release()
+            pc.future.set_exception(error)
+
+    def send_command_async(self, c: str, data: str, timeout: float = COMMAND_TIMEOUT) -> Future:
+        """
+        Writes a command to the board without waiting for the reply.
+
+        :return: a Future resolved with the reply body, or failed with CommandTimeout if the board
+                 doesn't answer within timeout
+        """
         if len(c) != 1 or not c.isalpha():
             raise ValueError("c must be a single character!")
 
+        pc = PendingCommand(c, data, time() + timeout)
+        if not self._run:
+            pc.future.set_exception(RuntimeError(f"Board {self.device_id} is shut down"))
+            return pc.future
+        if not self._inFlight.acquire(timeout=timeout):
+            pc.future.set_exception(CommandTimeout(f"Too many commands waiting on {self.device_id}"))
+            return pc.future
+
         message = f"{c}{data}\r"  # we won't add a \n, serial comms don't do that normally
-        self._packetReadEvent.clear()
-        d = message.encode("utf-8")
-        if self._commandLock.acquire(timeout=1.0):
-            if self._run:
-                self._ftdi.write_data(d)
-                if self._packetReadEvent.wait(3.0):
-                    self._commandLock.release()
-                    return self._body
-                else:
-                    logger.log(logging.ERROR, f"Failure to get response from board, it's down? Command: {c}:{data}")
-                    # raise RuntimeError()
-                    self._commandLock.release()
-            else:
-                self._commandLock.release()
-        else:
+        with self._pendingLock:
+            self._pending.setdefault(c.upper(), deque()).append(pc)
+        try:
+            with self._writeLock:
+                self._ftdi.write_data(message.encode("utf-8"))
+        except Exception as e:
+            with self._pendingLock:
+                waiting = self._pending[c.upper()]
+                if pc in waiting:
+                    waiting.remove(pc)
+                    self._inFlight.release()
+            if not pc.future.done():
+                pc.future.set_exception(e)
+        return pc.future
+
+    def send_command(self, c: str, data: str, timeout: float = COMMAND_TIMEOUT):
+        """Writes a command and waits for the reply, returns the reply body or None on failure"""
+        future = self.send_command_async(c, data, timeout)
+        try:
+            # the read loop expires the command, the extra second covers a read loop that has died
+            return future.result(timeout + 1.0)
+        except Exception as e:
             if self._run:
-                raise SystemError("Sync Error")
+                logger.log(logging.ERROR, f"Command {c}:{data} to {self.device_id} failed: {e}")
+            return None
+
+    def relock(self, relay):
+        self._fire_and_forget('o', str(relay))
+        self.relaystatus[relay] = False
+        expected = self._expectedRelock.pop(relay, None)
+        if expected is not None:
+            overrun = time() - expected
+            if overrun >= 0:
+                self.relayOverrun.add(overrun)
+            else:  # locked from the webpanel, or the credential's timeouts were cancelled
+                self.earlyRelocks += 1
+
+    def stats(self):
+        """:return: diagnostic counters and histogram snapshots, plain data so they can be queued"""
+        return {
+            "device": self.__repr__(),
+            "commands": {c: h.snapshot() for c, h in sorted(self.commandRtt.items())},
+            "timeouts": dict(self.commandTimeouts),
+            "framing_errors": self._framer.framing_errors,
+            "wake_bytes": self.wakeBytes.snapshot(),
+            "empty_wakes": self.emptyWakes,
+            "relay_overrun": self.relayOverrun.snapshot(),
+            "early_relocks": self.earlyRelocks,
+        }
+
+    def _fire_and_forget(self, c, data):
+        def check(future: Future):
+            error = future.exception()
+            if error is not None and not isinstance(error, CommandTimeout):  # timeouts are logged on expiry
+                logger.error(f"Command {c}{data} to {self.device_id} failed: {error}")
+        future = self.send_command_async(c, data)
+        future.add_done_callback(check)
+        return future
 
     def __repr__(self):
         return f"{self.device_id} - {self.model} v{self.version}: {self.numScanners} scanners, {self.numRelays} relays"
 
     def Unlock(self, relay, duration, credential=None):
-        if relay > self.numRelays:
+        """:return: Future for the relay command, None if the relay doesn't exist"""
+        if not 1 <= relay <= self.numRelays:
             logger.error(f"Attempt to activate a relay board {self.device_id} doesn't have. {relay}")
             return
-        now = time()
-        self._unlockTimeouts[relay].append(LockTimeout(now + duration, credential))
-        self.send_command('c', str(relay))
+        # queued before the relock is armed, so a short duration can't send the 'o' ahead of the 'c'
+        future = self._fire_and_forget('c', str(relay))
         self.relaystatus[relay] = True
+        self._expectedRelock[relay] = max(self._expectedRelock.get(relay, 0), time() + duration)
+        Scheduler.unlock(self, relay, duration, credential)
+        return future
+
+    def ExtendUnlock(self, relay, duration, credential=None):
+        """
+        Keeps a relay that is already unlocked open for another duration, without a relay command.
+        :return: False if the relay isn't being held open, the caller has to Unlock it instead
+        """
+        if not 1 <= relay <= self.numRelays or Scheduler.pending(self, relay) == 0:
+            return False
+        self._expectedRelock[relay] = max(self._expectedRelock.get(relay, 0), time() + duration)
+        Scheduler.unlock(self, relay, duration, credential)
+        return True
 
     def Lock(self, relay, credential=None):
-        if relay > self.numRelays:
+        if not 1 <= relay <= self.numRelays:
             logger.error(f"Attempt to activate a relay board {self.device_id} doesn't have. {relay}")
             return
-        if credential is None: #This only is raised by the webpanel, clear our all entries, and the relay
-            # will be relocked by the loop
-            self._unlockTimeouts[relay].clear()
-        else:
-            for tos in self._unlockTimeouts[relay]:
-                if tos.credential == credential: # Clear all pending timeouts for the credential
-                    self._unlockTimeouts[relay].remove(tos)
-                    # At this point the timeout should be cleared
-                    # during the watch loop
+        # credential None is only raised by the webpanel, clear out all entries. The relay is
+        # relocked once nothing else is holding it open.
+        Scheduler.cancel(self, relay, credential)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+"""
+Load tests the scan -> authorization -> relay path with simulated boards, no ACCX hardware needed.
+
+Writes a door_config.yaml for the simulated boards and a member database into a scratch
+directory, starts an AuthorizationService there and drives scans at it. Reports scan-to-relay
+latency, measured from a granted scan leaving the board until the board receives the relay
+command.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+from collections import deque
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Lock, Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from metrics import RollingPercentiles, format_ms
+from simulator import ScanGenerator, get_simulated
+
+
+def write_config(directory, boards, scanners):
+    lines = ["system:",
+             "  logfile: loadtest.log",
+             "  activitydb: loadtest-activity.db",
+             "webpanel:",
+             "  secretkey: loadtest",
+             "  username: loadtest",
+             "  password: loadtest",
+             "auth:",
+             "  wildapricot:",
+             "    dbfile: loadtest-wildapricot.db",
+             "    api_key: loadtest",
+             "    refresh: 100000",
+             "scanners:"]
+    for b in range(boards):
+        for s in range(1, scanners + 1):
+            lines += [f"  scanner{b}x{s}:", f"    board: sim://board{b}?scanners={scanners}", f"    scanner: {s}"]
+    lines.append("facilities:")
+    for b in range(boards):
+        for s in range(1, scanners + 1):
+            lines += [f"  door{b}x{s}:", f"    board: sim://board{b}?scanners={scanners}",
+                      f"    scanner: scanner{b}x{s}", f"    relay: {s}"]
+    with open(os.path.join(directory, "door_config.yaml"), "w") as config:
+        config.write("\n".join(lines) + "\n")
+    return [f"sim://board{b}?scanners={scanners}" for b in range(boards)]
+
+
+def seed_members(dbfile, members):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from auth.wildapricot import WildApricotBase, WildApricotDb
+
+    engine = create_engine(f"sqlite:///{dbfile}")
+    WildApricotBase.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    now = datetime.now()
+    fobs = []
+    for m in range(members):
+        fob = 1000000 + m
+        db.add(WildApricotDb(person=str(50000 + m), code=f"f:{fob}", member_enabled=True, member_status="Active",
+                             is_banned=False, expiration=now + timedelta(days=365), membership_level=1,
+                             last_login=now, last_updated=now))
+        fobs.append(str(fob))
+    db.commit()
+    db.close()
+    return fobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the door controller against simulated boards")
+    parser.add_argument('--boards', type=int, default=3)
+    parser.add_argument('--scanners', type=int, default=2, help='scanners per board, each gets its own door')
+    parser.add_argument('--rate', type=float, default=10.0, help='scans per second across all boards')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to generate scans for')
+    parser.add_argument('--pattern', choices=ScanGenerator.PATTERNS, default="poisson")
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--unknown', type=float, default=0.2, help='fraction of scans using unknown fobs')
+    parser.add_argument('--workdir', help='directory for the generated config and databases')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tcdoor-loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    urls = write_config(workdir, args.boards, args.scanners)
+    os.chdir(workdir)
+    fobs = seed_members("loadtest-wildapricot.db", args.members)
+    print(f"Working in {workdir}")
+
+    # configuration reads door_config.yaml from the working directory when it is imported
+    from authorization_service import AuthorizationService
+    from configuration import Config, DEFAULT_DEBOUNCE_MS
+    from models import Activity
+
+    inqueue = Queue()
+    outqueue = Queue()
+    service = Thread(target=AuthorizationService, args=(inqueue, outqueue), name="authorization-service")
+    service.start()
+    inqueue.put(("status",))
+    outqueue.get(True, 60)  # boards are up once the service answers
+
+    latency = RollingPercentiles(window=100000)
+    pending = {}
+    pendingLock = Lock()
+    lastScan = {}
+
+    def relay_command(sim, c, relay):
+        if c == 'c':
+            with pendingLock:
+                waiting = pending.get((sim.url, int(relay)))
+                sent = waiting.popleft() if waiting else None
+            if sent is not None:
+                latency.add(time() - sent)
+
+    for url in urls:
+        get_simulated(url).command_callback = relay_command
+
+    granted = set(fobs)
+
+    def scanned(url, scanner, first_char, code, sent):
+        if code in granted:
+            with pendingLock:
+                # repeats of a held fob are absorbed by the service and never get a relay command of their own
+                previous = lastScan.get((url, scanner))
+                lastScan[(url, scanner)] = (code, sent)
+                if previous is not None and previous[0] == code and sent - previous[1] < DEFAULT_DEBOUNCE_MS / 1000.0:
+                    return
+                pending.setdefault((url, scanner), deque()).append(sent)
+
+    unknown = [('F', str(20000000 + n)) for n in range(1000)]
+    credentials = [('F', f) for f in fobs]
+    weighted = credentials + random.sample(unknown, min(len(unknown), int(len(credentials) * args.unknown)))
+    generator = ScanGenerator(urls, args.rate, weighted, pattern=args.pattern, callback=scanned)
+
+    started = time()
+    generator.run(duration=args.duration)
+    sleep(3.0)  # let the last decisions land
+    elapsed = time() - started
+
+    db = Config.ScopedSession()
+    activity = db.query(Activity).count()
+    db.close()
+    inqueue.put(("status",))
+    status = outqueue.get(True, 30)
+    negative = status.get("negative_cache", {})
+    debounce = status.get("debounce", {})
+    traces = status.get("traces", {})
+    inqueue.put(("shutdown",))
+    outqueue.get(True, 30)
+    service.join()
+
+    print(f"{generator.sent} scans in {elapsed:.1f}s ({generator.sent / elapsed:.1f}/s), {activity} activity records")
+    print(f"scan-to-relay: {format_ms(latency.snapshot())}")
+    print(f"unknown credential cache: {negative.get('hits', 0)} hits, {negative.get('misses', 0)} misses")
+    for stage, snapshot in traces.get("stages", {}).items():
+        print(f"{stage:>10}: {format_ms(snapshot)}")
+    print(f"repeated scans absorbed: {sum(debounce.get('absorbed', {}).values())}, "
+          f"{debounce.get('extended', 0)} unlocks extended")
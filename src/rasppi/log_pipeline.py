@@ -0,0 +1,117 @@
+import logging
+import os
+from logging.handlers import QueueHandler
+from queue import Queue, Full
+from threading import Lock, Thread
+from typing import Dict, List
+
+# Records waiting for the listener before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+
+class _RouteHandler(QueueHandler):
+    """Stands in for a logger's real handlers, hands records to the pipeline without waiting"""
+
+    def __init__(self, pipeline: 'LogPipeline', route: str):
+        super().__init__(None)
+        self.pipeline = pipeline
+        self.route = route
+
+    def enqueue(self, record):
+        self.pipeline.enqueue(self.route, record)
+
+
+class LogPipeline():
+    """
+    Moves log handlers off the threads that log.
+
+    Each logger that is installed keeps a single handler that queues its records, and one listener
+    thread passes them on to the real handlers (log file, SMTP, Datadog). When the queue is full
+    records are dropped and counted, so a slow mail server or Datadog endpoint can never hold up a
+    scan.
+    """
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.queue = Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.handled = 0
+        self._routes: Dict[str, List[logging.Handler]] = {}
+        self._lock = Lock()
+        self._thread = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # the listener thread doesn't survive a fork, the child gets its own queue and listener
+        self.queue = Queue(maxsize=self.maxsize)
+        self._lock = Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="log-listener", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, route, record):
+        if self._thread is None:
+            self._ensure_started()
+        try:
+            self.queue.put_nowait((route, record))
+        except Full:
+            self.dropped += 1
+
+    def _run(self):
+        queue = self.queue
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            route, record = item
+            for handler in self._routes.get(route, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            self.handled += 1
+
+    def attach(self, logger: logging.Logger, handler: logging.Handler):
+        """Adds handler to logger, behind the queue"""
+        with self._lock:
+            route = logger.name
+            if route not in self._routes:
+                self._routes[route] = []
+                logger.addHandler(_RouteHandler(self, route))
+            # the listener iterates the list without the lock, so it is replaced rather than changed
+            self._routes[route] = self._routes[route] + [handler]
+
+    def detach(self, logger: logging.Logger, handler: logging.Handler):
+        with self._lock:
+            handlers = self._routes.get(logger.name, [])
+            if handler in handlers:
+                self._routes[logger.name] = [h for h in handlers if h is not handler]
+                handler.close()
+
+    def install(self, logger: logging.Logger) -> logging.Logger:
+        """Moves every handler logger has behind the queue"""
+        for handler in list(logger.handlers):
+            if not isinstance(handler, _RouteHandler):
+                logger.removeHandler(handler)
+                self.attach(logger, handler)
+        return logger
+
+    def stop(self, timeout=5.0):
+        """Writes out what is queued and stops the listener"""
+        thread = self._thread
+        if thread is not None:
+            self.queue.put(None, timeout=timeout)
+            thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {"queued": self.queue.qsize(),
+                "maxsize": self.maxsize,
+                "handled": self.handled,
+                "dropped": self.dropped,
+                "handlers": {route: [type(h).__name__ for h in hs] for route, hs in self._routes.items()}}
+
+
+Pipeline = LogPipeline()
@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+
+# Bucket upper bounds in seconds, roughly 1-2-5 steps from a millisecond to ten seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+class RollingPercentiles():
+    """Keeps the last `window` samples and reports percentiles over them."""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = Lock()
+        self.count = 0
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+
+    def percentile(self, p):
+        with self._lock:
+            ordered = sorted(self._samples)
+        return self._percentile(ordered, p)
+
+    @staticmethod
+    def _percentile(ordered, p):
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def snapshot(self):
+        with self._lock:
+            ordered = sorted(self._samples)
+            count = self.count
+        return {
+            "count": count,
+            "p50": self._percentile(ordered, 50),
+            "p90": self._percentile(ordered, 90),
+            "p99": self._percentile(ordered, 99),
+            "max": ordered[-1] if ordered else None,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self.count = 0
+
+
+class Histogram():
+    """
+    Fixed bucket histogram, cheap enough to update on every packet. Percentiles are reported as the
+    upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)  # the last bucket catches everything above
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, value):
+        with self._lock:
+            self._counts[bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def _percentile(self, p):
+        if self.count == 0:
+            return None
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, c in enumerate(self._counts):
+            seen += c
+            if seen >= target and c > 0:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self._percentile(50),
+                "p90": self._percentile(90),
+                "p99": self._percentile(99),
+                "max": self.max,
+                "buckets": list(zip(self.bounds + (None,), self._counts)),
+            }
+
+
+def format_ms(snapshot):
+    """Formats a snapshot of second-valued samples as milliseconds"""
+    def ms(v):
+        return "-" if v is None else f"{v * 1000.0:.2f}ms"
+    return f"n={snapshot['count']} p50={ms(snapshot['p50'])} p90={ms(snapshot['p90'])} " \
+           f"p99={ms(snapshot['p99'])} max={ms(snapshot['max'])}"
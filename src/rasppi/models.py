@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, DateTime, Boolean, Float, ForeignKey, create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -18,3 +18,34 @@ class Activity(DoorControllerBase):
     timestamp = Column(DateTime, nullable=False)
     result = Column(String, nullable=False)
     notified = Column(Boolean, nullable=False)
+    traceid = Column(String)
+    latency = Column(Float)  # ms from the packet arriving to the activity being recorded
+    stages = Column(String)  # json, ms spent in each stage of the scan
+
+
+def migrate_activity_db(engine):
+    """Creates the activity tables, and adds columns that databases from older versions don't have"""
+    DoorControllerBase.metadata.create_all(engine)
+    with engine.connect() as connection:
+        existing = {row[1] for row in connection.execute(text("PRAGMA table_info(activity)"))}
+        for column in Activity.__table__.columns:
+            if column.name not in existing:
+                connection.execute(text(f"ALTER TABLE activity ADD COLUMN {column.name} "
+                                        f"{column.type.compile(engine.dialect)}"))
+
+
+def create_activity_engine(path):
+    """
+    Engine for the activity database. WAL lets the webpanel read activity while the service is
+    writing it, and synchronous=NORMAL means commits no longer wait on an fsync of the SD card.
+    """
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+from collections import deque
+from threading import Event, RLock, Thread
+from time import sleep, time
+
+import paho.mqtt.client as mqtt
+
+from metrics import RollingPercentiles
+
+logger = logging.getLogger("mqtt")
+
+# After paho refuses a publish, e.g. its own queue is full or the connection just dropped, the
+# batch waits this long before it is tried again, doubling up to the max while refusals continue
+PUBLISH_BACKOFF_MIN = 0.1
+PUBLISH_BACKOFF_MAX = 5.0
+
+
+class MqttPublisher():
+    """
+    Publishes door events over one long lived broker connection.
+
+    Messages wait in a bounded in-memory queue, anything past queue_size is appended to a spool
+    file and read back once the queue drains, so a broker outage doesn't lose events. paho handles
+    reconnecting, backing off from 1 to reconnect_max seconds. Bursts are drained in batches of up
+    to batch_size messages per wake.
+    """
+
+    def __init__(self, broker, port, topic, qos=0, queue_size=1000, spool_file=None, batch_size=50,
+                 reconnect_max=60):
+        self.broker = broker
+        self.port = port
+        self.topic = topic
+        self.qos = qos
+        self.queue_size = queue_size
+        self.spool_file = spool_file
+        self.batch_size = batch_size
+
+        self._queue = deque()
+        self._lock = RLock()
+        self._wake = Event()
+        self._connected = Event()
+        self._run = True
+        self._inflight = {}  # mid -> enqueue time
+        self._acked = set()  # mids paho reported before publish() returned them
+        self._spooled = self._count_spool()
+
+        self.publishLatency = RollingPercentiles()
+        self.published = 0
+        self.dropped = 0
+        self.connects = 0
+        self.refused = 0
+
+        self._client = mqtt.Client()
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.reconnect_delay_set(1, reconnect_max)
+        self._client.connect_async(broker, port)
+        self._client.loop_start()
+
+        self._thread = Thread(target=self._publish_loop, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, payload: str):
+        with self._lock:
+            if len(self._queue) < self.queue_size and self._spooled == 0:
+                self._queue.append((time(), payload))
+            else:
+                self._spill(payload)
+        self._wake.set()
+
+    def _count_spool(self):
+        if self.spool_file is None or not os.path.exists(self.spool_file):
+            return 0
+        with open(self.spool_file) as spool:
+            return sum(1 for line in spool)
+
+    def _spill(self, payload):
+        if self.spool_file is None:
+            self.dropped += 1
+            return
+        try:
+            with open(self.spool_file, 'a') as spool:
+                spool.write(json.dumps([time(), payload]) + "\n")
+            self._spooled += 1
+        except OSError as e:
+            self.dropped += 1
+            logger.error(f"Unable to spool MQTT message, dropping it: {e}")
+
+    def _unspool(self):
+        """Moves spooled messages back into the memory queue once it has drained, oldest first"""
+        with open(self.spool_file) as spool:
+            lines = spool.readlines()
+        take = lines[:self.queue_size]
+        rest = lines[self.queue_size:]
+        for line in take:
+            queued, payload = json.loads(line)
+            self._queue.append((queued, payload))
+        if rest:
+            with open(self.spool_file, 'w') as spool:
+                spool.writelines(rest)
+        else:
+            os.remove(self.spool_file)
+        self._spooled = len(rest)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connects += 1
+            logger.info(f"Connected to MQTT broker {self.broker}:{self.port}")
+            self._connected.set()
+            self._wake.set()
+        else:
+            logger.error(f"MQTT broker {self.broker}:{self.port} refused connection: {mqtt.connack_string(rc)}")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        if self.qos == 0:  # paho only redelivers QoS 1 and 2 messages after a reconnect
+            with self._lock:
+                self.dropped += len(self._inflight)
+                self._inflight.clear()
+        if rc != 0:
+            logger.warning(f"Lost connection to MQTT broker {self.broker}:{self.port}, reconnecting")
+
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            queued = self._inflight.pop(mid, None)
+            if queued is None:
+                # beat publish() returning, _publish_loop will pick it up
+                self._acked.add(mid)
+            else:
+                self._delivered(queued)
+
+    def _delivered(self, queued):
+        self.published += 1
+        self.publishLatency.add(time() - queued)
+
+    def _taken(self, info):
+        """
+        Whether paho kept the message. It holds on to QoS 1 and 2 messages it couldn't send and sends
+        them after a reconnect, those are only lost to a full paho queue. Requeueing one paho kept
+        would publish it twice.
+        """
+        if self.qos == 0:
+            return info.rc == mqtt.MQTT_ERR_SUCCESS
+        return info.rc != mqtt.MQTT_ERR_QUEUE_SIZE
+
+    def _publish_loop(self):
+        backoff = 0.0
+        retry_at = 0.0
+        while self._run:
+            self._wake.wait(max(retry_at - time(), 0.0) or 1.0)
+            self._wake.clear()
+            if time() < retry_at:
+                continue  # woken by a new message while backing off
+            refused = False
+            while self._run and self._connected.is_set() and not refused:
+                with self._lock:
+                    if not self._queue and self._spooled:
+                        try:
+                            self._unspool()
+                        except (OSError, ValueError) as e:
+                            logger.error(f"Unable to read MQTT spool {self.spool_file}: {e}")
+                            self._spooled = 0
+                    batch = [self._queue.popleft() for n in range(min(self.batch_size, len(self._queue)))]
+                if not batch:
+                    break
+                for n, (queued, payload) in enumerate(batch):
+                    # not under our lock, paho calls on_publish while holding its own
+                    info = self._client.publish(self.topic, payload, qos=self.qos)
+                    with self._lock:
+                        taken = self._taken(info)
+                        if taken:
+                            if info.mid in self._acked:
+                                self._acked.discard(info.mid)
+                                self._delivered(queued)
+                            else:
+                                self._inflight[info.mid] = queued
+                        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                            # put the rest back in order and back off before trying again
+                            self._queue.extendleft(reversed(batch[n + 1 if taken else n:]))
+                            self.refused += 1
+                            refused = True
+                            break
+            if refused:
+                backoff = min(PUBLISH_BACKOFF_MAX, backoff * 2 or PUBLISH_BACKOFF_MIN)
+                retry_at = time() + backoff
+            else:
+                backoff = 0.0
+
+    def backlog(self):
+        with self._lock:
+            return len(self._queue) + self._spooled + len(self._inflight)
+
+    def shutdown(self, timeout=2.0):
+        """Gives queued messages a moment to go out, then disconnects"""
+        deadline = time() + timeout
+        while self.backlog() > 0 and self._connected.is_set() and time() < deadline:
+            self._wake.set()
+            sleep(0.05)
+        self._run = False
+        self._wake.set()
+        self._thread.join()
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def stats(self):
+        return {"broker": f"{self.broker}:{self.port}",
+                "connected": self._connected.is_set(),
+                "connects": self.connects,
+                "published": self.published,
+                "backlog": self.backlog(),
+                "spooled": self._spooled,
+                "dropped": self.dropped,
+                "refused": self.refused,
+                "publish_latency": self.publishLatency.snapshot()}
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class NegativeCache():
+    """
+    Remembers credentials no auth module recognized, so badging a dead fob over and over doesn't
+    query every module each time.
+
+    Entries expire after ttl seconds, and the least recently used ones are evicted past max_entries.
+    Every lookup carries the auth modules' data versions, the whole cache is dropped as soon as any
+    of them changes since a refresh may have brought the credential in.
+    """
+
+    def __init__(self, max_entries=4096, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._versions = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_versions(self, versions):
+        if versions != self._versions:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._versions = versions
+
+    def get(self, key, versions):
+        with self._lock:
+            self._check_versions(versions)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, versions):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._check_versions(versions)
+            self._entries[key] = (time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions = None
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "max_entries": self.max_entries,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations}
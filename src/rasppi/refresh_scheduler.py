@@ -0,0 +1,122 @@
+import logging
+import random
+from threading import Lock, Thread
+from time import time
+from typing import Dict, Iterable
+
+logger = logging.getLogger("auth")
+
+# Spread of each plugin's refresh interval, so plugins and doors don't all refresh on the same tick
+REFRESH_JITTER = 0.1
+# Longest a failed refresh waits before it is tried again
+REFRESH_RETRY_MAX = 300.0
+# Longest the service loop blocks on its queue, a ceiling on how late a refresh can start
+REFRESH_WAIT_MAX = 60.0
+
+
+class PluginRefresh():
+    __slots__ = ('plugin', 'name', 'interval', 'due', 'running', 'started', 'last_success', 'last_attempt',
+                 'duration', 'failures', 'last_error', 'refreshes')
+
+    def __init__(self, plugin, now):
+        self.plugin = plugin
+        self.name = plugin.__module__
+        self.interval = plugin.refresh_interval()
+        self.due = now
+        self.running = False
+        self.started = None
+        self.last_success = None
+        self.last_attempt = None
+        self.duration = None
+        self.failures = 0
+        self.last_error = None
+        self.refreshes = 0
+
+
+class RefreshScheduler():
+    """
+    Refreshes auth plugins' data on their own intervals, off the service loop.
+
+    Every plugin has a next due time, its refresh interval after the last refresh finished with
+    some jitter added. The service loop calls run_due() whenever it wakes up and waits on its queue
+    no longer than next_wait(), so a steady stream of commands can't hold refreshes back. Each
+    refresh runs on its own thread and a plugin is never refreshed again while one is running.
+    """
+
+    def __init__(self, plugins: Iterable = ()):
+        self._lock = Lock()
+        self._plugins: Dict[int, PluginRefresh] = {}
+        self.set_plugins(plugins)
+
+    def set_plugins(self, plugins: Iterable):
+        """Schedules plugins, all due now. Refreshes already running on replaced plugins are left to finish."""
+        now = time()
+        with self._lock:
+            self._plugins = {id(p): PluginRefresh(p, now) for p in plugins if p.refresh_interval() is not None}
+
+    def request(self):
+        """Makes every plugin due now, a running refresh isn't repeated"""
+        now = time()
+        with self._lock:
+            for r in self._plugins.values():
+                r.due = min(r.due, now)
+
+    def next_wait(self, now=None) -> float:
+        now = time() if now is None else now
+        with self._lock:
+            waiting = [r.due for r in self._plugins.values() if not r.running]
+        if not waiting:
+            return REFRESH_WAIT_MAX
+        return max(0.0, min(REFRESH_WAIT_MAX, min(waiting) - now))
+
+    def run_due(self, now=None):
+        """Starts a refresh for every plugin that is due and not already refreshing"""
+        now = time() if now is None else now
+        with self._lock:
+            due = [r for r in self._plugins.values() if not r.running and r.due <= now]
+            for r in due:
+                r.running = True
+                r.started = now
+                r.last_attempt = now
+        for r in due:
+            Thread(target=self._refresh, args=(r,), name=f"refresh-{r.name}", daemon=True).start()
+
+    def _refresh(self, r: PluginRefresh):
+        error = None
+        try:
+            r.plugin.refresh_database()
+        except Exception as e:
+            error = e
+        finished = time()
+        with self._lock:
+            r.running = False
+            r.duration = finished - r.started
+            r.refreshes += 1
+            if error is None:
+                r.last_success = finished
+                r.failures = 0
+                r.last_error = None
+                wait = r.interval
+            else:
+                r.failures += 1
+                r.last_error = str(error)
+                wait = min(r.interval, REFRESH_RETRY_MAX)
+            r.due = finished + wait * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+            failures = r.failures
+        if error is not None and failures == 1:
+            logger.error(f"Failed to refresh database, module: {r.name}, e: {error}")
+        elif error is not None:
+            logger.debug(f"Refresh of {r.name} failed again ({failures} in a row): {error}")
+
+    def stats(self, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            return {r.name: {"interval": r.interval,
+                             "running": r.running,
+                             "refreshes": r.refreshes,
+                             "last_success": r.last_success,
+                             "duration": r.duration,
+                             "staleness": now - r.last_success if r.last_success is not None else None,
+                             "due_in": r.due - now if not r.running else None,
+                             "failures": r.failures,
+                             "last_error": r.last_error} for r in self._plugins.values()}
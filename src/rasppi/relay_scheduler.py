@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import logging
+from threading import Condition, Thread
+from time import time
+from typing import Dict, List
+
+from metrics import RollingPercentiles
+
+logger = logging.getLogger("Hardware")
+
+
+class RelayTimeout():
+    __slots__ = ('deadline', 'board', 'relay', 'credential', 'cancelled')
+
+    def __init__(self, deadline: float, board, relay: int, credential):
+        self.deadline = deadline
+        self.board = board
+        self.relay = relay
+        self.credential = credential
+        self.cancelled = False
+
+
+class RelayScheduler():
+    """
+    Relocks relays when their unlock durations run out, for every board.
+
+    Pending timeouts live in a min-heap ordered by deadline, and a single thread sleeps until the
+    earliest one is due or a new unlock arrives. A relay stays unlocked while it has any pending
+    timeout and is relocked, through board.relock(relay), when the last one expires or is
+    cancelled. Cancelled timeouts are only marked and get discarded when they reach the top of
+    the heap.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._live: Dict[tuple, Dict[object, List[RelayTimeout]]] = {}
+        self._thread = None
+        self.jitter = RollingPercentiles()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._run, name="relay-scheduler", daemon=True)
+            self._thread.start()
+
+    def unlock(self, board, relay: int, duration: float, credential=None):
+        with self._cond:
+            self._ensure_started()
+            timeout = RelayTimeout(time() + duration, board, relay, credential)
+            self._live.setdefault((board, relay), {}).setdefault(credential, []).append(timeout)
+            heapq.heappush(self._heap, (timeout.deadline, next(self._sequence), timeout))
+            self._cond.notify()
+
+    def cancel(self, board, relay: int, credential=None):
+        """
+        Cancels the pending timeouts for a credential, or all of them if credential is None. The
+        relay is relocked right away if nothing else is holding it open.
+        """
+        with self._cond:
+            by_credential = self._live.get((board, relay), {})
+            if credential is None:
+                cancelled = [t for ts in by_credential.values() for t in ts]
+                by_credential.clear()
+            else:
+                cancelled = by_credential.pop(credential, [])
+            for t in cancelled:
+                t.cancelled = True
+            relock = not by_credential
+            if relock:
+                self._live.pop((board, relay), None)
+        if relock and board.relaystatus.get(relay, False):
+            board.relock(relay)
+
+    def forget(self, board):
+        """Drops every pending timeout for a board that is going away"""
+        with self._cond:
+            for key in [k for k in self._live if k[0] is board]:
+                for ts in self._live.pop(key).values():
+                    for t in ts:
+                        t.cancelled = True
+
+    def pending(self, board, relay: int) -> int:
+        with self._cond:
+            return sum(len(ts) for ts in self._live.get((board, relay), {}).values())
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            timeout: RelayTimeout = heapq.heappop(self._heap)[2]
+            if timeout.cancelled:
+                continue
+            key = (timeout.board, timeout.relay)
+            by_credential = self._live[key]
+            waiting = by_credential[timeout.credential]
+            waiting.remove(timeout)
+            if not waiting:
+                del by_credential[timeout.credential]
+            if not by_credential:
+                del self._live[key]
+                due.append(timeout)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    due = self._pop_due(time())
+                    if due:
+                        break
+                    self._cond.wait(self._heap[0][0] - time() if self._heap else None)
+            for timeout in due:
+                self.jitter.add(time() - timeout.deadline)
+                try:
+                    timeout.board.relock(timeout.relay)
+                except Exception:
+                    logger.critical(f"Failed to relock relay {timeout.relay} on {timeout.board}", exc_info=True)
+
+
+Scheduler = RelayScheduler()
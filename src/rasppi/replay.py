@@ -0,0 +1,288 @@
+"""
+Replays recorded scans against an AuthorizationService running on simulated boards.
+
+Scans come from the Activity table of an activity database, or from a serial capture: a text file
+with one packet per line as "<unix time> <board url> <packet>", e.g.
+
+    1697040000.125 ftdi://ftdi:232:AM01QC8Q/1 F15408774,1
+
+Lines starting with # are ignored and only F and P packets are replayed.
+
+The door configuration is copied into a scratch directory with every board swapped for a sim://
+board, the activity database and log moved into the scratch directory, the auth plugins' databases
+copied there, and email, MQTT and scan capture turned off. Nothing the real service uses is touched. Plugins can't
+refresh over the network unless --refresh is given.
+
+Scans are sent with their original spacing divided by --speed, --speed 0 sends them back to back.
+The report covers throughput, decision latency and, for activity replays, how the decisions compare
+to what was logged at the time. Decisions that depend on the date, like expired memberships, are
+made as of now and can legitimately differ.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter, deque
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+from time import sleep, time
+from typing import List, NamedTuple, Optional
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from metrics import RollingPercentiles, format_ms
+from simulator import SCHEME, get_simulated
+
+
+class ReplayScan(NamedTuple):
+    at: float  # seconds, only the spacing between scans matters
+    board: str  # board url in the original configuration
+    scanner: int
+    first_char: str
+    code: str
+    facility: Optional[str] = None
+    result: Optional[str] = None  # what was logged originally, None for captures
+
+
+CREDENTIAL_PREFIX = {'fob': 'F', 'passcode': 'P'}
+
+
+def load_config(path):
+    with open(path) as stream:
+        return yaml.safe_load(stream)
+
+
+def scanner_locations(config):
+    """:return: facility name -> (board url, scanner index) of the facility's entry scanner"""
+    scanners = config.get('scanners') or {}
+    locations = {}
+    for fn, fv in (config.get('facilities') or {}).items():
+        sv = scanners.get(fv['scanner'])
+        if sv is not None:
+            locations[fn] = (sv['board'], sv['scanner'])
+    return locations
+
+
+def read_activity(dbfile, config, since=None, until=None, limit=None):
+    """:return: (scans, number of rows that couldn't be mapped to a scanner)"""
+    from sqlalchemy.orm import sessionmaker
+    from models import Activity, create_activity_engine
+
+    locations = scanner_locations(config)
+    db = sessionmaker(bind=create_activity_engine(dbfile))()
+    try:
+        # only columns every version of the table has, the source database is left as it is
+        query = db.query(Activity.timestamp, Activity.facility, Activity.credentialref, Activity.result) \
+            .order_by(Activity.timestamp)
+        if since is not None:
+            query = query.filter(Activity.timestamp >= since)
+        if until is not None:
+            query = query.filter(Activity.timestamp < until)
+        if limit is not None:
+            query = query.limit(limit)
+        scans = []
+        skipped = 0
+        for a in query:
+            credential_type, _, code = (a.credentialref or "").partition(':')
+            if a.facility not in locations or credential_type not in CREDENTIAL_PREFIX or not code:
+                skipped += 1
+                continue
+            board, scanner = locations[a.facility]
+            scans.append(ReplayScan(a.timestamp.timestamp(), board, scanner, CREDENTIAL_PREFIX[credential_type],
+                                    code, a.facility, a.result))
+        return scans, skipped
+    finally:
+        db.close()
+
+
+def read_capture(path):
+    """:return: (scans, number of lines that weren't replayable packets)"""
+    scans = []
+    skipped = 0
+    with open(path) as capture:
+        for line in capture:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                at, board, packet = line.split(None, 2)
+                code, scanner = packet[1:].split(',')
+                if packet[0] not in ('F', 'P'):
+                    raise ValueError(packet)
+                scans.append(ReplayScan(float(at), board, int(scanner), packet[0], code))
+            except ValueError:
+                skipped += 1
+    return scans, skipped
+
+
+def write_replay_config(config, config_dir, workdir, scans: List[ReplayScan], refresh=False):
+    """
+    Writes door_config.yaml into workdir with every board replaced by a simulated one.
+    :return: original board url -> sim url
+    """
+    config = dict(config)
+    scanner_count = Counter()
+    relay_count = Counter()
+    for sv in (config.get('scanners') or {}).values():
+        scanner_count[sv['board']] = max(scanner_count[sv['board']], sv['scanner'])
+    for fv in (config.get('facilities') or {}).values():
+        relay_count[fv['board']] = max(relay_count[fv['board']], fv['relay'])
+    for scan in scans:
+        scanner_count[scan.board] = max(scanner_count[scan.board], scan.scanner)
+    sims = {url: f"{SCHEME}replay{n}?scanners={max(1, scanner_count[url])}&relays={max(4, relay_count[url])}"
+            for n, url in enumerate(sorted(set(scanner_count) | set(relay_count)))}
+
+    config['scanners'] = {sn: dict(sv, board=sims[sv['board']]) for sn, sv in (config.get('scanners') or {}).items()}
+    config['facilities'] = {fn: dict(fv, board=sims[fv['board']])
+                            for fn, fv in (config.get('facilities') or {}).items()}
+
+    system = dict(config['system'])
+    system['activitydb'] = 'replay-activity.db'
+    system['logfile'] = 'replay.log'
+    for key in ('email', 'mqtt_broker', 'mqtt_topic', 'mqtt_port', 'scan_capture'):
+        system.pop(key, None)
+    config['system'] = system
+
+    auth = {}
+    for plugin, pv in (config.get('auth') or {}).items():
+        pv = dict(pv)
+        if 'dbfile' in pv:
+            source = os.path.join(config_dir, pv['dbfile'])
+            copy = f"replay-{plugin}.db"
+            if os.path.exists(source):
+                shutil.copyfile(source, os.path.join(workdir, copy))
+            pv['dbfile'] = copy
+        if not refresh and 'api_key' in pv:
+            pv['api_key'] = 'replay'
+        auth[plugin] = pv
+    config['auth'] = auth
+
+    with open(os.path.join(workdir, 'door_config.yaml'), 'w') as stream:
+        yaml.safe_dump(config, stream, default_flow_style=False)
+    return sims
+
+
+def compare(scans: List[ReplayScan], decisions):
+    """
+    Lines up replayed decisions with the original ones, in order per facility and credential.
+    :return: (Counter of (original, replayed) results, list of scans whose result changed)
+    """
+    replayed = {}
+    for d in decisions:
+        replayed.setdefault((d.facility, d.credentialref), deque()).append(d.result)
+    outcomes = Counter()
+    changed = []
+    for scan in scans:
+        credential_type = 'fob' if scan.first_char == 'F' else 'passcode'
+        waiting = replayed.get((scan.facility, f"{credential_type}:{scan.code}"))
+        result = waiting.popleft() if waiting else "no decision"
+        outcomes[(scan.result, result)] += 1
+        if result != scan.result:
+            changed.append((scan, result))
+    return outcomes, changed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded scans against simulated boards")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--activity', help='activity database to replay scans from')
+    source.add_argument('--capture', help='serial capture to replay scans from')
+    parser.add_argument('--config', default='door_config.yaml', help='door configuration the scans were made with')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='only replay activity from this time on')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='only replay activity before this time')
+    parser.add_argument('--limit', type=int, help='replay at most this many scans')
+    parser.add_argument('--speed', type=float, default=1.0, help='time compression, 0 sends scans back to back')
+    parser.add_argument('--refresh', action='store_true', help="let auth plugins refresh their data over the network")
+    parser.add_argument('--show', type=int, default=20, help='changed decisions to list')
+    parser.add_argument('--workdir', help='directory for the replay configuration and databases')
+    args = parser.parse_args()
+
+    config_path = os.path.abspath(args.config)
+    config = load_config(config_path)
+    if args.activity:
+        scans, skipped = read_activity(os.path.abspath(args.activity), config, args.since, args.until, args.limit)
+    else:
+        scans, skipped = read_capture(args.capture)
+        scans = scans[:args.limit] if args.limit else scans
+    if not scans:
+        print(f"Nothing to replay, {skipped} entries skipped")
+        sys.exit(1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tcdoor-replay-")
+    os.makedirs(workdir, exist_ok=True)
+    sims = write_replay_config(config, os.path.dirname(config_path), workdir, scans, args.refresh)
+    os.chdir(workdir)
+    print(f"Replaying {len(scans)} scans ({skipped} skipped) in {workdir}")
+
+    # configuration reads door_config.yaml from the working directory when it is imported
+    logging.basicConfig(filename='replay.log', level=logging.INFO)
+    from authorization_service import AuthorizationService
+    from configuration import Config
+    from models import Activity
+
+    inqueue = Queue()
+    outqueue = Queue()
+    service = Thread(target=AuthorizationService, args=(inqueue, outqueue), name="authorization-service")
+    service.start()
+    inqueue.put(("status",))
+    outqueue.get(True, 60)  # boards are up once the service answers
+
+    started = time()
+    first = scans[0].at
+    for scan in scans:
+        if args.speed > 0:
+            wait = started + (scan.at - first) / args.speed - time()
+            if wait > 0:
+                sleep(wait)
+        sim = get_simulated(sims[scan.board])
+        if sim is not None:
+            sim.inject_scan(scan.code, scan.scanner, scan.first_char)
+    sent = time() - started
+
+    # wait for the decisions to stop coming in
+    db = Config.ScopedSession()
+    count, settled = -1, time()
+    while time() - settled < 2.0 and time() - started < sent + 60.0:
+        sleep(0.25)
+        now_count = db.query(Activity).count()
+        if now_count != count:
+            count, settled = now_count, time()
+    decisions = db.query(Activity).order_by(Activity.timestamp).all()
+    db.close()
+    inqueue.put(("status",))
+    status = outqueue.get(True, 30)
+    inqueue.put(("shutdown",))
+    outqueue.get(True, 30)
+    service.join()
+
+    latency = RollingPercentiles(window=max(1, len(decisions)))
+    for d in decisions:
+        if d.latency is not None:
+            latency.add(d.latency / 1000.0)
+    elapsed = (max(d.timestamp for d in decisions).timestamp() - started) if decisions else sent
+    print(f"{len(scans)} scans sent in {sent:.1f}s ({len(scans) / max(sent, 1e-6):.1f}/s), "
+          f"{len(decisions)} decisions in {elapsed:.1f}s ({len(decisions) / max(elapsed, 1e-6):.1f}/s)")
+    print(f"results: " + ", ".join(f"{n} {r}" for r, n in Counter(d.result for d in decisions).most_common()))
+    print(f"decision latency: {format_ms(latency.snapshot())}")
+    relay = status.get("traces", {}).get("stages", {}).get("relay")
+    if relay:
+        print(f"relay round trip: {format_ms(relay)}")
+    absorbed = sum(status.get("debounce", {}).get("absorbed", {}).values())
+    if absorbed:
+        print(f"{absorbed} repeated scans absorbed by debouncing")
+
+    if args.activity:
+        outcomes, changed = compare(scans, decisions)
+        print("original -> replayed:")
+        for (original, replayed), n in sorted(outcomes.items(), key=lambda o: -o[1]):
+            print(f"  {original:>8} -> {replayed:<12} {n}")
+        for scan, result in changed[:args.show]:
+            print(f"  {datetime.fromtimestamp(scan.at)} {scan.facility} "
+                  f"{'fob' if scan.first_char == 'F' else 'passcode'}:{scan.code} {scan.result} -> {result}")
+        if len(changed) > args.show:
+            print(f"  ... {len(changed) - args.show} more")
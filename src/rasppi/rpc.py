@@ -0,0 +1,100 @@
+import itertools
+import logging
+from queue import Empty
+from threading import Event, Lock, Thread
+from time import time
+from typing import Dict
+
+from metrics import RollingPercentiles
+
+logger = logging.getLogger("rpc")
+
+# Tag for requests that expect a correlated reply, ('rpc', request id, (command, args...))
+RPC = 'rpc'
+
+
+class RpcTimeout(Empty):
+    """The service didn't answer within the call's timeout"""
+
+
+class _PendingCall():
+    __slots__ = ('done', 'response', 'sent')
+
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+        self.sent = time()
+
+
+class RpcClient():
+    """
+    Calls into the AuthorizationService over its command and reply queues.
+
+    Every call carries a request id that the service sends back with its reply, and a dispatcher
+    thread hands each reply to the call waiting on that id. Any number of calls can be in flight
+    from different threads, and a reply that arrives after its call gave up is counted and dropped
+    instead of being picked up by the next caller.
+    """
+
+    def __init__(self, requests, replies):
+        self._requests = requests
+        self._replies = replies
+        self._pending: Dict[int, _PendingCall] = {}
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+        self._thread = None
+        self.latency = RollingPercentiles()
+        self.calls = 0
+        self.timeouts = 0
+        self.late = 0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._dispatch, name="rpc-dispatcher", daemon=True)
+            self._thread.start()
+
+    def call(self, command, *args, timeout=5.0):
+        """
+        Sends command to the service and waits for its reply.
+        :raises RpcTimeout: no reply within timeout seconds
+        """
+        call = _PendingCall()
+        with self._lock:
+            self._ensure_started()
+            request_id = next(self._ids)
+            self._pending[request_id] = call
+            self.calls += 1
+        self._requests.put((RPC, request_id, (command,) + args))
+        if not call.done.wait(timeout):
+            with self._lock:
+                unanswered = self._pending.pop(request_id, None) is not None
+                if unanswered:
+                    self.timeouts += 1
+            if unanswered:
+                raise RpcTimeout(f"No reply to {command} within {timeout}s")
+            # the dispatcher claimed the reply just as the wait ran out
+            call.done.wait()
+        return call.response
+
+    def _dispatch(self):
+        while True:
+            reply = self._replies.get()
+            # a bare string would unpack too, 'OK' as request 'O'
+            if not (isinstance(reply, tuple) and len(reply) == 2):
+                logger.warning(f"Dropped a reply without a request id: {reply!r:.100}")
+                continue
+            request_id, response = reply
+            with self._lock:
+                call = self._pending.pop(request_id, None)
+                if call is None:
+                    self.late += 1
+                    continue
+            call.response = response
+            self.latency.add(time() - call.sent)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._pending)
+        return {"calls": self.calls, "in_flight": in_flight, "timeouts": self.timeouts, "late": self.late,
+                "latency": self.latency.snapshot()}
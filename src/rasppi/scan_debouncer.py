@@ -0,0 +1,96 @@
+from threading import Lock
+from time import time
+from typing import Dict
+
+
+class HeldScan():
+    __slots__ = ('first_seen', 'last_seen', 'absorbed', 'facility')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.absorbed = 0
+        self.facility = None  # set once the scan is granted
+
+
+class ScanDebouncer():
+    """
+    Collapses repeats of the same scan on one scanner into a single decision.
+
+    A scan is a repeat if the same credential was read on the same scanner less than the scanner's
+    debounce window after the scan that was decided. Once that scan is granted the window slides
+    with every repeat, so a fob held against the reader stays one unlock for as long as it is held.
+    Repeats of a denied or undecided scan don't move the window, so someone who keeps tapping is
+    decided again once per window and a fixed membership is picked up.
+    """
+
+    PURGE_EVERY = 256
+    # a fob left against the reader stops extending the unlock this long after it was granted
+    MAX_HOLD = 30.0
+
+    def __init__(self):
+        self._held: Dict[tuple, HeldScan] = {}
+        self._lock = Lock()
+        self._calls = 0
+        self.absorbed: Dict[str, int] = {}
+        self.extended = 0
+        self.capped = 0
+
+    def seen(self, key, window, scanner_name):
+        """
+        :return: the HeldScan key is a repeat of, None if it is a new scan that needs a decision
+        """
+        now = time()
+        with self._lock:
+            self._calls += 1
+            if self._calls % self.PURGE_EVERY == 0:
+                self._purge(now, window)
+            held = self._held.get(key)
+            if held is not None and now - (held.first_seen if held.facility is None else held.last_seen) < window:
+                held.last_seen = now
+                held.absorbed += 1
+                self.absorbed[scanner_name] = self.absorbed.get(scanner_name, 0) + 1
+                return held
+            if window > 0:
+                self._held[key] = HeldScan(now)
+            return None
+
+    def granted(self, key, facility):
+        """Marks the scan for key as granted, its repeats will extend the unlock"""
+        with self._lock:
+            held = self._held.get(key)
+            if held is not None:
+                held.facility = facility
+
+    def can_extend(self, held: HeldScan) -> bool:
+        """:return: whether a repeat of held should keep its door open"""
+        if held.facility is None:
+            return False
+        if time() - held.first_seen >= self.MAX_HOLD:
+            with self._lock:
+                self.capped += 1
+            return False
+        return True
+
+    def restart(self, key):
+        """Starts a new window for key, for a repeat that has to be decided again"""
+        with self._lock:
+            self._held[key] = HeldScan(time())
+
+    def forget(self, key):
+        with self._lock:
+            self._held.pop(key, None)
+
+    def _purge(self, now, window):
+        # windows are per scanner, anything idle this long is well past any of them
+        horizon = max(window, 60.0)
+        for key in [k for k, h in self._held.items() if now - h.last_seen >= horizon]:
+            del self._held[key]
+
+    def stats(self):
+        with self._lock:
+            return {"held": len(self._held),
+                    "absorbed": dict(self.absorbed),
+                    "extended": self.extended,
+                    "capped": self.capped,
+                    "max_hold": self.MAX_HOLD}
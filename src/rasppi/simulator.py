@@ -0,0 +1,267 @@
+import logging
+import random
+from threading import Condition, Event, Lock, Thread, Timer
+from time import sleep, time
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger("simulator")
+
+MODEL = "TCM-ACCX"
+VERSION = "0.03"
+SCHEME = "sim://"
+
+_registry: Dict[str, 'SimulatedFtdi'] = {}
+_registryLock = Lock()
+
+
+def get_simulated(url):
+    """:return: the SimulatedFtdi that was opened with url, or None"""
+    with _registryLock:
+        return _registry.get(url)
+
+
+def is_simulated(url):
+    return url.startswith(SCHEME)
+
+
+class SimulatedFtdi():
+    """
+    Stands in for a pyftdi Ftdi object connected to an ACCX board running door_firmware.cpp, see
+    src/arduino/commandline.md for the protocol. Bytes written by the host are interpreted as
+    firmware commands, replies and scans are queued for the host to read back.
+
+    Opened through a url such as sim://frontdoor?scanners=2&relays=4&delay=0.05&boot=0.5, where
+    delay is how long the board takes to answer a command and boot how long it takes to print its
+    banner after a reset.
+    """
+
+    def __init__(self, num_scanners=2, num_relays=4, reply_delay=0.0, boot_delay=0.0):
+        self.num_scanners = num_scanners
+        self.num_relays = num_relays
+        self.reply_delay = reply_delay
+        self.boot_delay = boot_delay
+        self.relays = {}
+        self.url = None
+        self.latency = 16
+        self.timeouts = (5000, 5000)
+        self.command_callback = None
+        self._cond = Condition()
+        self._outgoing = bytearray()
+        self._input = bytearray()
+        self._echo = True
+        self._dtr = True
+        self._closed = False
+
+    def open_from_url(self, url):
+        self.url = url
+        params = parse_qs(urlparse(url).query)
+        if 'scanners' in params:
+            self.num_scanners = int(params['scanners'][0])
+        if 'relays' in params:
+            self.num_relays = int(params['relays'][0])
+        if 'delay' in params:
+            self.reply_delay = float(params['delay'][0])
+        if 'boot' in params:
+            self.boot_delay = float(params['boot'][0])
+        with _registryLock:
+            _registry[url] = self
+
+    def set_baudrate(self, baudrate):
+        pass
+
+    def set_latency_timer(self, latency):
+        self.latency = latency
+
+    def set_dtr(self, state):
+        if state and not self._dtr:
+            self._reset()
+        self._dtr = state
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        with _registryLock:
+            if _registry.get(self.url) is self:
+                del _registry[self.url]
+
+    def _reset(self):
+        with self._cond:
+            self._outgoing.clear()
+            self._input.clear()
+            self._echo = True
+            self.relays = {r + 1: False for r in range(self.num_relays)}
+        if self.boot_delay > 0:
+            boot = Timer(self.boot_delay, self._banner)
+            boot.daemon = True
+            boot.start()
+        else:
+            self._banner()
+
+    def _banner(self):
+        if self._closed:
+            return
+        self._println("Firmware version " + VERSION)
+        self._println("Num commands: 6")
+        self._println("Ready. Enter ? for help")
+
+    def _emit(self, data: bytes):
+        with self._cond:
+            self._outgoing.extend(data)
+            self._cond.notify_all()
+
+    def _println(self, line: str):
+        self._emit(f"{line}\r\n".encode("utf-8"))
+
+    def inject_scan(self, code, scanner=1, first_char='F'):
+        """Simulates a fob read or passcode entry, returns the time the packet left the board"""
+        sent = time()
+        self._println(f"{first_char}{code},{scanner}")
+        return sent
+
+    def write_data(self, data):
+        for b in bytes(data):
+            if self._echo:
+                self._emit(bytes([b]))
+            if b != 0x0D:
+                self._input.append(b)
+                if len(self._input) == 20:
+                    self._println(f"G{self._input.decode('utf-8', 'replace')}")
+                    self._input.clear()
+            else:
+                if self._echo:
+                    self._emit(b"\n")
+                line = self._input.decode("utf-8", "replace")
+                self._input.clear()
+                if self.reply_delay > 0:
+                    Timer(self.reply_delay, self._command, args=(line,)).start()
+                else:
+                    self._command(line)
+        return len(data)
+
+    def _relay_arg(self, args):
+        if len(args) == 1 and args.isdigit() and 1 <= int(args) <= self.num_relays:
+            return int(args)
+        return None
+
+    def _command(self, line: str):
+        if len(line) == 0:
+            self._println("G")
+            return
+        c, args = line[0], line[1:]
+        if self.command_callback is not None:
+            self.command_callback(self, c, args)
+        if c == '?':
+            self._println("Help:")
+            for code, text in (('?', "show this help"), ('e', "configure echo: 0=off, 1=on"),
+                               ('i', "get device info"), ('o', "open relay: relay num"),
+                               ('c', "close relay: relay num"), ('q', "query relay: relay num")):
+                self._println(f"\t{code} : {text}")
+        elif c == 'e' and len(args) == 1:
+            self._echo = args == '1'
+            self._println(f"E{1 if self._echo else 0}")
+        elif c == 'i':
+            self._println(f"Im:{MODEL},v:{VERSION},s:{self.num_scanners},r:{self.num_relays}")
+        elif c in ('o', 'c') and self._relay_arg(args) is not None:
+            self.relays[int(args)] = c == 'c'
+            self._println(f"{c.upper()}{args}")
+        elif c == 'q' and self._relay_arg(args) is not None:
+            self._println(f"Q{args},{1 if self.relays[int(args)] else 0}")
+        else:
+            self._println(f"G{line}")
+
+    def read_data_bytes(self, size, attempt=1):
+        """
+        Returns whatever is buffered, waiting up to one latency period for data to show up. Like the
+        chip's status-only packets, an idle board comes back empty once every latency period.
+        """
+        with self._cond:
+            if not self._outgoing and not self._closed:
+                self._cond.wait(self.latency / 1000.0)
+            data = self._outgoing[:size]
+            del self._outgoing[:size]
+        return data
+
+
+class ScanGenerator():
+    """
+    Generates scans across a set of simulated boards.
+
+    :param urls: sim:// urls of the boards to scan on, they must already be open
+    :param rate: average scans per second across all boards
+    :param credentials: list of (first_char, code) to pick from, 'F' for fobs and 'P' for passcodes
+    :param pattern: "poisson" for independent scans, "burst" for groups of scans arriving together
+                    (a class letting out), "hold" for a fob held against the reader, which repeats
+                    the same scan a few times in quick succession
+    :param callback: called with (url, scanner, first_char, code, sent time) for every scan
+    """
+
+    PATTERNS = ("poisson", "burst", "hold")
+
+    def __init__(self, urls: List[str], rate: float, credentials, pattern="poisson", callback=None):
+        if pattern not in self.PATTERNS:
+            raise ValueError(f"Unknown scan pattern {pattern}")
+        self.urls = urls
+        self.rate = rate
+        self.credentials = credentials
+        self.pattern = pattern
+        self.callback = callback
+        self.sent = 0
+        self._stop = Event()
+        self._thread = None
+
+    def _scan(self, url, scanner, first_char, code):
+        sim = get_simulated(url)
+        if sim is None:
+            return
+        sent = sim.inject_scan(code, scanner, first_char)
+        self.sent += 1
+        if self.callback is not None:
+            self.callback(url, scanner, first_char, code, sent)
+
+    def _event(self):
+        url = random.choice(self.urls)
+        sim = get_simulated(url)
+        scanner = random.randint(1, sim.num_scanners if sim is not None else 1)
+        first_char, code = random.choice(self.credentials)
+        if self.pattern == "poisson":
+            self._scan(url, scanner, first_char, code)
+            return 1
+        elif self.pattern == "hold":
+            repeats = random.randint(2, 5)
+            for r in range(repeats):
+                self._scan(url, scanner, first_char, code)
+                sleep(0.08)
+            return repeats
+        else:
+            burst = random.randint(3, 10)
+            for b in range(burst):
+                first_char, code = random.choice(self.credentials)
+                self._scan(url, scanner, first_char, code)
+                sleep(random.uniform(0.2, 1.0))
+            return burst
+
+    def run(self, count=None, duration=None):
+        """Generates scans until count scans or duration seconds, whichever comes first"""
+        end = time() + duration if duration is not None else None
+        while not self._stop.is_set():
+            if count is not None and self.sent >= count:
+                break
+            if end is not None and time() >= end:
+                break
+            started = time()
+            scans = self._event()
+            # keep the long run average at rate scans per second
+            wait = random.expovariate(self.rate / scans) - (time() - started)
+            if wait > 0:
+                self._stop.wait(wait)
+
+    def start(self, count=None, duration=None):
+        self._thread = Thread(target=self.run, args=(count, duration), name="scan-generator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
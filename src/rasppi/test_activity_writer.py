@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from threading import Event
+from sqlalchemy import create_engine
+from activity_writer import ActivityWriter
+from models import Activity, migrate_activity_db
+
+
+class GatedEngine():
+    """Holds every commit until the gate opens, like an SD card stalled on a write"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.gate = Event()
+        self.waiting = Event()
+
+    def begin(self):
+        self.waiting.set()
+        self.gate.wait(5.0)
+        return self.engine.begin()
+
+
+def activity(n):
+    return Activity(facility="door", memberid=str(n), result="granted", timestamp=datetime.now(), notified=False)
+
+
+class TestActivityWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.directory.name, 'activity.db')}")
+        migrate_activity_db(self.engine)
+
+    def rows(self):
+        with self.engine.connect() as conn:
+            return [r[0] for r in conn.execute(Activity.__table__.select()
+                                               .with_only_columns([Activity.__table__.c.memberid])
+                                               .order_by(Activity.__table__.c.id))]
+
+    def testRowsArriveInGroups(self):
+        writer = ActivityWriter(self.engine, interval=0.5, batch_size=4)
+        for n in range(10):
+            self.assertTrue(writer.add(activity(n)))
+        writer.shutdown()
+        self.assertEqual(self.rows(), [str(n) for n in range(10)])
+        # two full groups, the rest is committed by shutdown
+        self.assertEqual(writer.stats()["batch_size"]["count"], 3)
+        self.assertEqual(writer.stats()["batch_size"]["mean"], 10 / 3)
+
+    def testBackedUpWriterDropsInsteadOfBlocking(self):
+        engine = GatedEngine(self.engine)
+        writer = ActivityWriter(engine, interval=0.0, batch_size=1, queue_size=2)
+        self.assertTrue(writer.add(activity(0)))
+        self.assertTrue(engine.waiting.wait(1.0))  # the writer is stuck committing the first row
+        self.assertTrue(writer.add(activity(1)))
+        self.assertTrue(writer.add(activity(2)))
+        with self.assertLogs("auth", "ERROR"):
+            self.assertFalse(writer.add(activity(3)))
+        self.assertEqual(writer.stats()["dropped"], 1)
+
+        engine.gate.set()
+        writer.shutdown()
+        self.assertEqual(self.rows(), ["0", "1", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from threading import Event
+from time import sleep, time
+from auth_fanout import AuthFanout
+
+
+class FakeModule():
+    def __init__(self, name, grant, delay=0.0):
+        self.__module__ = name
+        self.grant = grant
+        self.delay = delay
+        self.answered = Event()
+
+    def on_scan(self, credential_type, credential_value, scanner, facility, now_time):
+        sleep(self.delay)
+        self.answered.set()
+        return (self.grant, f"member-{self.__module__}", f"{self.__module__}:auth", None, None)
+
+
+class TestAuthFanout(unittest.TestCase):
+
+    def decide(self, fanout, modules):
+        return fanout.decide(modules, "fob", "1234", None, None, None)
+
+    def testHigherPriorityGrantWins(self):
+        fanout = AuthFanout(deadline=1.0)
+        winner, results = self.decide(fanout, [FakeModule("high", True, 0.05), FakeModule("low", True)])
+        self.assertEqual(winner.__module__, "high")
+        self.assertEqual(results["high"][1], "member-high")
+        fanout.shutdown()
+
+    def testLowerPriorityGrantWaitsForHigherDenial(self):
+        fanout = AuthFanout(deadline=1.0)
+        winner, results = self.decide(fanout, [FakeModule("high", False, 0.05), FakeModule("low", True)])
+        self.assertEqual(winner.__module__, "low")
+        self.assertFalse(results["high"][0])
+        fanout.shutdown()
+
+    def testModulesRunConcurrently(self):
+        fanout = AuthFanout(deadline=1.0)
+        start = time()
+        winner, results = self.decide(fanout, [FakeModule(f"m{n}", False, 0.1) for n in range(4)])
+        self.assertIsNone(winner)
+        self.assertEqual(len(results), 4)
+        self.assertLess(time() - start, 0.3)
+        fanout.shutdown()
+
+    def testSlowModuleMissesDeadline(self):
+        fanout = AuthFanout(deadline=0.05)
+        slow = FakeModule("slow", True, 0.2)
+        start = time()
+        winner, results = self.decide(fanout, [slow, FakeModule("fast", True)])
+        self.assertLess(time() - start, 0.15)
+        self.assertEqual(winner.__module__, "fast")
+        self.assertNotIn("slow", results)
+        self.assertTrue(slow.answered.wait(1.0))
+        sleep(0.01)
+        stats = fanout.stats()
+        self.assertEqual(stats["modules"]["slow"]["timeouts"], 1)
+        self.assertEqual(stats["late"][0]["module"], "slow")
+        self.assertTrue(stats["late"][0]["grant"])
+        fanout.shutdown()
+
+    def testFailingModuleIsSkipped(self):
+        fanout = AuthFanout(deadline=1.0)
+        broken = FakeModule("broken", True)
+        broken.on_scan = None
+        winner, results = self.decide(fanout, [broken, FakeModule("ok", True)])
+        self.assertEqual(winner.__module__, "ok")
+        self.assertEqual(fanout.stats()["modules"]["broken"]["errors"], 1)
+        fanout.shutdown()
+
+    def testMalformedResultIsSkipped(self):
+        fanout = AuthFanout(deadline=1.0)
+        silent = FakeModule("silent", True)
+        silent.on_scan = lambda *args: None
+        raising = FakeModule("raising", True)
+
+        def fail(*args):
+            raise ValueError("backend down")
+        raising.on_scan = fail
+        winner, results = self.decide(fanout, [silent, raising, FakeModule("ok", True)])
+        self.assertEqual(winner.__module__, "ok")
+        self.assertEqual(set(results), {"ok"})
+        stats = fanout.stats()["modules"]
+        self.assertEqual((stats["silent"]["errors"], stats["raising"]["errors"]), (1, 1))
+        fanout.shutdown()
+
+    def testShortResultsArePadded(self):
+        fanout = AuthFanout(deadline=1.0)
+        basic = FakeModule("basic", True)
+        basic.on_scan = lambda *args: (True, "member-basic", "basic:auth")
+        winner, results = self.decide(fanout, [basic])
+        self.assertEqual(winner.__module__, "basic")
+        (grant, member, auth, expiration, last_update) = results["basic"]
+        self.assertEqual((grant, member, auth, expiration, last_update), (True, "member-basic", "basic:auth", None, None))
+        fanout.shutdown()
+
+    def testStuckModuleIsSkippedUntilItAnswers(self):
+        fanout = AuthFanout(workers=2, deadline=0.05)
+        release = Event()
+        hung = FakeModule("hung", True)
+        hung.on_scan = lambda *args: release.wait(5.0) and (False, None, "hung:auth", None, None)
+        for n in range(5):
+            winner, results = self.decide(fanout, [hung, FakeModule("ok", True)])
+            self.assertEqual(winner.__module__, "ok")
+        stats = fanout.stats()["modules"]["hung"]
+        self.assertEqual((stats["timeouts"], stats["stuck"], stats["skipped"]), (1, 1, 4))
+        release.set()
+        sleep(0.05)
+        self.assertEqual(fanout.stats()["modules"]["hung"]["stuck"], 0)
+        self.decide(fanout, [hung, FakeModule("ok", True)])
+        self.assertEqual(fanout.stats()["modules"]["hung"]["latency"]["count"], 2)
+        fanout.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
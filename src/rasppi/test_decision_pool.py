@@ -0,0 +1,56 @@
+import unittest
+from threading import Event
+from time import time
+from decision_pool import DecisionPool
+
+
+class TestDecisionPool(unittest.TestCase):
+
+    def testShutdownDoesNotBlockOnAFullQueue(self):
+        pool = DecisionPool(workers=1, queue_depth=2)
+        gate = Event()
+        started = Event()
+        decided = []
+        pool.submit("door", lambda: (started.set(), gate.wait(5.0)))
+        self.assertTrue(started.wait(1.0))
+        for n in range(2):
+            self.assertTrue(pool.submit("door", decided.append, n))
+        self.assertFalse(pool.submit("door", decided.append, 2))
+
+        start = time()
+        pool.shutdown(wait=False)
+        self.assertLess(time() - start, 0.1)
+        gate.set()
+        pool._threads[0].join(1.0)
+        self.assertFalse(pool._threads[0].is_alive())
+        self.assertEqual(decided, [0, 1])
+
+    def testDrainWaitsForQueuedDecisions(self):
+        pool = DecisionPool(workers=2)
+        self.addCleanup(pool.shutdown)
+        gate = Event()
+        decided = []
+        pool.submit("door", lambda: (gate.wait(5.0), decided.append("slow")))
+        pool.submit("door", decided.append, "queued")
+        self.assertFalse(pool.drain(timeout=0.1))
+        gate.set()
+        self.assertTrue(pool.drain(timeout=1.0))
+        self.assertEqual(decided, ["slow", "queued"])
+
+    def testDrainOfAStoppingPool(self):
+        pool = DecisionPool(workers=1)
+        gate = Event()
+        pool.submit("door", gate.wait, 5.0)
+        pool.shutdown(wait=False)
+        self.assertFalse(pool.drain(timeout=0.1))
+        gate.set()
+        self.assertTrue(pool.drain(timeout=1.0))
+
+    def testIdleWorkersStop(self):
+        pool = DecisionPool(workers=2)
+        pool.shutdown()
+        self.assertFalse(any(t.is_alive() for t in pool._threads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from framing import PacketFramer
+
+
+class TestPacketFramer(unittest.TestCase):
+
+    def testWholePackets(self):
+        framer = PacketFramer()
+        self.assertEqual(framer.feed(b"F15408774,1\r\nC1\r\n"), [('F', "15408774,1"), ('C', "1")])
+
+    def testPartialPackets(self):
+        framer = PacketFramer()
+        self.assertEqual(framer.feed(b"F1540"), [])
+        self.assertEqual(framer.feed(b"8774,2\r"), [])
+        self.assertEqual(framer.feed(b"\nO"), [('F', "15408774,2")])
+        self.assertEqual(framer.feed(b"3\r\n"), [('O', "3")])
+
+    def testCarriageWithoutNewline(self):
+        framer = PacketFramer()
+        self.assertEqual(framer.feed(b"F123\rP4455661,1\r\n"), [('P', "4455661,1")])
+        self.assertEqual(framer.framing_errors, 1)
+
+    def testEmptyLinesIgnored(self):
+        framer = PacketFramer()
+        self.assertEqual(framer.feed(b"\r\n\r\nE0\r\n"), [('E', "0")])
+
+    def testRunawayBufferDiscarded(self):
+        framer = PacketFramer()
+        framer.feed(b"x" * 1000)
+        self.assertEqual(framer.framing_errors, 1)
+        self.assertEqual(framer.feed(b"C2\r\n"), [('C', "2")])
+
+
+if __name__ == '__main__':
+    unittest.main()
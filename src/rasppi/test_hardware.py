@@ -0,0 +1,223 @@
+import threading
+import unittest
+from threading import Event
+from time import sleep, time
+
+import hardware
+from hardware import CommandTimeout, ReaderBoard
+from simulator import SimulatedFtdi
+
+
+class StatusPacketFtdi(SimulatedFtdi):
+    """A board whose chip answers every idle read with a status-only packet, which pyftdi returns empty"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.reads = 0
+
+    def read_data_bytes(self, size, attempt=1):
+        self.reads += 1
+        return super().read_data_bytes(size, attempt)
+
+
+class HoldingFtdi(SimulatedFtdi):
+    """A board that sits on commands starting with one of the held letters until the test answers them"""
+
+    def __init__(self, held="oc", **kwargs):
+        super().__init__(**kwargs)
+        self.held = held
+        self.waiting = []
+        self.broken = False
+
+    def _command(self, line):
+        if line[:1] in tuple(self.held):
+            self.waiting.append(line)
+        else:
+            super()._command(line)
+
+    def answer(self, line):
+        self.waiting.remove(line)
+        super()._command(line)
+
+    def write_data(self, data):
+        if self.broken:
+            raise OSError("usb write failed")
+        return super().write_data(data)
+
+
+class TestReadWake(unittest.TestCase):
+
+    def testIdleBoardWakesOncePerReadTimeout(self):
+        ftdi = StatusPacketFtdi()
+        board = ReaderBoard("sim://idle", ftdi=ftdi)
+        self.addCleanup(board.shutdown)
+        wakes, reads = board.emptyWakes, ftdi.reads
+        sleep(0.5)
+        # the chip's status packets come every READ_LATENCY_MS, none of them should wake the parser
+        self.assertGreater(ftdi.reads - reads, 50)
+        self.assertLessEqual(board.emptyWakes - wakes, 0.5 / (hardware.READ_TIMEOUT_MS / 1000.0) + 2)
+
+    def testDataEndsTheWaitEarly(self):
+        ftdi = StatusPacketFtdi()
+        board = ReaderBoard("sim://idle", ftdi=ftdi)
+        self.addCleanup(board.shutdown)
+        arrived = Event()
+        board.packetCallback = lambda first_char, body, device: arrived.set()
+        sleep(0.02)
+        sent = ftdi.inject_scan("1234")
+        self.assertTrue(arrived.wait(1.0))
+        self.assertLess(time() - sent, hardware.READ_TIMEOUT_MS / 1000.0 / 2)
+
+
+class TestReaderBoardStartup(unittest.TestCase):
+
+    def setUp(self):
+        timeout = hardware.STARTUP_TIMEOUT
+        hardware.STARTUP_TIMEOUT = 0.3
+        self.addCleanup(setattr, hardware, "STARTUP_TIMEOUT", timeout)
+
+    def testBoardWithoutBannerIsReleased(self):
+        silent = SimulatedFtdi(boot_delay=60)
+        with self.assertRaises(RuntimeError):
+            ReaderBoard("sim://slowboot", ftdi=silent)
+        self.assertTrue(silent._closed)
+        self.assertNotIn("board sim://slowboot", [t.name for t in threading.enumerate()])
+
+        board = ReaderBoard("sim://slowboot", ftdi=SimulatedFtdi(boot_delay=0.05))
+        self.assertEqual(board.numRelays, 4)
+        threads = [t for t in threading.enumerate() if t.name == "board sim://slowboot"]
+        self.assertEqual(len(threads), 1)
+        board.shutdown()
+
+
+class TestCommands(unittest.TestCase):
+
+    def board(self, ftdi):
+        board = ReaderBoard("sim://commands", ftdi=ftdi)
+        self.addCleanup(board.shutdown)
+        return board
+
+    def testRepliesFindTheirCommandOutOfOrder(self):
+        ftdi = HoldingFtdi()
+        board = self.board(ftdi)
+        futures = {line: board.send_command_async(line[0], line[1:]) for line in ("o1", "o2", "c1", "o3")}
+        for line in ("o3", "c1", "o1", "o2"):
+            ftdi.answer(line)
+        self.assertEqual({line: f.result(1.0) for line, f in futures.items()},
+                         {"o1": "1", "o2": "2", "c1": "1", "o3": "3"})
+        self.assertEqual(board.commandRtt["o"].snapshot()["count"], 3)
+        self.assertFalse(any(board._pending.values()))
+
+    def testRejectedCommandFails(self):
+        board = self.board(HoldingFtdi(held=""))
+        with self.assertRaises(ValueError):
+            board.send_command_async('o', '9').result(1.0)
+
+    def testUnansweredCommandTimesOut(self):
+        ftdi = HoldingFtdi()
+        board = self.board(ftdi)
+        packets = []
+        board.packetCallback = lambda first_char, body, device: packets.append(first_char + body)
+        slow = board.send_command_async('o', '1', timeout=0.2)
+        fast = board.send_command_async('o', '2', timeout=5.0)
+        self.assertIsInstance(slow.exception(2.0), CommandTimeout)
+        self.assertFalse(fast.done())
+        self.assertEqual(board.commandTimeouts, {'o': 1})
+
+        # the late reply isn't taken for the command still waiting on another relay
+        ftdi.answer("o1")
+        ftdi.answer("o2")
+        self.assertEqual(fast.result(1.0), "2")
+        deadline = time() + 1.0
+        while not packets and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(packets, ["O1"])
+
+    def testCommandsInFlightAreLimited(self):
+        ftdi = HoldingFtdi()
+        board = self.board(ftdi)
+        waiting = [board.send_command_async('o', '1') for n in range(hardware.MAX_COMMANDS_IN_FLIGHT)]
+        with self.assertRaises(CommandTimeout):
+            board.send_command_async('o', '2', timeout=0.1).result(1.0)
+        ftdi.answer("o1")
+        self.assertEqual(waiting[0].result(1.0), "1")
+        queued = board.send_command_async('o', '2', timeout=1.0)
+        ftdi.answer("o2")
+        self.assertEqual(queued.result(1.0), "2")
+
+    def testFailedWriteGivesUpItsSlot(self):
+        ftdi = HoldingFtdi()
+        board = self.board(ftdi)
+        ftdi.broken = True
+        for n in range(hardware.MAX_COMMANDS_IN_FLIGHT + 1):
+            self.assertIsInstance(board.send_command_async('o', '1', timeout=0.1).exception(1.0), OSError)
+        self.assertFalse(any(board._pending.values()))
+
+    def testShutdownFailsPendingCommands(self):
+        ftdi = HoldingFtdi()
+        board = ReaderBoard("sim://commands", ftdi=ftdi)
+        futures = [board.send_command_async('o', str(relay)) for relay in (1, 2, 3)]
+        start = time()
+        board.shutdown()
+        for future in futures:
+            self.assertIsInstance(future.exception(1.0), RuntimeError)
+        self.assertLess(time() - start, 1.0)
+        self.assertEqual(board._pending, {})
+        self.assertIsInstance(board.send_command_async('o', '1').exception(0), RuntimeError)
+
+
+class TestRelays(unittest.TestCase):
+
+    def testShortUnlockClosesBeforeItOpens(self):
+        ftdi = SimulatedFtdi()
+        board = ReaderBoard("sim://relays", ftdi=ftdi)
+        self.addCleanup(board.shutdown)
+        commands = []
+        ftdi.command_callback = lambda sim, c, args: commands.append(c + args)
+        for n in range(20):
+            board.Unlock(1, 0).result(1.0)
+            deadline = time() + 1.0
+            while len(commands) < 2 * (n + 1) and time() < deadline:
+                sleep(0.001)
+        self.assertEqual(commands, ["c1", "o1"] * 20)
+        self.assertFalse(ftdi.relays[1])
+
+    def testRelaysOutsideTheBoardAreRejected(self):
+        board = ReaderBoard("sim://relays")
+        self.addCleanup(board.shutdown)
+        for relay in (0, -1, board.numRelays + 1):
+            self.assertIsNone(board.Unlock(relay, 1.0))
+            self.assertFalse(board.ExtendUnlock(relay, 1.0))
+            board.Lock(relay)
+        self.assertEqual(board.relaystatus.get(0), None)
+        self.assertEqual(board.relaystatus.get(-1), None)
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        list_urls = hardware.list_device_urls
+        hardware.list_device_urls = lambda: [("sim://probe-a", "A"), ("sim://probe-b", "B"), ("sim://probe-c", "C")]
+        self.addCleanup(setattr, hardware, "list_device_urls", list_urls)
+        hardware._discoveryCache.clear()
+        self.addCleanup(hardware._discoveryCache.clear)
+
+    def testBusyUrlsAreNotProbed(self):
+        board = ReaderBoard("sim://probe-a")
+        self.addCleanup(board.shutdown)
+        found = hardware.query_devices([board], timeout=5.0, ignored_urls={"sim://probe-b"})
+        self.assertEqual([d.split(" - ")[0] for d in found], ["sim://probe-c"])
+
+    def testDeviceIsOnlyOpenedOnce(self):
+        board = ReaderBoard("sim://probe-a")
+        with self.assertRaises(RuntimeError):
+            ReaderBoard("sim://probe-a")
+        # a probe that races a reconnect fails instead of resetting the board under it
+        self.assertEqual(hardware.query_devices(None, timeout=5.0, ignored_urls={"sim://probe-b", "sim://probe-c"}), [])
+        board.shutdown()
+        self.assertEqual(len(hardware.query_devices(None, timeout=5.0, ignored_urls={"sim://probe-b",
+                                                                                     "sim://probe-c"})), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import unittest
+from auth.json_stream import iter_json_array
+
+
+def pieces(data: bytes, size):
+    return (data[n:n + size] for n in range(0, len(data), size))
+
+
+class TestJsonStream(unittest.TestCase):
+
+    document = {"ResultType": "Contacts", "Info": {"nested": [1, {"Contacts": "not this one"}]},
+                "Contacts": [{"Id": 1, "Name": "Zoë Ångström", "FieldValues": [{"FieldName": "Key Fob", "Value": "123"}]},
+                             {"Id": 2, "Name": "Bob", "Balance": 12.5, "Archived": False},
+                             3, "four", None, [5, 6], 1234567890],
+                "After": {"x": [1, 2, 3]}}
+
+    def testEveryChunkSize(self):
+        data = json.dumps(self.document, indent=1, ensure_ascii=False).encode("utf-8")
+        for size in (1, 2, 3, 7, 64, len(data)):
+            self.assertEqual(list(iter_json_array(pieces(data, size), "Contacts")), self.document["Contacts"],
+                             f"chunk size {size}")
+
+    def testElementsArriveBeforeTheEnd(self):
+        data = json.dumps({"Contacts": [{"Id": n} for n in range(100)]}).encode("utf-8")
+        read = []
+
+        def chunks():
+            for chunk in pieces(data, 16):
+                read.append(len(chunk))
+                yield chunk
+
+        contacts = iter_json_array(chunks(), "Contacts")
+        self.assertEqual(next(contacts), {"Id": 0})
+        self.assertLess(sum(read), 64)
+
+    def testMissingOrEmpty(self):
+        self.assertEqual(list(iter_json_array([b'{"Contacts": []}'], "Contacts")), [])
+        self.assertEqual(list(iter_json_array([b'{"Other": [1]}'], "Contacts")), [])
+        self.assertEqual(list(iter_json_array([b'{}'], "Contacts")), [])
+
+    def testTruncatedRaises(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"Contacts": [{"Id": 1}, {"Id": '], "Contacts"))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"Contacts": [{"Id": 1}'], "Contacts"))
+
+
+if __name__ == '__main__':
+    unittest.main()
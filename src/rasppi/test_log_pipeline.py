@@ -0,0 +1,73 @@
+import logging
+import unittest
+from threading import Event
+from time import time
+from log_pipeline import LogPipeline
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.unblocked = Event()
+        self.records = []
+
+    def emit(self, record):
+        self.unblocked.wait(5.0)
+        self.records.append(self.format(record))
+
+
+class TestLogPipeline(unittest.TestCase):
+
+    def makeLogger(self, name):
+        logger = logging.getLogger(f"test_log_pipeline.{name}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        return logger
+
+    def testLoggingDoesNotWaitOnHandlers(self):
+        pipeline = LogPipeline()
+        logger = self.makeLogger("slow")
+        handler = SlowHandler()
+        logger.addHandler(handler)
+        pipeline.install(logger)
+        start = time()
+        for n in range(10):
+            logger.error(f"door {n} is slow")
+        self.assertLess(time() - start, 0.1)
+        handler.unblocked.set()
+        pipeline.stop()
+        self.assertEqual(handler.records, [f"door {n} is slow" for n in range(10)])
+
+    def testFullQueueDrops(self):
+        pipeline = LogPipeline(maxsize=5)
+        logger = self.makeLogger("full")
+        handler = SlowHandler()
+        pipeline.attach(logger, handler)
+        for n in range(20):
+            logger.warning("backed up")
+        self.assertGreaterEqual(pipeline.stats()["dropped"], 14)
+        handler.unblocked.set()
+        pipeline.stop()
+
+    def testHandlerLevelsAndTracebacks(self):
+        pipeline = LogPipeline()
+        logger = self.makeLogger("levels")
+        everything = SlowHandler()
+        errors = SlowHandler(logging.ERROR)
+        everything.unblocked.set()
+        errors.unblocked.set()
+        pipeline.attach(logger, everything)
+        pipeline.attach(logger, errors)
+        logger.info("opened")
+        try:
+            raise ValueError("relay stuck")
+        except ValueError:
+            logger.error("failed", exc_info=True)
+        pipeline.stop()
+        self.assertEqual(len(everything.records), 2)
+        self.assertEqual(len(errors.records), 1)
+        self.assertIn("ValueError: relay stuck", errors.records[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
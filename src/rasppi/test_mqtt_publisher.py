@@ -0,0 +1,159 @@
+import os
+import tempfile
+import unittest
+from threading import Lock
+from time import sleep, time
+
+import paho.mqtt.client as mqtt
+
+import mqtt_publisher
+from mqtt_publisher import MqttPublisher
+
+
+class FakeInfo():
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+
+
+class FakeClient():
+    """
+    Stands in for paho's client. Publishes are acknowledged at once unless the test queues up
+    return codes in refusals, and nothing connects until the test calls connect().
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.mid = 0
+        self.sent = []
+        self.attempts = []  # time of every publish call
+        self.refusals = []
+        self.kept = []  # payloads paho would hold on to and send after a reconnect
+        self.on_connect = self.on_disconnect = self.on_publish = None
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        pass
+
+    def connect_async(self, host, port):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def connect(self):
+        self.on_connect(self, None, {}, 0)
+
+    def publish(self, topic, payload, qos=0):
+        with self.lock:
+            self.mid += 1
+            self.attempts.append(time())
+            rc = self.refusals.pop(0) if self.refusals else mqtt.MQTT_ERR_SUCCESS
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                self.sent.append(payload)
+            elif qos > 0 and rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                self.kept.append(payload)
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            self.on_publish(self, None, self.mid)
+        return FakeInfo(self.mid, rc)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        sleep(0.005)
+    return condition()
+
+
+class TestMqttPublisher(unittest.TestCase):
+
+    def setUp(self):
+        client = mqtt_publisher.mqtt.Client
+        mqtt_publisher.mqtt.Client = FakeClient
+        self.addCleanup(setattr, mqtt_publisher.mqtt, "Client", client)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def publisher(self, **kwargs):
+        publisher = MqttPublisher("broker", 1883, "door/activity", **kwargs)
+        self.addCleanup(publisher.shutdown, 0.0)
+        return publisher
+
+    def testOverflowIsSpooledAndSentInOrder(self):
+        spool = os.path.join(self.directory.name, "spool")
+        publisher = self.publisher(queue_size=3, spool_file=spool)
+        for n in range(10):
+            publisher.publish(f"event {n}")
+        self.assertEqual(publisher.stats()["spooled"], 7)
+        self.assertTrue(os.path.exists(spool))
+
+        publisher._client.connect()
+        self.assertTrue(wait_for(lambda: publisher.stats()["published"] == 10))
+        self.assertEqual(publisher._client.sent, [f"event {n}" for n in range(10)])
+        self.assertFalse(os.path.exists(spool))
+        self.assertEqual(publisher.backlog(), 0)
+
+    def testSpoolSurvivesARestart(self):
+        spool = os.path.join(self.directory.name, "spool")
+        first = self.publisher(queue_size=1, spool_file=spool)
+        for n in range(3):
+            first.publish(f"event {n}")
+        second = self.publisher(queue_size=1, spool_file=spool)
+        self.assertEqual(second.stats()["spooled"], 2)
+
+    def testRefusedBatchIsRequeuedInOrder(self):
+        publisher = self.publisher(batch_size=5)
+        publisher._client.refusals = [mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN]
+        for n in range(5):
+            publisher.publish(f"event {n}")
+        publisher._client.connect()
+        self.assertTrue(wait_for(lambda: publisher.stats()["published"] == 5))
+        self.assertEqual(publisher._client.sent, [f"event {n}" for n in range(5)])
+        self.assertEqual(publisher.stats()["refused"], 1)
+
+    def testQosMessagesPahoKeptAreNotRequeued(self):
+        publisher = self.publisher(qos=1, batch_size=5)
+        publisher._client.refusals = [mqtt.MQTT_ERR_NO_CONN, mqtt.MQTT_ERR_QUEUE_SIZE]
+        for n in range(3):
+            publisher.publish(f"event {n}")
+        publisher._client.connect()
+        self.assertTrue(wait_for(lambda: len(publisher._client.sent) == 2))
+        # paho sends event 0 itself after reconnecting, only the one its full queue turned away comes back
+        self.assertEqual(publisher._client.kept, ["event 0"])
+        self.assertEqual(publisher._client.sent, ["event 1", "event 2"])
+        self.assertEqual(publisher.stats()["refused"], 2)
+        self.assertEqual(len(publisher._inflight), 1)
+
+    def testRefusalsBackOff(self):
+        publisher = self.publisher()
+        publisher._client.refusals = [mqtt.MQTT_ERR_QUEUE_SIZE] * 3
+        publisher.publish("event")
+        publisher._client.connect()
+        self.assertTrue(wait_for(lambda: publisher.stats()["published"] == 1))
+        attempts = publisher._client.attempts
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        self.assertEqual(len(gaps), 3)
+        for gap, expected in zip(gaps, (0.1, 0.2, 0.4)):
+            self.assertGreaterEqual(gap, expected * 0.9)
+            self.assertLess(gap, expected + 0.1)
+
+    def testNewMessagesDoNotCutTheBackoffShort(self):
+        publisher = self.publisher()
+        publisher._client.refusals = [mqtt.MQTT_ERR_QUEUE_SIZE]
+        publisher.publish("first")
+        publisher._client.connect()
+        self.assertTrue(wait_for(lambda: publisher.stats()["refused"] == 1))
+        publisher.publish("second")
+        sleep(0.03)
+        self.assertEqual(len(publisher._client.attempts), 1)
+        self.assertTrue(wait_for(lambda: publisher.stats()["published"] == 2))
+        self.assertEqual(publisher._client.sent, ["first", "second"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from time import sleep
+from negative_cache import NegativeCache
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def testHitAfterPut(self):
+        cache = NegativeCache()
+        key = ("fob", "1234", "frontdoor")
+        self.assertIsNone(cache.get(key, (0,)))
+        cache.put(key, {"auth.wildapricot": (False, None, "wildapricot:unknown_fob")}, (0,))
+        self.assertEqual(cache.get(key, (0,))["auth.wildapricot"][2], "wildapricot:unknown_fob")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def testKeyedByFacility(self):
+        cache = NegativeCache()
+        cache.put(("fob", "1234", "frontdoor"), {}, (0,))
+        self.assertIsNone(cache.get(("fob", "1234", "backdoor"), (0,)))
+
+    def testExpires(self):
+        cache = NegativeCache(ttl=0.05)
+        cache.put(("fob", "1234", "frontdoor"), {}, (0,))
+        sleep(0.1)
+        self.assertIsNone(cache.get(("fob", "1234", "frontdoor"), (0,)))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def testZeroTtlDisables(self):
+        cache = NegativeCache(ttl=0)
+        cache.put(("fob", "1234", "frontdoor"), {}, (0,))
+        self.assertIsNone(cache.get(("fob", "1234", "frontdoor"), (0,)))
+
+    def testRefreshInvalidates(self):
+        cache = NegativeCache()
+        cache.put(("fob", "1234", "frontdoor"), {}, (0, 3))
+        self.assertIsNone(cache.get(("fob", "1234", "frontdoor"), (0, 4)))
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = NegativeCache(max_entries=2)
+        cache.put("a", {}, (0,))
+        cache.put("b", {}, (0,))
+        cache.get("a", (0,))
+        cache.put("c", {}, (0,))
+        self.assertIsNotNone(cache.get("a", (0,)))
+        self.assertIsNone(cache.get("b", (0,)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from threading import Event
+from time import sleep, time
+from refresh_scheduler import RefreshScheduler
+
+
+class FakePlugin():
+    def __init__(self, interval=60, fail=False):
+        self.interval = interval
+        self.fail = fail
+        self.unblocked = Event()
+        self.unblocked.set()
+        self.refreshes = 0
+
+    def refresh_interval(self):
+        return self.interval
+
+    def refresh_database(self):
+        self.unblocked.wait(5.0)
+        self.refreshes += 1
+        if self.fail:
+            raise ValueError("api down")
+
+
+def wait_idle(scheduler, timeout=5.0):
+    end = time() + timeout
+    while any(r["running"] for r in scheduler.stats().values()) and time() < end:
+        sleep(0.01)
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    def testDueOnStartThenWaitsInterval(self):
+        plugin = FakePlugin(interval=100)
+        scheduler = RefreshScheduler([plugin])
+        self.assertEqual(scheduler.next_wait(), 0.0)
+        scheduler.run_due()
+        wait_idle(scheduler)
+        self.assertEqual(plugin.refreshes, 1)
+        self.assertGreater(scheduler.next_wait(), 50.0)
+        stats = scheduler.stats()[plugin.__module__]
+        self.assertIsNotNone(stats["last_success"])
+        self.assertGreaterEqual(stats["due_in"], 90.0)
+        self.assertLessEqual(stats["due_in"], 110.0)
+
+    def testNeverOverlaps(self):
+        plugin = FakePlugin(interval=0)
+        plugin.unblocked.clear()
+        scheduler = RefreshScheduler([plugin])
+        scheduler.run_due()
+        scheduler.request()
+        scheduler.run_due()
+        scheduler.run_due()
+        plugin.unblocked.set()
+        wait_idle(scheduler)
+        self.assertEqual(plugin.refreshes, 1)
+
+    def testRunDoesNotWaitForRefresh(self):
+        plugin = FakePlugin()
+        plugin.unblocked.clear()
+        scheduler = RefreshScheduler([plugin])
+        start = time()
+        scheduler.run_due()
+        self.assertLess(time() - start, 0.5)
+        self.assertTrue(scheduler.stats()[plugin.__module__]["running"])
+        plugin.unblocked.set()
+        wait_idle(scheduler)
+
+    def testFailureIsRecordedAndRetried(self):
+        plugin = FakePlugin(interval=3600, fail=True)
+        scheduler = RefreshScheduler([plugin])
+        scheduler.run_due()
+        wait_idle(scheduler)
+        stats = scheduler.stats()[plugin.__module__]
+        self.assertEqual(stats["failures"], 1)
+        self.assertIsNone(stats["last_success"])
+        self.assertIsNone(stats["staleness"])
+        self.assertEqual(stats["last_error"], "api down")
+        self.assertLess(stats["due_in"], 3600 * 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
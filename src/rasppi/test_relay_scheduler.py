@@ -0,0 +1,67 @@
+import unittest
+from threading import Event
+from time import sleep, time
+from relay_scheduler import RelayScheduler
+
+
+class FakeBoard():
+    def __init__(self):
+        self.relaystatus = {1: False, 2: False}
+        self.relocked = {}
+        self.relockEvent = Event()
+
+    def unlock(self, scheduler, relay, duration, credential=None):
+        scheduler.unlock(self, relay, duration, credential)
+        self.relaystatus[relay] = True
+
+    def relock(self, relay):
+        self.relaystatus[relay] = False
+        self.relocked[relay] = time()
+        self.relockEvent.set()
+
+
+class TestRelayScheduler(unittest.TestCase):
+
+    def testRelocksAtDeadline(self):
+        scheduler = RelayScheduler()
+        board = FakeBoard()
+        start = time()
+        board.unlock(scheduler, 1, 0.05, "fob:1")
+        self.assertTrue(board.relockEvent.wait(1.0))
+        self.assertGreaterEqual(board.relocked[1] - start, 0.05)
+        self.assertLess(board.relocked[1] - start, 0.2)
+        self.assertEqual(scheduler.jitter.count, 1)
+
+    def testStaysOpenUntilLastTimeout(self):
+        scheduler = RelayScheduler()
+        board = FakeBoard()
+        board.unlock(scheduler, 1, 0.05, "fob:1")
+        board.unlock(scheduler, 1, 0.2, "fob:2")
+        sleep(0.1)
+        self.assertTrue(board.relaystatus[1])
+        self.assertEqual(scheduler.pending(board, 1), 1)
+        self.assertTrue(board.relockEvent.wait(1.0))
+        self.assertFalse(board.relaystatus[1])
+
+    def testCancelByCredential(self):
+        scheduler = RelayScheduler()
+        board = FakeBoard()
+        board.unlock(scheduler, 1, 10, "fob:1")
+        board.unlock(scheduler, 1, 10, "fob:2")
+        scheduler.cancel(board, 1, "fob:1")
+        self.assertTrue(board.relaystatus[1])
+        scheduler.cancel(board, 1, "fob:2")
+        self.assertFalse(board.relaystatus[1])
+        self.assertEqual(scheduler.pending(board, 1), 0)
+
+    def testCancelAll(self):
+        scheduler = RelayScheduler()
+        board = FakeBoard()
+        board.unlock(scheduler, 2, 10, "fob:1")
+        board.unlock(scheduler, 2, 10, None)
+        scheduler.cancel(board, 2)
+        self.assertFalse(board.relaystatus[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from queue import Empty, Queue
+from threading import Thread
+from time import sleep
+from rpc import RPC, RpcClient, RpcTimeout
+
+
+class FakeService():
+    """Answers ('echo', value, delay) calls after delay seconds, out of order when delays differ"""
+
+    def __init__(self):
+        self.requests = Queue()
+        self.replies = Queue()
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            (tag, request_id, (command, value, delay)) = self.requests.get()
+            Thread(target=self.answer, args=(request_id, value, delay), daemon=True).start()
+
+    def answer(self, request_id, value, delay):
+        sleep(delay)
+        self.replies.put((request_id, value))
+
+
+class TestRpc(unittest.TestCase):
+
+    def testConcurrentCallsGetTheirOwnReplies(self):
+        service = FakeService()
+        client = RpcClient(service.requests, service.replies)
+        results = {}
+
+        def caller(n):
+            results[n] = client.call("echo", n, (10 - n) * 0.01, timeout=2.0)
+
+        callers = [Thread(target=caller, args=(n,)) for n in range(10)]
+        for c in callers:
+            c.start()
+        for c in callers:
+            c.join()
+        self.assertEqual(results, {n: n for n in range(10)})
+        self.assertEqual(client.stats()["in_flight"], 0)
+
+    def testTimeoutAndLateReplyIsDropped(self):
+        service = FakeService()
+        client = RpcClient(service.requests, service.replies)
+        with self.assertRaises(RpcTimeout):
+            client.call("echo", "slow", 0.3, timeout=0.05)
+        self.assertEqual(client.call("echo", "fast", 0.0, timeout=1.0), "fast")
+        sleep(0.4)
+        self.assertEqual(client.call("echo", "next", 0.0, timeout=1.0), "next")
+        stats = client.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["late"], 1)
+
+    def testUntaggedRepliesAreNotCountedLate(self):
+        service = FakeService()
+        client = RpcClient(service.requests, service.replies)
+        for reply in ("OK", ("a", "b", "c"), ["id", "value"]):
+            service.replies.put(reply)
+        self.assertEqual(client.call("echo", "after", 0.0, timeout=1.0), "after")
+        self.assertEqual(client.stats()["late"], 0)
+
+    def testTimeoutIsAnEmpty(self):
+        # callers written against the plain reply queue catch Empty
+        self.assertTrue(issubclass(RpcTimeout, Empty))
+
+    def testRequestsAreTagged(self):
+        requests = Queue()
+        client = RpcClient(requests, Queue())
+        with self.assertRaises(RpcTimeout):
+            client.call("checkfob", "1234", timeout=0.01)
+        (tag, request_id, command) = requests.get(timeout=1.0)
+        self.assertEqual(tag, RPC)
+        self.assertEqual(command, ("checkfob", "1234"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from time import sleep
+from scan_debouncer import ScanDebouncer
+
+
+class TestScanDebouncer(unittest.TestCase):
+
+    def testRepeatsAreAbsorbed(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        self.assertIsNone(debouncer.seen(key, 0.5, "front"))
+        held = debouncer.seen(key, 0.5, "front")
+        self.assertIsNotNone(held)
+        self.assertIsNotNone(debouncer.seen(key, 0.5, "front"))
+        self.assertEqual(held.absorbed, 2)
+        self.assertEqual(debouncer.stats()["absorbed"], {"front": 2})
+
+    def testOtherCredentialIsNotARepeat(self):
+        debouncer = ScanDebouncer()
+        self.assertIsNone(debouncer.seen(("sim://door", 1, 'F', "1234"), 0.5, "front"))
+        self.assertIsNone(debouncer.seen(("sim://door", 1, 'F', "5678"), 0.5, "front"))
+        self.assertIsNone(debouncer.seen(("sim://door", 2, 'F', "1234"), 0.5, "rear"))
+
+    def testWindowSlidesWhileHeld(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        debouncer.seen(key, 0.1, "front")
+        debouncer.granted(key, "frontdoor")
+        for n in range(4):
+            sleep(0.06)
+            self.assertIsNotNone(debouncer.seen(key, 0.1, "front"))
+        sleep(0.15)
+        self.assertIsNone(debouncer.seen(key, 0.1, "front"))
+
+    def testDeniedTapsAreDecidedAgainEachWindow(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        self.assertIsNone(debouncer.seen(key, 0.1, "front"))
+        decided = 1
+        for n in range(8):
+            sleep(0.03)
+            if debouncer.seen(key, 0.1, "front") is None:
+                decided += 1
+        self.assertGreaterEqual(decided, 2)
+
+    def testGrantIsRemembered(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        debouncer.seen(key, 0.5, "front")
+        debouncer.granted(key, "frontdoor")
+        self.assertEqual(debouncer.seen(key, 0.5, "front").facility, "frontdoor")
+
+    def testHeldFobStopsExtendingAfterMaxHold(self):
+        debouncer = ScanDebouncer()
+        debouncer.MAX_HOLD = 0.1
+        key = ("sim://door", 1, 'F', "1234")
+        debouncer.seen(key, 0.5, "front")
+        self.assertFalse(debouncer.can_extend(debouncer.seen(key, 0.5, "front")))
+        debouncer.granted(key, "frontdoor")
+        self.assertTrue(debouncer.can_extend(debouncer.seen(key, 0.5, "front")))
+        sleep(0.12)
+        held = debouncer.seen(key, 0.5, "front")
+        self.assertIsNotNone(held)
+        self.assertFalse(debouncer.can_extend(held))
+        self.assertEqual(debouncer.stats()["capped"], 1)
+
+    def testRestartedScanIsDecidedAgain(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        debouncer.seen(key, 0.5, "front")
+        debouncer.granted(key, "frontdoor")
+        debouncer.restart(key)
+        held = debouncer.seen(key, 0.5, "front")
+        self.assertIsNone(held.facility)
+
+    def testZeroWindowDisables(self):
+        debouncer = ScanDebouncer()
+        key = ("sim://door", 1, 'F', "1234")
+        self.assertIsNone(debouncer.seen(key, 0, "front"))
+        self.assertIsNone(debouncer.seen(key, 0, "front"))
+
+
+if __name__ == '__main__':
+    unittest.main()
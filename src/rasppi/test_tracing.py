@@ -0,0 +1,46 @@
+import unittest
+from time import sleep
+import tracing
+from tracing import ScanTrace, TraceRecorder
+
+
+class TestTracing(unittest.TestCase):
+
+    def testStagesFollowTheirMarks(self):
+        trace = ScanTrace()
+        for stage in (tracing.FRAMED, tracing.DISPATCHED, tracing.STARTED, tracing.AUTHORIZED, tracing.DECIDED):
+            sleep(0.01)
+            trace.mark(stage)
+        trace.mark(tracing.NOTIFIED)
+        stages = trace.stages()
+        self.assertEqual(list(stages), [tracing.FRAMED, tracing.DISPATCHED, tracing.STARTED,
+                                        tracing.AUTHORIZED, tracing.DECIDED, tracing.NOTIFIED])
+        self.assertGreaterEqual(stages[tracing.AUTHORIZED], 0.01)
+        self.assertAlmostEqual(sum(stages.values()), trace.total(), places=6)
+
+    def testRelayStagesFollowTheDecision(self):
+        trace = ScanTrace()
+        trace.mark(tracing.DECIDED)
+        trace.mark(tracing.RELAY_SENT)
+        trace.mark(tracing.NOTIFIED)
+        sleep(0.02)
+        trace.mark(tracing.RELAY_ACKED)
+        self.assertGreaterEqual(trace.stages()[tracing.RELAY_ACKED], 0.02)
+        self.assertLess(trace.stages()[tracing.NOTIFIED], 0.01)
+        self.assertAlmostEqual(trace.total(), trace.marks[tracing.RELAY_ACKED] - trace.marks[tracing.RECEIVED])
+
+    def testGrantFinishesAfterTheRelay(self):
+        recorder = TraceRecorder()
+        trace = ScanTrace()
+        recorder.park(trace)
+        self.assertIs(recorder.claim(trace.trace_id), trace)
+        self.assertIsNone(recorder.claim(trace.trace_id))
+        recorder.finish(trace)
+        self.assertEqual(recorder.total.count, 0)
+        recorder.finish(trace)
+        self.assertEqual(recorder.total.count, 1)
+        self.assertEqual(recorder.slowest()[0]["trace_id"], trace.trace_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
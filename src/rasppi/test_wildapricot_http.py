@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from time import sleep, time
+from auth import wildapricot
+from auth.wildapricot import WildApricotAuth
+
+
+class FakeResponse():
+    def __init__(self, status, document):
+        self.status_code = status
+        self.document = document
+        self.closed = False
+
+    def json(self):
+        return self.document
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession():
+    """Stands in for the plugin's requests.Session, hands out numbered tokens"""
+
+    def __init__(self, expires_in=1800, reject=(), delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.reject = set(reject)
+        self.tokens = 0
+        self.gets = []
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.tokens += 1
+        return FakeResponse(200, {"access_token": f"token{self.tokens}", "expires_in": self.expires_in})
+
+    def get(self, url, headers=None, params=None, timeout=None, stream=False):
+        token = headers['Authorization'].split()[1]
+        self.gets.append((token, timeout))
+        sleep(self.delay)
+        if token in self.reject:
+            return FakeResponse(401, {})
+        return FakeResponse(200, {"Contacts": [{"Id": 7, "Status": "Active", "MembershipEnabled": True,
+                                                "FieldValues": [{"FieldName": "Key Fob", "Value": "1234"}]}]})
+
+    def close(self):
+        pass
+
+
+class TestWildApricotHttp(unittest.TestCase):
+
+    def makeAuth(self, session):
+        auth = WildApricotAuth()
+        auth.read_configuration({"dbfile": ":memory:", "api_key": "test"})
+        auth.session = session
+        self.addCleanup(auth.on_close)
+        return auth
+
+    def testTokenIsReused(self):
+        session = FakeSession()
+        auth = self.makeAuth(session)
+        for n in range(5):
+            self.assertEqual(auth.get_single_contact("7", 1234)['person'], "7")
+        self.assertEqual(session.tokens, 1)
+        self.assertEqual(auth.stats()["token_hits"], 4)
+        self.assertEqual({timeout for token, timeout in session.gets}, {wildapricot.ON_DEMAND_TIMEOUT})
+
+    def testTokenIsRefreshedBeforeItExpires(self):
+        session = FakeSession(expires_in=0.1)
+        auth = self.makeAuth(session)
+        auth.get_access_token()
+        auth.get_access_token()
+        self.assertEqual(session.tokens, 1)
+        # refreshed halfway through a lifetime this short
+        sleep(0.06)
+        auth.get_access_token()
+        self.assertEqual(session.tokens, 2)
+
+    def testRejectedTokenIsReplacedOnce(self):
+        session = FakeSession(reject={"token1"})
+        auth = self.makeAuth(session)
+        self.assertEqual(auth.get_single_contact("7", 1234)['person'], "7")
+        self.assertEqual([token for token, timeout in session.gets], ["token1", "token2"])
+
+    def testOnDemandTimingsAreKept(self):
+        auth = self.makeAuth(FakeSession())
+        timings = {}
+        auth.get_single_contact("7", 1234, timings)
+        self.assertEqual(set(timings), {"token", "request", "decode"})
+
+    def testSlowOnDemandFallsBackToTheDatabase(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        auth = WildApricotAuth()
+        auth.read_configuration({"dbfile": os.path.join(directory.name, "wa.db"), "api_key": "test"})
+        auth.on_load()
+        self.addCleanup(auth.ScopedSession.remove)
+        auth.session = FakeSession(delay=0.5)
+        auth.list_wa_accounts = lambda: iter([{"person": "7", "fob": "f:1234", "enabled": True, "status": "Lapsed",
+                                               "renewal_due": datetime(2030, 1, 1), "banned": False,
+                                               "last_login": None, "membership_level": 1}])
+        auth.refresh_membership()
+        wait = wildapricot.ON_DEMAND_WAIT
+        wildapricot.ON_DEMAND_WAIT = 0.05
+        self.addCleanup(setattr, wildapricot, "ON_DEMAND_WAIT", wait)
+        for n in range(2):
+            start = time()
+            self.assertEqual(auth.on_scan("fob", "1234", None, None, datetime.now())[2], "wildapricot:not_active")
+            self.assertLess(time() - start, 0.4)
+        self.assertEqual(auth.stats()["on_demand_timeouts"], 2)
+        auth.on_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from auth.wildapricot import WildApricotAuth, WildApricotDb, WildApricotSyncState, SYNC_STATE_KEY
+
+
+def contact(person, fob, status="Active"):
+    return {"person": person, "fob": f"f:{fob}", "enabled": True, "status": status,
+            "renewal_due": datetime(2030, 1, 1), "banned": False, "last_login": None, "membership_level": 1}
+
+
+class TestWildApricotSync(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.auth = WildApricotAuth()
+        self.auth.read_configuration({"dbfile": os.path.join(self.directory.name, "wa.db"), "api_key": "test",
+                                      "full_refresh": 60})
+        self.auth.on_load()
+        self.full = [contact("1", 100), contact("2", 200), contact("3", 300)]
+        self.changed = []
+        self.since = []
+        self.auth.list_wa_accounts = lambda: iter(self.full)
+        self.auth.list_changed_accounts = lambda since: self.since.append(since) or iter(self.changed)
+
+    def tearDown(self):
+        self.auth.ScopedSession.remove()
+        self.directory.cleanup()
+
+    def members(self):
+        db = self.auth.ScopedSession()
+        try:
+            return {(m.person, m.code, m.member_status) for m in db.query(WildApricotDb)}
+        finally:
+            db.close()
+
+    def state(self) -> WildApricotSyncState:
+        db = self.auth.ScopedSession()
+        try:
+            return db.query(WildApricotSyncState).get(SYNC_STATE_KEY)
+        finally:
+            db.close()
+
+    def testFirstSyncIsFullThenDeltas(self):
+        self.auth.refresh_membership()
+        self.assertEqual(self.members(), {("1", "f:100", "Active"), ("2", "f:200", "Active"),
+                                          ("3", "f:300", "Active")})
+        first = self.state()
+        self.assertEqual((first.last_sync_mode, first.full_syncs, first.last_added), ("full", 1, 3))
+
+        self.changed = [("1", contact("1", 100, "Lapsed")), ("2", contact("2", 201)), ("3", None),
+                        ("4", contact("4", 400))]
+        version = self.auth.data_version
+        self.auth.refresh_membership()
+        self.assertEqual(self.members(), {("1", "f:100", "Lapsed"), ("2", "f:201", "Active"),
+                                          ("4", "f:400", "Active")})
+        second = self.state()
+        self.assertEqual((second.last_sync_mode, second.delta_syncs, second.last_contacts), ("delta", 1, 4))
+        self.assertEqual((second.last_added, second.last_modified, second.last_deleted), (2, 1, 2))
+        self.assertGreater(self.auth.data_version, version)
+        self.assertLess(self.since[0], first.watermark.replace(tzinfo=timezone.utc))
+        self.assertGreater(second.watermark, first.watermark)
+
+    def testFullReconcileRemovesDeletedContacts(self):
+        self.auth.refresh_membership()
+        db = self.auth.ScopedSession()
+        db.query(WildApricotSyncState).get(SYNC_STATE_KEY).last_full_sync = datetime.now() - timedelta(hours=2)
+        db.commit()
+        db.close()
+        self.full = [contact("1", 100)]
+        self.auth.refresh_membership()
+        self.assertEqual(self.members(), {("1", "f:100", "Active")})
+        self.assertEqual(self.state().full_syncs, 2)
+        self.assertEqual(self.since, [])
+
+    def testFullSyncOnlyWritesChangedMembers(self):
+        self.auth.refresh_membership()
+        self.full = [contact("1", 100), contact("2", 200, "Lapsed"), contact("3", 300), contact("5", 500)]
+        self.auth.FullRefresh = 0
+        self.auth.refresh_membership()
+        state = self.state()
+        self.assertEqual((state.last_added, state.last_modified, state.last_deleted), (1, 1, 0))
+        db = self.auth.ScopedSession()
+        member = db.query(WildApricotDb).filter(WildApricotDb.person == "2").one()
+        self.assertEqual(member.should_grant(datetime.now())[2], "wildapricot:not_active")
+        self.assertEqual(member.expiration, datetime(2030, 1, 1))
+        db.close()
+
+    def testMembersFromBeforeHashesAreMigrated(self):
+        path = os.path.join(self.directory.name, "old.db")
+        old = sqlite3.connect(path)
+        old.execute("CREATE TABLE members (id INTEGER PRIMARY KEY, person VARCHAR, person_url VARCHAR, code VARCHAR, "
+                    "member_enabled BOOLEAN, member_status VARCHAR, is_banned BOOLEAN, expiration DATETIME, "
+                    "membership_level INTEGER, last_login DATETIME, last_updated DATETIME)")
+        old.execute("INSERT INTO members (person, code, member_enabled, member_status, is_banned, expiration, "
+                    "membership_level, last_login, last_updated) VALUES ('1', 'f:100', 1, 'Active', 0, "
+                    "'2030-01-01 00:00:00.000000', 1, NULL, '2020-01-01 00:00:00.000000')")
+        old.commit()
+        old.close()
+        auth = WildApricotAuth()
+        auth.read_configuration({"dbfile": path, "api_key": "test"})
+        auth.on_load()
+        auth.list_wa_accounts = lambda: iter([contact("1", 100)])
+        auth.refresh_membership()
+        db = auth.ScopedSession()
+        state = db.query(WildApricotSyncState).get(SYNC_STATE_KEY)
+        self.assertEqual((state.last_added, state.last_modified, state.last_deleted), (0, 0, 0))
+        member = db.query(WildApricotDb).one()
+        self.assertIsNotNone(member.content_hash)
+        self.assertEqual(member.last_updated, datetime(2020, 1, 1))
+        db.close()
+        auth.ScopedSession.remove()
+
+    def testFailedSyncKeepsWatermark(self):
+        self.auth.refresh_membership()
+        watermark = self.state().watermark
+
+        def fail(since):
+            raise ConnectionError("api down")
+        self.auth.list_changed_accounts = fail
+        with self.assertRaises(ConnectionError):
+            self.auth.refresh_membership()
+        self.assertEqual(self.state().watermark, watermark)
+
+    def testDeltaFilterIsSentInUtc(self):
+        filters = []
+        self.auth.query_contacts = lambda contact_filter, select: filters.append(contact_filter) or iter([])
+        since = datetime(2024, 5, 1, 8, 30, tzinfo=timezone(timedelta(hours=-5)))
+        list(WildApricotAuth.list_changed_accounts(self.auth, since))  # setUp fakes it on the instance
+        self.assertEqual(filters, ["'Profile last updated' ge 2024-05-01T13:30:00+00:00"])
+
+    def testWatermarkIsUtc(self):
+        before = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.auth.refresh_membership()
+        self.assertLessEqual(before, self.state().watermark)
+        self.assertLess(self.state().watermark - before, timedelta(seconds=5))
+
+    def testScansUseTheIndexFromTheLastSync(self):
+        self.auth.refresh_membership()
+        before = self.auth.memberIndex
+        self.assertEqual(self.auth.on_scan("fob", "200", None, None, datetime.now())[:3],
+                         (True, "2", "wildapricot:needs_wa"))
+        # scans don't read the database, only a sync that changes something swaps the index
+        db = self.auth.ScopedSession()
+        db.query(WildApricotDb).filter(WildApricotDb.person == "2").delete()
+        db.commit()
+        db.close()
+        self.assertEqual(self.auth.on_scan("fob", "200", None, None, datetime.now())[1], "2")
+        self.changed = [("4", contact("4", 400))]
+        self.auth.refresh_membership()
+        self.assertIsNot(self.auth.memberIndex, before)
+        self.assertEqual(self.auth.on_scan("fob", "200", None, None, datetime.now())[2], "wildapricot:unknown_fob")
+        self.assertEqual(self.auth.on_scan("fob", "400", None, None, datetime.now())[1], "4")
+        self.assertEqual(before.members["f:200"].person, "2")
+
+    def testIndexIsLoadedAtStartup(self):
+        self.full = [contact("1", 100), contact("2", 100), contact("3", 300)]
+        self.auth.refresh_membership()
+        auth = WildApricotAuth()
+        auth.read_configuration({"dbfile": os.path.join(self.directory.name, "wa.db"), "api_key": "test"})
+        auth.on_load()
+        self.addCleanup(auth.ScopedSession.remove)
+        self.assertEqual(set(auth.memberIndex.members), {"f:100", "f:300"})
+        self.assertEqual(auth.memberIndex.duplicates, {"f:100"})
+        self.assertEqual(auth.memberIndex.members["f:300"].expiration, datetime(2030, 1, 1))
+        self.assertEqual(auth.on_scan("fob", "100", None, None, datetime.now())[1], "1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import uuid
+from collections import deque
+from threading import Lock
+from time import time
+from typing import Dict, Optional
+
+from metrics import RollingPercentiles
+
+# Marks a scan collects on its way through, each stage is timed from the mark it follows
+RECEIVED = "received"    # the read that brought the packet in returned
+FRAMED = "framing"       # packet split out of the serial stream and handed to the service
+DISPATCHED = "lookup"    # facility lookup and debounce done, queued for a decision worker
+STARTED = "queue"        # a decision worker picked the scan up
+AUTHORIZED = "auth"      # the auth modules (or the negative cache) answered
+DECIDED = "decide"       # activity built, before the unlock is requested
+NOTIFIED = "notify"      # mqtt payload built, logged to datadog and queued for the broker
+RELAY_SENT = "unlock"    # the service loop sent the relay command
+RELAY_ACKED = "relay"    # the board acknowledged the relay command
+
+# stage -> the mark it is timed from. Notifying and unlocking both follow the decision and overlap.
+FOLLOWS = {FRAMED: RECEIVED, DISPATCHED: FRAMED, STARTED: DISPATCHED, AUTHORIZED: STARTED,
+           DECIDED: AUTHORIZED, NOTIFIED: DECIDED, RELAY_SENT: DECIDED, RELAY_ACKED: RELAY_SENT}
+STAGES = tuple(FOLLOWS)
+
+
+class ScanTrace():
+    """Timestamps for one scan on its way from the serial port to the relay"""
+    __slots__ = ('trace_id', 'marks', 'modules', 'credential', 'facility', 'result', 'timestamp', 'parts')
+
+    def __init__(self, received=None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.marks = {RECEIVED: received if received is not None else time()}
+        self.modules = {}  # auth module -> seconds it took to answer
+        self.credential = None
+        self.facility = None
+        self.result = None
+        self.timestamp = None
+        self.parts = 1  # finish() calls still expected, one more while a relay command is out
+
+    def mark(self, stage):
+        self.marks[stage] = time()
+
+    def stages(self) -> Dict[str, float]:
+        """:return: seconds spent in each stage reached so far"""
+        return {stage: self.marks[stage] - self.marks[prior] for stage, prior in FOLLOWS.items()
+                if stage in self.marks and prior in self.marks}
+
+    def total(self):
+        return max(self.marks.values()) - self.marks[RECEIVED]
+
+    def summary(self):
+        return {"trace_id": self.trace_id, "credential": self.credential, "facility": self.facility,
+                "result": self.result, "timestamp": self.timestamp, "total": self.total(),
+                "stages": self.stages(), "modules": dict(self.modules)}
+
+
+class TraceRecorder():
+    """
+    Aggregates finished scan traces into per-stage percentiles and keeps the recent ones around.
+
+    A trace is finished once every part of the scan has called finish(), a granted scan isn't done
+    until its relay command has been answered. Traces waiting on a relay are parked by id so the
+    service loop can pick them up.
+    """
+
+    def __init__(self, recent=500):
+        self._lock = Lock()
+        self.stageLatency: Dict[str, RollingPercentiles] = {s: RollingPercentiles() for s in STAGES}
+        self.total = RollingPercentiles()
+        self._recent = deque(maxlen=recent)
+        self._parked: Dict[str, ScanTrace] = {}
+
+    def park(self, trace: ScanTrace):
+        """Holds the trace for a relay command, claim() hands it back"""
+        with self._lock:
+            trace.parts += 1
+            self._parked[trace.trace_id] = trace
+
+    def claim(self, trace_id) -> Optional[ScanTrace]:
+        with self._lock:
+            return self._parked.pop(trace_id, None)
+
+    def finish(self, trace: ScanTrace):
+        with self._lock:
+            trace.parts -= 1
+            if trace.parts > 0:
+                return
+            self._recent.append(trace)
+        for stage, seconds in trace.stages().items():
+            self.stageLatency[stage].add(seconds)
+        self.total.add(trace.total())
+
+    def slowest(self, count=20):
+        with self._lock:
+            recent = list(self._recent)
+        return [t.summary() for t in sorted(recent, key=lambda t: t.total(), reverse=True)[:count]]
+
+    def stats(self):
+        return {"total": self.total.snapshot(),
+                "stages": {s: p.snapshot() for s, p in self.stageLatency.items()}}
@@ -5,10 +5,10 @@ from configuration import Config, Configuration, ConfigurationException
 from itertools import groupby
 import logging
 import subprocess
-from time import sleep
 logger = logging.getLogger("webpanel")
 from datadog_logger import get_datadog_logger
-dd_logger = get_datadog_logger("authorization_service", "authorization_service")
+from log_pipeline import Pipeline
+dd_logger = Pipeline.install(get_datadog_logger("authorization_service", "authorization_service"))
 from flask import Flask, render_template, jsonify, request, redirect, g, stream_with_context, Response
 from flask_httpauth import HTTPDigestAuth
 from sqlalchemy.orm import Session
@@ -16,7 +16,8 @@ from datetime import datetime
 from pytz import utc
 
 from models import Activity#, AccessRequirement, Credential
-from multiprocessing import Queue
+import tracing
+from rpc import RpcClient
 from queue import Empty
 
 webpanel = Flask(__name__)
@@ -50,6 +51,14 @@ def is_info(s : str):
 def is_debug(s : str):
     return "text-secondary" if s.startswith("DEBUG") else ""
 
+@webpanel.template_filter()
+def ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000.0:.1f}ms"
+
+@webpanel.template_filter()
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
 @webpanel.template_filter()
 def pretty_past(d : datetime):
     now = datetime.now()
@@ -126,12 +135,9 @@ def configuration():
 @webpanel.route('/query_hardware', methods=['post'])
 @auth.login_required
 def query_hardware():
-    #rapidly clicking query could cause problems.
-    q: Queue = webpanel.config['squeue']
-    w: Queue = webpanel.config['wqueue']
-    q.put(("query",))
+    service: RpcClient = webpanel.config['rpc']
     try:
-        status = w.get(True, 10.0)
+        status = service.call("query", timeout=10.0)
     except Empty:
         status = []
 
@@ -168,13 +174,11 @@ def update_config():
         with open(Config.FileName,'w') as out:
             out.write(newconfig)
         Config.Reload()
-        q: Queue = webpanel.config['squeue']
-        w: Queue = webpanel.config['wqueue']
-        q.put(("reload",))
+        service: RpcClient = webpanel.config['rpc']
         try:
-            w.get(True, 3.00) #wait for a response before doing anything else
-        except Empty: #TODO
-            pass
+            service.call("reload", timeout=10.0) #wait for a response before doing anything else
+        except Empty:
+            logger.warning("Authorization service didn't confirm the configuration reload")
         return redirect("/config")
     except ConfigurationException as ce:
         return jsonify({'result':'failed', "message" : str(ce) })
@@ -273,16 +277,15 @@ def format_active(ar):
 @webpanel.route('/diagnostics')
 @auth.login_required
 def diagnostics():
-    q: Queue = webpanel.config['squeue']
-    w: Queue = webpanel.config['wqueue']
-    q.put(("status",))
+    service: RpcClient = webpanel.config['rpc']
     try:
-        status = w.get(True,0.250)
+        status = service.call("status", timeout=2.0)
     except Empty:
         status = {}
     g.dbsession = Config.ScopedSession()
+    facility_status = status.get("facilities", {})
     facility_map = {}
-    for f in status:
+    for f in facility_status:
         facility_map[f] = ( Config.Facilities[f].board, Config.Facilities[f].relay )
     #requirements : List[AccessRequirement] = list(g.dbsession.query(AccessRequirement).order_by(AccessRequirement.requiredpriority.desc()).all())
     #TODO
@@ -292,7 +295,25 @@ def diagnostics():
         if r.is_active():
             requiredLevel = max(requiredLevel,r.requiredpriority)
 
-    return render_template('diagnostics.html',facility_status=status,facility_map=facility_map,requirements=requirements,rlevel=requiredLevel,ctx="diagnostics")
+    return render_template('diagnostics.html',facility_status=facility_status,facility_map=facility_map,
+                           boards=status.get("boards", {}),relock_jitter=status.get("relock_jitter"),
+                           decisions=status.get("decisions"),activity=status.get("activity"),mqtt=status.get("mqtt"),
+                           auth=status.get("auth"),negative_cache=status.get("negative_cache"),
+                           debounce=status.get("debounce"),log_pipeline=status.get("logging"),
+                           refresh=status.get("refresh"),rpc=service.stats(),
+                           plugins=status.get("plugins"),
+                           requirements=requirements,rlevel=requiredLevel,ctx="diagnostics")
+
+@webpanel.route('/slowscans')
+@auth.login_required
+def slowscans():
+    service: RpcClient = webpanel.config['rpc']
+    try:
+        status = service.call("status", timeout=2.0)
+    except Empty:
+        status = {}
+    return render_template('slowscans.html',traces=status.get("traces"),slow_scans=status.get("slow_scans", []),
+                           stages=tracing.STAGES,ctx="slowscans")
 
 @webpanel.route('/lock',methods=['post'])
 @auth.login_required
@@ -300,9 +321,8 @@ def lock():
     try:
         board = request.form['board']
         relay = int(request.form['index'])
-        q: Queue = webpanel.config['squeue']
-        q.put(("lock",board,relay,None))
-        sleep(0.5) #less than ideal
+        service: RpcClient = webpanel.config['rpc']
+        service.call("lock",board,relay,None, timeout=2.0)
         return redirect("/diagnostics")
     except:
         return redirect("/diagnostics")
@@ -317,9 +337,9 @@ def unlock():
         relay = int(request.form['index'])
         duration = int(float(request.form['duration']))
         dd_logger.info(f"Manual unlock of door for {duration} seconds triggered.")
-        q: Queue = webpanel.config['squeue']
-        q.put(("unlock",board,relay,duration,None))
-        sleep(0.5)  # less than ideal
+        service: RpcClient = webpanel.config['rpc']
+        # answered once the board acknowledges the relay command
+        service.call("unlock",board,relay,duration,None, timeout=2.0)
         return redirect("/diagnostics")
     except:
         return redirect("/diagnostics")
@@ -330,16 +350,11 @@ def test_fob():
     if 'fobnumber' not in request.args:
         return redirect("/diagnostics")
     fob_to_test = str(int(request.args['fobnumber']))
-    q: Queue = webpanel.config['squeue']
-    w: Queue = webpanel.config['wqueue']
+    service: RpcClient = webpanel.config['rpc']
     try:
-        while True:
-            w.get(block=False)
+        result = service.call("checkfob", fob_to_test, timeout=5.0)
     except Empty:
-        pass
-
-    q.put(("checkfob", fob_to_test))
-    result = w.get(True, 1.0)
+        result = None
 
     try:
         return render_template("fobtest.html",results=result, tested_fob=request.args['fobnumber'])